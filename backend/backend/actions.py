@@ -12,14 +12,16 @@ import tempfile
 
 from munch import Munch
 from distutils.dir_util import copy_tree
-from copr.exceptions import CoprRequestException
+from copr.exceptions import CoprException, CoprRequestException
 from requests import RequestException
 
 from .sign import create_user_keys, CoprKeygenRequestError
-from .createrepo import createrepo
+from .createrepo import createrepo, record_changes, get_state_dir
 from .exceptions import CreateRepoError, CoprSignError
-from .helpers import get_redis_logger, silent_remove, ensure_dir_exists, get_chroot_arch
+from .helpers import get_redis_logger, silent_remove, ensure_dir_exists, get_chroot_arch, \
+    ProjectFlagsCache
 from .sign import sign_rpms_in_dir, unsign_rpms_in_dir, get_pubkey
+from .vm_manage.manager import VmManager
 
 
 class Action(object):
@@ -48,6 +50,7 @@ class Action(object):
         self.destdir = self.opts.destdir
         self.front_url = self.opts.frontend_base_url
         self.results_root_url = self.opts.results_baseurl
+        self.project_flags = ProjectFlagsCache(self.opts)
 
         self.log = get_redis_logger(self.opts, "backend.actions", "actions")
 
@@ -57,6 +60,14 @@ class Action(object):
     def handle_legal_flag(self):
         self.log.debug("Action legal-flag: ignoring")
 
+    def handle_cancel_build(self, result):
+        data = json.loads(self.data["data"])
+        vmm = VmManager(self.opts, logger=self.log)
+        interrupted = vmm.interrupt_build(data["build_id"])
+        self.log.info("Action cancel build {}: interrupted {} running chroots"
+                      .format(data["build_id"], interrupted))
+        result.result = ActionResult.SUCCESS
+
     def handle_createrepo(self, result):
         self.log.debug("Action create repo")
         data = json.loads(self.data["data"])
@@ -74,7 +85,7 @@ class Action(object):
             try:
                 createrepo(path=path, front_url=self.front_url,
                            username=username, projectname=projectname,
-                           override_acr_flag=True)
+                           override_acr_flag=True, state_dir=get_state_dir(self.opts, path))
                 done_count += 1
             except CoprRequestException as err:
                 # fixme: dirty hack to catch case when createrepo invoked upon deleted project
@@ -94,6 +105,18 @@ class Action(object):
     def get_chroot_result_dir(self, chroot, projectname, username):
         return os.path.join(self.destdir, username, projectname, chroot)
 
+    def move_state_dir(self, old_path, new_path):
+        """
+        Move the createrepo state of the repos in `old_path` along with them
+        """
+        old_state_dir = get_state_dir(self.opts, old_path)
+        new_state_dir = get_state_dir(self.opts, new_path)
+        if not os.path.exists(old_state_dir):
+            return
+        shutil.rmtree(new_state_dir, ignore_errors=True)
+        ensure_dir_exists(os.path.dirname(new_state_dir), self.log)
+        shutil.move(old_state_dir, new_state_dir)
+
     def handle_rename(self, result):
         self.log.debug("Action rename")
         old_path = os.path.normpath(os.path.join(
@@ -104,6 +127,7 @@ class Action(object):
         if os.path.exists(old_path):
             if not os.path.exists(new_path):
                 shutil.move(old_path, new_path)
+                self.move_state_dir(old_path, new_path)
                 result.result = ActionResult.SUCCESS
             else:
                 result.message = "Destination directory already exist."
@@ -156,7 +180,7 @@ class Action(object):
             for chroot in chroots:
                 createrepo(path=chroot, front_url=self.front_url,
                            username=data["user"], projectname=data["copr"],
-                           override_acr_flag=True)
+                           override_acr_flag=True, state_dir=get_state_dir(self.opts, chroot))
 
             result.result = ActionResult.SUCCESS
             result.ended_on = time.time()
@@ -174,6 +198,20 @@ class Action(object):
         if os.path.exists(path):
             self.log.info("Removing copr {0}".format(path))
             shutil.rmtree(path)
+        # a project created again under the same name starts from scratch
+        shutil.rmtree(get_state_dir(self.opts, path), ignore_errors=True)
+        owner_project = project.split("/", 1)
+        if len(owner_project) == 2:
+            self.project_flags.invalidate(*owner_project)
+
+    def handle_update_project(self, result):
+        data = json.loads(self.data["data"])
+        self.log.info("Action update project {}/{}: {}"
+                      .format(data["username"], data["projectname"], data))
+        self.project_flags.update(data["username"], data["projectname"],
+                                  auto_createrepo=data.get("auto_createrepo"),
+                                  persistent=data.get("persistent"))
+        result.result = ActionResult.SUCCESS
 
     def handle_comps_update(self, result):
         self.log.debug("Action delete build")
@@ -242,6 +280,9 @@ class Action(object):
         username = ext_data["username"]
         projectname = ext_data["projectname"]
         chroots_requested = set(ext_data["chroots"])
+        self.project_flags.update(username, projectname,
+                                  auto_createrepo=ext_data.get("auto_createrepo"),
+                                  persistent=ext_data.get("persistent"))
 
         if "src_pkg_name" not in ext_data and "result_dir_name" not in ext_data:
             self.log.error("Delete build action missing `src_pkg_name` or `result_dir_name` field,"
@@ -271,19 +312,35 @@ class Action(object):
                           .format(target_dir, ext_data))
             return
 
+        try:
+            auto_createrepo = self.project_flags.get(username, projectname, "auto_createrepo")
+        except (CoprException, RequestException):
+            # repos are regenerated with the queued removals by the next createrepo run
+            self.log.exception("Failed to get auto_createrepo flag of {}/{}, repos are not regenerated"
+                               .format(username, projectname))
+            auto_createrepo = None
+
         for chroot in chroots_to_do:
             self.log.debug("In chroot {0}".format(chroot))
             altered = False
 
             pkg_path = os.path.join(path, chroot, target_dir)
             if os.path.isdir(pkg_path):
+                removed = [os.path.join(target_dir, name)
+                           for name in os.listdir(pkg_path) if name.endswith(".rpm")]
                 self.log.info("Removing build {0}".format(pkg_path))
                 shutil.rmtree(pkg_path)
                 altered = True
             else:
                 self.log.debug("Package {0} dir not found in chroot {1}".format(target_dir, chroot))
 
-            if altered:
+            if altered and auto_createrepo is None:
+                chroot_path = os.path.join(path, chroot)
+                for name in ["createrepo", "createrepo-devel"]:
+                    record_changes(chroot_path, name, removed=removed,
+                                   state_dir=get_state_dir(self.opts, chroot_path))
+
+            elif altered:
                 self.log.debug("Running createrepo")
 
                 result_base_url = "/".join(
@@ -293,7 +350,10 @@ class Action(object):
                     createrepo(
                         path=createrepo_target,
                         front_url=self.front_url, base_url=result_base_url,
-                        username=username, projectname=projectname
+                        username=username, projectname=projectname,
+                        auto_createrepo=auto_createrepo,
+                        removed=removed,
+                        state_dir=get_state_dir(self.opts, createrepo_target)
                     )
                 except CoprRequestException:
                     # FIXME: dirty hack to catch the case when createrepo invoked upon a deleted project
@@ -340,7 +400,7 @@ class Action(object):
                 os.makedirs(chrootdir)
                 createrepo(path=chrootdir, front_url=self.front_url,
                            username=data["user"], projectname=data["copr"],
-                           override_acr_flag=True)
+                           override_acr_flag=True, state_dir=get_state_dir(self.opts, chrootdir))
 
             for build in data["builds"]:
                 srcdir = os.path.join(self.opts.destdir, data["user"], data["copr"], data["rawhide_chroot"], build)
@@ -402,7 +462,7 @@ class Action(object):
                     })
                     createrepo(path=destdir, front_url=self.front_url,
                                username=ownername, projectname=projectname,
-                               override_acr_flag=True)
+                               override_acr_flag=True, state_dir=get_state_dir(self.opts, destdir))
 
             modules_file_write = open(os.path.join(project_path, "modules", "modules.json"), "w+")
             modules_file_write.write(json.dumps(modules, indent=4))
@@ -456,6 +516,12 @@ class Action(object):
         elif action_type == ActionType.BUILD_MODULE:
             self.handle_build_module(result)
 
+        elif action_type == ActionType.CANCEL_BUILD:
+            self.handle_cancel_build(result)
+
+        elif action_type == ActionType.UPDATE_PROJECT:
+            self.handle_update_project(result)
+
         self.log.info("Action result: {}".format(result))
 
         if "result" in result:
@@ -480,6 +546,8 @@ class ActionType(object):
     FORK = 7
     UPDATE_MODULE_MD = 8
     BUILD_MODULE = 9
+    CANCEL_BUILD = 10
+    UPDATE_PROJECT = 11
 
 
 class ActionResult(object):
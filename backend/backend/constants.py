@@ -3,6 +3,8 @@ import os
 mockchain = "/usr/bin/mockchain"
 # rsync path
 rsync = "/usr/bin/rsync"
+# suffixes of the already compressed files, rsync doesn't compress them again
+RSYNC_SKIP_COMPRESS = "rpm/gz/bz2/xz/zip/tgz/tbz/txz/lz/lzma/zst/7z"
 
 DEF_REMOTE_BASEDIR = "/var/tmp"
 DEF_BUILD_TIMEOUT = 3600 * 6
@@ -27,6 +29,10 @@ class BuildStatus(object):
 
 
 LOG_PUB_SUB = "copr:backend:log:pubsub::"
+# frontend announces new build/action tasks here, keep in sync with copr-frontend
+NEW_WORK_PUB_SUB = "copr:backend:new_work:pubsub::"
+# live output of the running build, argument - task_id
+BUILD_LOG_PUB_SUB = "copr:backend:build_log:pubsub::{task_id}"
 
 from logging import Formatter
 default_log_format = Formatter(
@@ -1,4 +1,10 @@
+import errno
+import fcntl
+import hashlib
+import json
 import os
+import shutil
+import time
 from subprocess import Popen, PIPE
 
 from setproctitle import getproctitle, setproctitle
@@ -11,7 +17,8 @@ from lockfile import LockFile
 # log = get_redis_logger(opts, "createrepo", "actions")
 
 from .helpers import get_auto_createrepo_status
-from .exceptions import CreateRepoError
+from .exceptions import CreateRepoError, RpmHeaderError
+from .rpmheader import get_file_names
 
 
 def run_cmd_unsafe(comm_str, lock_path):
@@ -35,7 +42,7 @@ def run_cmd_unsafe(comm_str, lock_path):
     return out
 
 
-def createrepo_unsafe(path, dest_dir=None, base_url=None):
+def createrepo_unsafe(path, dest_dir=None, base_url=None, pkglist=None, skip_stat=False):
     """
         Run createrepo_c on the given path
 
@@ -47,6 +54,10 @@ def createrepo_unsafe(path, dest_dir=None, base_url=None):
     :param str dest_dir: [optional] relative to path location for repomd, in most cases
         you should also provide base_url.
     :param str base_url: optional parameter for createrepo_c, "--baseurl"
+    :param str pkglist: [optional] file with the rpms (relative to path) to put
+        into the repo, createrepo_c doesn't walk the directory then
+    :param bool skip_stat: reuse the old metadata of packages by file name only,
+        only the packages missing there are read
 
     :return tuple: (return_code,  stdout, stderr)
     """
@@ -54,6 +65,10 @@ def createrepo_unsafe(path, dest_dir=None, base_url=None):
     comm = ['/usr/bin/createrepo_c', '--database', '--ignore-lock']
     if os.path.exists(path + '/repodata/repomd.xml'):
         comm.append("--update")
+    if pkglist:
+        comm.extend(["--pkglist", pkglist])
+    if skip_stat:
+        comm.append("--skip-stat")
     if "epel-5" in path:
         # this is because rhel-5 doesn't know sha256
         comm.extend(['-s', 'sha', '--checksum', 'md5'])
@@ -83,7 +98,6 @@ APPDATA_CMD_TEMPLATE = \
 --max-threads=4 \
 --temp-dir={packages_dir}/tmp \
 --cache-dir={packages_dir}/cache \
---packages-dir={packages_dir} \
 --output-dir={packages_dir}/appdata \
 --basename=appstream \
 --include-failed \
@@ -111,17 +125,125 @@ INCLUDE_MODULE_MD = \
 {packages_dir}/repodata
 """
 
-def add_appdata(path, username, projectname, lock=None):
+# packages with files here get into appstream metadata
+APPDATA_DIRS = ["/usr/share/applications/", "/usr/share/metainfo/", "/usr/share/appdata/"]
+
+
+def _read_json(json_path, default):
+    try:
+        with open(json_path) as handle:
+            return json.load(handle)
+    except (IOError, ValueError):
+        return default
+
+
+def _write_json(json_path, value):
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "w") as handle:
+        json.dump(value, handle)
+    os.rename(tmp_path, json_path)
+
+
+def _file_checksum(file_path):
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def ships_appdata(pkg_path):
+    """
+    :return: True when the rpm contains desktop or metainfo files
+    """
+    try:
+        return any(os.path.dirname(name) + "/" in APPDATA_DIRS
+                   for name in get_file_names(pkg_path))
+    except RpmHeaderError:
+        return False
+
+
+def find_appdata_packages(path, packages, state_dir=None):
+    """
+        Select packages for appstream-builder. Only packages not seen before
+        are inspected, results are kept in `.appdata.cache` by package checksum,
+        a file is checksummed again when its mtime changes.
+
+    :param packages: rpm paths relative to `path`
+    :param state_dir: see :py:func:`get_state_dir`
+    :return: sorted list of `packages` shipping desktop or metainfo files
+    """
+    cache_path = _state_path(path, state_dir, ".appdata.cache")
+    cache = _read_json(cache_path, {})
+    old_files = cache.get("files", {})
+    old_checksums = cache.get("checksums", {})
+
+    files, checksums, result = {}, {}, []
+    for pkg in sorted(packages):
+        pkg_path = os.path.join(path, pkg)
+        try:
+            mtime = os.stat(pkg_path).st_mtime
+        except OSError:
+            continue
+
+        old_mtime, checksum = old_files.get(pkg, (None, None))
+        if old_mtime != mtime:
+            checksum = _file_checksum(pkg_path)
+        if checksum not in old_checksums:
+            old_checksums[checksum] = ships_appdata(pkg_path)
+
+        files[pkg] = [mtime, checksum]
+        checksums[checksum] = old_checksums[checksum]
+        if checksums[checksum]:
+            result.append(pkg)
+
+    _write_json(cache_path, {"files": files, "checksums": checksums})
+    return result
+
+
+def add_appdata(path, username, projectname, lock=None, pkglist=None, state_dir=None):
+    """
+        Generate appstream metadata of the packages in `path` and include them
+        into repodata. appstream-builder runs only when the set of packages
+        shipping desktop or metainfo files changed since the last run, results
+        for the packages it processed before are reused.
+
+    :param str pkglist: [optional] file with the rpms of the repo, relative to path,
+        `path` is walked when not given
+    :param str state_dir: [optional] see :py:func:`get_state_dir`
+    """
     out = ""
     kwargs = {
         "packages_dir": path,
         "username": username,
         "projectname": projectname
     }
-    try:
-        out += "\n" + run_cmd_unsafe(
-            APPDATA_CMD_TEMPLATE.format(**kwargs), os.path.join(path, "createrepo.lock"))
+    if pkglist:
+        with open(pkglist) as handle:
+            packages = handle.read().splitlines()
+    else:
+        packages = walk_packages(path)
 
+    appdata_packages = find_appdata_packages(path, packages, state_dir)
+    generated_path = _state_path(path, state_dir, ".appdata.generated")
+    try:
+        if appdata_packages != _read_json(generated_path, None):
+            if appdata_packages:
+                cmd = APPDATA_CMD_TEMPLATE.format(**kwargs).strip()
+                if os.path.exists(os.path.join(path, "appdata", "appstream.xml.gz")):
+                    cmd += " --old-metadata={packages_dir}/appdata".format(**kwargs)
+                cmd += " " + " ".join(os.path.join(path, pkg) for pkg in appdata_packages)
+                out += "\n" + run_cmd_unsafe(cmd, os.path.join(path, "createrepo.lock"))
+
+                # appstream builder provide strange access rights to result dir
+                # fix them, so that lighttpd could serve appdata dir
+                out += "\n" + run_cmd_unsafe("chmod -R +rX {packages_dir}/appdata"
+                                             .format(**kwargs), os.path.join(path, "createrepo.lock"))
+            else:
+                shutil.rmtree(os.path.join(path, "appdata"), ignore_errors=True)
+            _write_json(generated_path, appdata_packages)
+
+        # createrepo_c drops the metadata it doesn't know about, include them again
         if os.path.exists(os.path.join(path, "appdata", "appstream.xml.gz")):
             out += "\n" + run_cmd_unsafe(
                 INCLUDE_APPSTREAM.format(**kwargs), os.path.join(path, "createrepo.lock"))
@@ -129,11 +251,6 @@ def add_appdata(path, username, projectname, lock=None):
         if os.path.exists(os.path.join(path, "appdata", "appstream-icons.tar.gz")):
             out += "\n" + run_cmd_unsafe(
                 INCLUDE_ICONS.format(**kwargs), os.path.join(path, "createrepo.lock"))
-
-        # appstream builder provide strange access rights to result dir
-        # fix them, so that lighttpd could serve appdata dir
-        out += "\n" + run_cmd_unsafe("chmod -R +rX {packages_dir}/appdata"
-                                     .format(**kwargs), os.path.join(path, "createrepo.lock"))
     except CreateRepoError as err:
         err.stdout = out + "\nLast command\n" + err.stdout
         raise
@@ -148,8 +265,219 @@ def add_module_md(path):
     return ""
 
 
+def get_state_dir(opts, path):
+    """
+    :return: directory in `opts.createrepo_state_dir` keeping the state files
+        of incremental createrepo runs for the repo in `path`, so that they
+        are not published together with the repo
+    """
+    path = os.path.abspath(path)
+    rel_path = os.path.relpath(path, os.path.abspath(opts.destdir))
+    if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+        # repo outside of destdir
+        rel_path = path.lstrip(os.sep)
+    return os.path.normpath(os.path.join(opts.createrepo_state_dir, rel_path))
+
+
+def _state_path(path, state_dir, file_name):
+    """
+    :return: path of the state file of the repo in `path`, the file is kept
+        in `state_dir` when given, otherwise in the repo itself
+    """
+    if state_dir is None:
+        return os.path.join(path, file_name)
+    try:
+        os.makedirs(state_dir)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    return os.path.join(state_dir, file_name)
+
+
+def _read_stamp(stamp_path):
+    try:
+        with open(stamp_path) as handle:
+            return float(handle.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def _write_stamp(stamp_path, value):
+    tmp_path = stamp_path + ".tmp"
+    with open(tmp_path, "w") as handle:
+        handle.write(repr(value))
+    os.rename(tmp_path, stamp_path)
+
+
+def run_coalesced(path, name, func, state_dir=None):
+    """
+        Run `func` regenerating the repo in `path`, unless another process did
+        that for us meanwhile. Calls for the same repo wait for each other, when
+        the running one finishes, the first waiting call runs `func` again and
+        covers all the others, since it sees every package which was in `path`
+        before it started. The others return without doing anything then.
+
+        Returning means that packages which were in `path` when called are
+        published in the repo.
+
+    :param name: distinguishes repos generated from the same directory
+    :param state_dir: see :py:func:`get_state_dir`
+    :return: output of `func` or "" when the request was covered by another run
+    """
+    requested_on = time.time()
+    if not os.path.isdir(path):
+        return func()
+
+    stamp_path = _state_path(path, state_dir, ".{}.stamp".format(name))
+    with open(_state_path(path, state_dir, ".{}.queue.lock".format(name)), "a") as queue_lock:
+        fcntl.flock(queue_lock, fcntl.LOCK_EX)
+        try:
+            # stamp is the start of the last successful run
+            if _read_stamp(stamp_path) > requested_on:
+                return ""
+            started_on = time.time()
+            out = func()
+            _write_stamp(stamp_path, started_on)
+            return out
+        finally:
+            fcntl.flock(queue_lock, fcntl.LOCK_UN)
+
+
+# full rebuild of the repo from the directory content, fixes whatever the
+# incremental runs could have missed
+CREATEREPO_FULL_PASS_PERIOD = 24 * 3600
+
+FULL_PASS = "*"
+
+
+def record_changes(path, name, added=None, removed=None, state_dir=None):
+    """
+        Queue package changes for the next run of `name` repo generation in
+        `path`. When neither `added` nor `removed` is known, the next run
+        walks the whole directory.
+
+    :param list added: rpm paths relative to `path`
+    :param list removed: rpm paths relative to `path`
+    :param str state_dir: [optional] see :py:func:`get_state_dir`
+    """
+    if added is None and removed is None:
+        lines = [FULL_PASS]
+    else:
+        lines = ["+" + pkg for pkg in added or []] + ["-" + pkg for pkg in removed or []]
+
+    with open(_state_path(path, state_dir, ".{}.changes".format(name)), "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            handle.write("".join(line + "\n" for line in lines))
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def take_changes(path, name, state_dir=None):
+    """
+    :return: (added, removed, full) package changes queued so far,
+        the queue is emptied
+    """
+    added, removed, full = set(), set(), False
+    with open(_state_path(path, state_dir, ".{}.changes".format(name)), "a+") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            handle.seek(0)
+            lines = handle.read().splitlines()
+            handle.truncate(0)
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+    for line in lines:
+        if line == FULL_PASS:
+            full = True
+        elif line.startswith("+"):
+            added.add(line[1:])
+            removed.discard(line[1:])
+        elif line.startswith("-"):
+            removed.add(line[1:])
+            added.discard(line[1:])
+    return added, removed, full
+
+
+def walk_packages(path):
+    """
+    :return: set of all rpm paths in `path`, relative to it
+    """
+    packages = set()
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(".rpm"):
+                packages.add(os.path.relpath(os.path.join(root, name), path))
+    return packages
+
+
+def prepare_pkglist(path, name, state_dir=None):
+    """
+        Apply queued changes to the list of packages in the repo, kept in
+        `.{name}.pkglist`. Packages are collected by walking `path` instead
+        when a full pass was requested, no list exists yet or the last full
+        pass is older than CREATEREPO_FULL_PASS_PERIOD.
+
+    :return: (pkglist_path, full, reused) where `reused` tells that some
+        added package replaced a file already in the repo
+    """
+    pkglist_path = _state_path(path, state_dir, ".{}.pkglist".format(name))
+    added, removed, full = take_changes(path, name, state_dir)
+
+    last_full_pass = _read_stamp(_state_path(path, state_dir, ".{}.full.stamp".format(name)))
+    if time.time() - last_full_pass > CREATEREPO_FULL_PASS_PERIOD \
+            or not os.path.exists(pkglist_path):
+        full = True
+
+    reused = False
+    if full:
+        packages = walk_packages(path)
+    else:
+        with open(pkglist_path) as handle:
+            packages = set(handle.read().splitlines())
+        reused = bool(packages & added)
+        packages = (packages - removed) | added
+
+    tmp_path = pkglist_path + ".tmp"
+    with open(tmp_path, "w") as handle:
+        handle.write("".join(pkg + "\n" for pkg in sorted(packages)))
+    os.rename(tmp_path, pkglist_path)
+    return pkglist_path, full, reused
+
+
+def run_incremental(path, name, func, added=None, removed=None, state_dir=None):
+    """
+        Regenerate repo in `path` from the known package changes, see
+        :py:func:`record_changes`. Runs are coalesced by :py:func:`run_coalesced`,
+        queued changes of all the covered calls are applied together.
+
+    :param func: callable(pkglist, skip_stat) running createrepo_c
+    :param state_dir: see :py:func:`get_state_dir`
+    """
+    if not os.path.isdir(path):
+        return func(None, False)
+
+    record_changes(path, name, added, removed, state_dir)
+
+    def run():
+        pkglist, full, reused = prepare_pkglist(path, name, state_dir)
+        try:
+            out = func(pkglist, not (full or reused))
+        except Exception:
+            # changes taken by this run are lost, the list may not match repodata
+            record_changes(path, name, state_dir=state_dir)
+            raise
+        if full:
+            _write_stamp(_state_path(path, state_dir, ".{}.full.stamp".format(name)), time.time())
+        return out
+
+    return run_coalesced(path, name, run, state_dir)
+
+
 def createrepo(path, front_url, username, projectname,
-               override_acr_flag=False, base_url=None):
+               override_acr_flag=False, base_url=None, added=None, removed=None,
+               auto_createrepo=None, state_dir=None):
     """
         Creates repo depending on the project setting "auto_createrepo".
         When enabled creates `repodata` at the provided path, otherwise
@@ -159,6 +487,13 @@ def createrepo(path, front_url, username, projectname,
     :param username: copr project owner username
     :param projectname: copr project name
     :param base_url: base_url to access rpms independently of repomd location
+    :param bool auto_createrepo: [optional] project setting when known by the caller,
+        otherwise it is fetched from frontend
+    :param list added: [optional] rpms (relative to path) new since the last run
+    :param list removed: [optional] rpms (relative to path) deleted since the last run,
+        when neither `added` nor `removed` is given, whole `path` is scanned
+    :param str state_dir: [optional] directory for the state of incremental runs,
+        see :py:func:`get_state_dir`, `path` itself when not given
     :param Multiprocessing.Lock lock:  [optional] global copr-backend lock
 
     :return: tuple(returncode, stdout, stderr) produced by `createrepo_c`
@@ -167,11 +502,18 @@ def createrepo(path, front_url, username, projectname,
 
     base_url = base_url or ""
 
-    acr_flag = get_auto_createrepo_status(front_url, username, projectname)
-    if override_acr_flag or acr_flag:
-        out_cr = createrepo_unsafe(path)
-        out_ad = add_appdata(path, username, projectname)
-        out_md = add_module_md(path)
-        return "\n".join([out_cr, out_ad, out_md])
+    if not override_acr_flag and auto_createrepo is None:
+        auto_createrepo = get_auto_createrepo_status(front_url, username, projectname)
+    if override_acr_flag or auto_createrepo:
+        def regenerate(pkglist, skip_stat):
+            out_cr = createrepo_unsafe(path, pkglist=pkglist, skip_stat=skip_stat)
+            out_ad = add_appdata(path, username, projectname, pkglist=pkglist, state_dir=state_dir)
+            out_md = add_module_md(path)
+            return "\n".join([out_cr, out_ad, out_md])
+        return run_incremental(path, "createrepo", regenerate, added, removed, state_dir)
     else:
-        return createrepo_unsafe(path, base_url=base_url, dest_dir="devel")
+        return run_incremental(
+            path, "createrepo-devel",
+            lambda pkglist, skip_stat: createrepo_unsafe(
+                path, base_url=base_url, dest_dir="devel", pkglist=pkglist, skip_stat=skip_stat),
+            added, removed, state_dir)
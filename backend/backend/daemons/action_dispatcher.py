@@ -14,12 +14,13 @@ from requests import get, RequestException
 from backend.frontend import FrontendClient
 
 from ..actions import Action
-from ..helpers import get_redis_logger
+from ..helpers import get_redis_logger, NewWorkListener
 
 
 class ActionDispatcher(multiprocessing.Process):
     """
-    1) Fetch action task from frontend
+    1) Fetch action task from frontend, wait for an announcement
+       of new actions when there is none
     2) Run it synchronously
     3) Go to 1)
     """
@@ -30,6 +31,7 @@ class ActionDispatcher(multiprocessing.Process):
         self.opts = opts
         self.log = get_redis_logger(self.opts, "backend.action_dispatcher", "action_dispatcher")
         self.frontend_client = FrontendClient(self.opts, self.log)
+        self.work_listener = NewWorkListener(self.opts, "action", self.log)
 
     def update_process_title(self, msg=None):
         proc_title = "Action dispatcher"
@@ -57,7 +59,7 @@ class ActionDispatcher(multiprocessing.Process):
                                    .format(self.opts.frontend_base_url, error))
             finally:
                 if not action_task:
-                    time.sleep(self.opts.sleeptime)
+                    self.work_listener.wait(self.opts.sleeptime)
 
         self.log.info("Got new action_task {} of type {}".format(action_task['id'], action_task['action_type']))
         return Action(self.opts, action_task, frontend_client=self.frontend_client)
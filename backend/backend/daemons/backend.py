@@ -20,6 +20,7 @@ from backend.frontend import FrontendClient
 
 from ..exceptions import CoprBackendError
 from ..helpers import BackendConfigReader, get_redis_logger
+from ..journal import JobJournal
 from .build_dispatcher import BuildDispatcher
 from .action_dispatcher import ActionDispatcher
 
@@ -59,9 +60,12 @@ class CoprBackend(object):
         self.update_conf()
         self.log.info("Initial config: {}".format(self.opts))
 
+        # journaled builds are resumed or rescheduled by the build dispatcher
+        keep = [{"build_id": entry["task"]["build_id"], "chroot": entry["task"]["chroot"]}
+                for entry in JobJournal(self.opts).entries()]
         try:
-            self.log.info("Rescheduling old unfinished builds")
-            self.frontend_client.reschedule_all_running(120) # 10 minutes
+            self.log.info("Rescheduling old unfinished builds, {} journaled builds kept".format(len(keep)))
+            self.frontend_client.reschedule_all_running(120, keep=keep) # 10 minutes
         except RequestException as err:
             self.log.exception(err)
             raise CoprBackendError(err)
@@ -9,24 +9,29 @@ import time
 import os
 import multiprocessing
 import json
+from collections import deque
 from setproctitle import setproctitle
-from requests import get, RequestException
+from requests import RequestException
 
 from backend.frontend import FrontendClient
 
-from ..helpers import get_redis_logger
-from ..exceptions import DispatchBuildError, NoVmAvailable
+from ..helpers import get_redis_logger, NewWorkListener, ProjectFlagsCache
+from ..exceptions import DispatchBuildError, NoVmAvailable, VmDescriptorNotFound
 from ..job import BuildJob
+from ..journal import JobJournal
+from ..vm_manage import VmStates
 from ..vm_manage.manager import VmManager
-from .worker import Worker
+from .worker import WorkerPool
 
 
 class BuildDispatcher(multiprocessing.Process):
     """
-    1) Fetch build task from frontend
+    1) Fetch build task from the local queue, lease a batch of tasks
+       which fit into ready VMs from frontend when the queue is empty,
+       if there is nothing to lease wait until frontend announces new builds
     2) Get a free VM for it
-    3) Create a worker for the job
-    4) Start it asynchronously and go to 1)
+    3) Pass the job to an idle worker from the pool
+    4) Go to 1)
     """
 
     def __init__(self, opts):
@@ -36,12 +41,20 @@ class BuildDispatcher(multiprocessing.Process):
         self.log = get_redis_logger(self.opts, "backend.build_dispatcher", "build_dispatcher")
         self.frontend_client = FrontendClient(self.opts, self.log)
         self.vm_manager = VmManager(self.opts)
+        self.work_listener = NewWorkListener(self.opts, "build", self.log)
 
         # Maps e.g. x86_64 && i386 => PC
         self.arch_to_group = dict()
         # PC => max N builders per user
         self.group_to_usermax = dict()
 
+        # build jobs leased from frontend, but not dispatched yet
+        self.job_queue = deque()
+
+        self.worker_pool = WorkerPool(self.opts, self.log)
+        self.journal = JobJournal(self.opts)
+        self.project_flags = ProjectFlagsCache(self.opts)
+
         self.init_internal_structures()
 
     def get_vm_group_id(self, arch):
@@ -68,30 +81,78 @@ class BuildDispatcher(multiprocessing.Process):
                self.log.debug("user might use only {0}VMs for {1} group".format(group["max_vm_per_user"], group_id))
                self.group_to_usermax[group_id] = group["max_vm_per_user"]
 
+    def get_capacity(self):
+        """
+        Describe build groups which can start a build right now, so that
+        frontend leases only jobs we are able to serve. Jobs for a saturated
+        group don't block the others then.
+
+        :return: list of dicts with archs of the group, number of ready VMs
+            with an idle worker, VM limit per owner and number of VMs used
+            by each owner
+        """
+        capacity = []
+        for group in self.opts.build_groups:
+            ready_count = len(self.vm_manager.get_vm_by_group_and_state_list(
+                group["id"], [VmStates.READY]))
+            ready_count = min(ready_count, self.worker_pool.idle_count(group["id"]))
+            if not ready_count:
+                continue
+
+            capacity.append({
+                "archs": group["archs"],
+                "count": ready_count,
+                "max_per_owner": self.group_to_usermax[group["id"]],
+                "owners_in_use": self.vm_manager.get_user_usage(group["id"]),
+            })
+        return capacity
+
+    def lease_jobs(self):
+        """
+        Refill local queue with a batch of build jobs leased from frontend,
+        we want to fill every ready VM at once.
+        """
+        self.collect_finished_jobs()
+        capacity = self.get_capacity()
+        if not capacity:
+            self.log.debug("No ready VM, nothing to lease")
+            return
+
+        try:
+            tasks = self.frontend_client.lease_builds(
+                sum(group["count"] for group in capacity), capacity)
+        except (RequestException, ValueError) as error:
+            self.log.exception("Leasing build jobs from {} failed with error: {}"
+                               .format(self.opts.frontend_base_url, error))
+            return
+
+        for task in tasks:
+            job = BuildJob(task, self.opts)
+            self.project_flags.update(job.project_owner, job.project_name,
+                                      auto_createrepo=job.auto_createrepo,
+                                      persistent=job.persistent)
+            self.job_queue.append(job)
+
+        if tasks:
+            self.log.info("Leased {} build jobs".format(len(tasks)))
+
     def load_job(self):
         """
-        Retrieve a single build job from frontend.
+        Retrieve a single build job, leased jobs are taken first.
         """
         self.log.info("Waiting for a job from frontend...")
         get_task_init_time = time.time()
 
-        task = None
-        while not task:
+        while not self.job_queue:
             self.update_process_title("Waiting for a job from frontend for {} s"
                                       .format(int(time.time() - get_task_init_time)))
-            try:
-                r = get("{0}/backend/waiting/".format(self.opts.frontend_base_url),
-                        auth=("user", self.opts.frontend_auth))
-                task = r.json().get("build")
-            except (RequestException, ValueError) as error:
-                self.log.exception("Retrieving build job from {} failed with error: {}"
-                                   .format(self.opts.frontend_base_url, error))
-            finally:
-                if not task:
-                    time.sleep(self.opts.sleeptime)
-
-        self.log.info("Got new build job {}".format(task['task_id']))
-        return BuildJob(task, self.opts)
+            self.lease_jobs()
+            if not self.job_queue:
+                self.work_listener.wait(self.opts.sleeptime)
+
+        job = self.job_queue.popleft()
+        self.log.info("Got new build job {}".format(job.task_id))
+        return job
 
     def can_build_start(self, job):
         """
@@ -114,13 +175,114 @@ class BuildDispatcher(multiprocessing.Process):
 
         return can_build_start
 
-    def clean_finished_workers(self, workers):
-        for worker in workers:
-            if not worker.is_alive():
-                worker.join(5)
-                workers.remove(worker)
-                self.log.info("Removed finished worker {} for job {}"
-                              .format(worker.worker_id, worker.job.task_id))
+    def collect_finished_jobs(self):
+        """
+        Free workers which finished their jobs and log how long it took
+        to get each job from the local queue to the actual build start.
+        """
+        for report in self.worker_pool.collect_finished():
+            if not report.get("started_on") or not report.get("loaded_on"):
+                continue
+            self.log.info(
+                "Dispatch overhead of job {}: {:.3f}s (VM acquire {:.3f}s, "
+                "handoff to worker {:.3f}s, start announcement {:.3f}s)".format(
+                    report["task_id"],
+                    report["started_on"] - report["loaded_on"],
+                    report["dispatched_on"] - report["loaded_on"],
+                    report["picked_on"] - report["dispatched_on"],
+                    report["started_on"] - report["picked_on"]))
+
+    def check_workers(self):
+        """
+        Replace dead workers, their detached builds are reattached by the new
+        workers. Other jobs are returned to the frontend queue and their VMs
+        are released.
+        """
+        for task in self.worker_pool.replace_dead_workers():
+            job, vm = task["job"], task["vm"]
+            entry = self.journal.get(job.task_id) or {
+                "task": job.to_task_dict(), "vm_name": vm.vm_name, "build_state": None}
+            try:
+                if self.resume_one_job(entry):
+                    continue
+            except Exception as error:
+                self.log.exception("Failed to resume job {}: {}".format(job.task_id, error))
+
+            self.log.error("Job {} lost with its worker, rescheduling".format(job.task_id))
+            self.release_lost_vm(entry)
+            self.journal.remove(job.task_id)
+            try:
+                self.frontend_client.reschedule_build(job.build_id, job.chroot)
+            except RequestException as error:
+                self.log.exception("Failed to reschedule job {}: {}".format(job.task_id, error))
+
+    def resume_one_job(self, entry):
+        """
+        Pass the journaled job to a worker when its build can be reattached,
+        i.e. it was started detached and its VM is still assigned to it.
+        Only the ssh transport can reattach to a build, with paramiko the job
+        is rescheduled.
+
+        :return: True if resumed
+        """
+        if self.opts.ssh.transport != "ssh" or not entry.get("build_state"):
+            return False
+
+        try:
+            vmd = self.vm_manager.get_vm_by_name(entry["vm_name"])
+        except VmDescriptorNotFound:
+            return False
+
+        job = BuildJob(entry["task"], self.opts)
+        # keep the VM from being reclaimed while the worker picks the job up
+        if not self.vm_manager.renew_vm_lease(vmd.vm_name, job.task_id):
+            return False
+
+        worker = self.worker_pool.submit(job, vmd, resume_from=entry)
+        if worker is None:
+            return False
+
+        self.log.info("Resumed job {} on VM {} by worker {}"
+                      .format(job.task_id, vmd.vm_name, worker.worker_id))
+        return True
+
+    def release_lost_vm(self, entry):
+        """
+        Return the VM of the job which can't be resumed into the pool,
+        unless it was reassigned meanwhile. The VM is terminated instead
+        when the detached build may still run there.
+        """
+        try:
+            vmd = self.vm_manager.get_vm_by_name(entry["vm_name"])
+        except VmDescriptorNotFound:
+            return
+        if vmd.state != VmStates.IN_USE or getattr(vmd, "task_id", None) != entry["task"]["task_id"]:
+            return
+        if entry.get("build_state"):
+            self.vm_manager.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.IN_USE)
+        else:
+            self.vm_manager.release_vm(vmd.vm_name)
+
+    def resume_journaled_jobs(self):
+        """
+        Reattach to the builds interrupted by the backend restart and
+        reschedule the lost ones.
+        """
+        for entry in self.journal.entries():
+            task = entry["task"]
+            try:
+                if self.resume_one_job(entry):
+                    continue
+            except Exception as error:
+                self.log.exception("Failed to resume job {}: {}".format(task["task_id"], error))
+
+            self.log.info("Job {} can't be resumed, rescheduling".format(task["task_id"]))
+            self.release_lost_vm(entry)
+            self.journal.remove(task["task_id"])
+            try:
+                self.frontend_client.reschedule_build(task["build_id"], task["chroot"])
+            except RequestException as error:
+                self.log.exception("Failed to reschedule job {}: {}".format(task["task_id"], error))
 
     def run(self):
         """
@@ -128,21 +290,25 @@ class BuildDispatcher(multiprocessing.Process):
         """
         self.log.info("Build dispatching started.")
         self.update_process_title()
+        self.worker_pool.start()
+        self.resume_journaled_jobs()
 
-        workers = []
-        next_worker_id = 1
         while True:
-            self.clean_finished_workers(workers)
+            self.check_workers()
+            self.collect_finished_jobs()
 
             job = self.load_job()
+            loaded_on = time.time()
 
             try:
                 self.log.info("Acquiring VM for job {}...".format(str(job)))
                 vm_group_id = self.get_vm_group_id(job.arch)
+                if not self.worker_pool.idle_count(vm_group_id):
+                    raise NoVmAvailable("All workers of group {} are busy".format(vm_group_id))
                 vm = self.vm_manager.acquire_vm(vm_group_id, job.project_owner, os.getpid(),
                                                 job.task_id, job.build_id, job.chroot)
             except NoVmAvailable as error:
-                self.log.info("No available resources for task {} (Reason: {}). Deferring job."
+                self.log.info("No available resources for task {} (Reason: {}). Returning lease."
                               .format(job.task_id, error))
                 self.frontend_client.defer_build(job.build_id, job.chroot)
                 continue
@@ -153,15 +319,11 @@ class BuildDispatcher(multiprocessing.Process):
                 self.vm_manager.release_vm(vm.vm_name)
                 continue
 
-            worker = Worker(
-                opts=self.opts,
-                frontend_client=self.frontend_client,
-                vm_manager=self.vm_manager,
-                worker_id=next_worker_id,
-                vm=vm, job=job
-            )
-            workers.append(worker)
-            worker.start()
-            self.log.info("Started new worker {} for job {}"
-                          .format(worker.worker_id, worker.job.task_id))
-            next_worker_id = (next_worker_id + 1) % 2**15
+            worker = self.worker_pool.submit(job, vm, loaded_on)
+            if worker is None:
+                self.log.info("No idle worker for task {}, returning lease.".format(job.task_id))
+                self.vm_manager.release_vm(vm.vm_name)
+                self.frontend_client.defer_build(job.build_id, job.chroot)
+                continue
+            self.log.info("Passed job {} to worker {}"
+                          .format(job.task_id, worker.worker_id))
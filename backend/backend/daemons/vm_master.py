@@ -10,10 +10,12 @@ from multiprocessing import Process
 import time
 from setproctitle import setproctitle
 import traceback
-import psutil
+from requests import RequestException
 
 from ..vm_manage import VmStates
+from ..vm_manage.autoscale import Autoscaler
 from ..exceptions import VmSpawnLimitReached
+from ..frontend import FrontendClient
 
 from ..helpers import get_redis_logger
 
@@ -36,97 +38,57 @@ class VmMaster(Process):
 
         self.kill_received = False
 
+        self.frontend_client = None
+        self.queue_stats = None
+        self.queue_stats_loaded_on = 0
+
         self.log = get_redis_logger(self.opts, "vmm.vm_master", "vmm")
         self.vmm.set_logger(self.log)
 
-    def remove_old_dirty_vms(self):
-        # terminate vms bound_to user and time.time() - vm.last_release_time > threshold_keep_vm_for_user_timeout
-        #  or add field to VMD ot override common threshold
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.READY]):
-            if vmd.get_field(self.vmm.rc, "bound_to_user") is None:
-                continue
-            last_release = vmd.get_field(self.vmm.rc, "last_release")
-            if last_release is None:
-                continue
-            not_re_acquired_in = time.time() - float(last_release)
-            if not_re_acquired_in > self.opts.build_groups[vmd.group]["vm_dirty_terminating_timeout"]:
-                self.log.info("dirty VM `{}` not re-acquired in {}, terminating it"
-                              .format(vmd.vm_name, not_re_acquired_in))
-                self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.READY)
-
-
-    def check_one_vm_for_dead_builder(self, vmd):
-        # TODO: builder should renew lease periodically
-        # and we should use that time instead of in_use_since and pid checks
-        in_use_since = vmd.get_field(self.vmm.rc, "in_use_since")
-        pid = vmd.get_field(self.vmm.rc, "used_by_pid")
-
-        if not in_use_since or not pid:
+    def check_one_dirty_vm(self, vmd):
+        if getattr(vmd, "bound_to_user", None) is None:
             return
-        in_use_time_elapsed = time.time() - float(in_use_since)
-
-        # give a minute for worker to set correct title
-        if in_use_time_elapsed < 60 and str(pid) == "None":
+        last_release = getattr(vmd, "last_release", None)
+        if last_release is None:
             return
+        not_re_acquired_in = time.time() - float(last_release)
+        if not_re_acquired_in > self.opts.build_groups[vmd.group]["vm_dirty_terminating_timeout"]:
+            self.log.info("dirty VM `{}` not re-acquired in {}, terminating it"
+                          .format(vmd.vm_name, not_re_acquired_in))
+            self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.READY)
 
-        pid = int(pid)
-        # try:
-        #     # here we can catch race condition: worker acquired VM but haven't set process title yet
-        #     if psutil.pid_exists(pid) and vmd.vm_name in psutil.Process(pid).cmdline[0]:
-        #         return
-        #
-        #     self.log.info("Process `{}` not exists anymore, doing second try. VM data: {}"
-        #                   .format(pid, vmd))
-        #     # dirty hack: sleep and check again
-        #     time.sleep(5)
-        #     if psutil.pid_exists(pid) and vmd.vm_name in psutil.Process(pid).cmdline[0]:
-        #         return
-        # except Exception:
-        #     self.log.exception("Failed do determine if process `{}` still alive for VM: {}, assuming alive"
-        #                        .format(pid, vmd))
-        #     return
-
-        # psutil changed Process().cmdline from property to function between f20 and f22
-        # disabling more precise check for now
-        try:
-            # here we can catch race condition: worker acquired VM but haven't set process title yet
-            if psutil.pid_exists(pid):
-                return
-
-            self.log.info("Process `{}` not exists anymore, doing second try. VM data: {}"
-                          .format(pid, vmd))
-            # dirty hack: sleep and check again
-            time.sleep(5)
-            if psutil.pid_exists(pid):
-                return
-
-        except Exception:
-            self.log.exception("Failed do determine if process `{}` still alive for VM: {}, assuming alive"
-                               .format(pid, vmd))
+    def get_lease_expiration(self, vmd):
+        """
+        :return: unixtime when the lease of the VM in use expires, or None
+        """
+        lease_expires = getattr(vmd, "lease_expires", None)
+        if lease_expires is not None:
+            return float(lease_expires)
+        # acquired before leases were introduced
+        in_use_since = getattr(vmd, "in_use_since", None)
+        if in_use_since is not None:
+            return float(in_use_since) + self.opts.vm_lease_timeout
+        return None
+
+    def check_one_vm_for_dead_builder(self, vmd):
+        """
+        Reclaim the VM when the builder stopped renewing its lease,
+        no matter on which host the builder runs.
+        """
+        lease_expires = self.get_lease_expiration(vmd)
+        if lease_expires is None or lease_expires > time.time():
             return
 
-        self.log.info("Process `{}` not exists anymore, terminating VM: {} ".format(pid, vmd.vm_name))
+        self.log.info("Lease of VM {} used by task {} expired, terminating VM"
+                      .format(vmd.vm_name, getattr(vmd, "task_id", None)))
         self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.IN_USE)
         # TODO: build rescheduling ?
 
-    def remove_vm_with_dead_builder(self):
-        # TODO: rewrite build manage at backend and move functionality there
-        # VMM shouldn't do this
-
-        # check that process who acquired VMD still exists, otherwise release VM
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.IN_USE]):
-            self.check_one_vm_for_dead_builder(vmd)
-
-    def check_vms_health(self):
-        # for machines in state ready and time.time() - vm.last_health_check > threshold_health_check_period
-        states_to_check = [VmStates.CHECK_HEALTH_FAILED, VmStates.READY,
-                           VmStates.GOT_IP, VmStates.IN_USE]
-
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, states_to_check):
-            last_health_check = vmd.get_field(self.vmm.rc, "last_health_check")
-            check_period = self.opts.build_groups[vmd.group]["vm_health_check_period"]
-            if not last_health_check or time.time() - float(last_health_check) > check_period:
-                self.start_vm_check(vmd.vm_name)
+    def check_one_vm_health(self, vmd):
+        last_health_check = getattr(vmd, "last_health_check", None)
+        check_period = self.opts.build_groups[vmd.group]["vm_health_check_period"]
+        if not last_health_check or time.time() - float(last_health_check) > check_period:
+            self.start_vm_check(vmd.vm_name)
 
     def start_vm_check(self, vm_name):
         """
@@ -139,7 +101,7 @@ class VmMaster(Process):
         if self.vmm.lua_scripts["set_checking_state"](keys=[vmd.vm_key], args=[time.time()]) == "OK":
             # can start
             try:
-                self.checker.run_check_health(vmd.vm_name, vmd.vm_ip)
+                self.checker.run_check_health(vmd.vm_name, vmd.vm_ip, orig_state)
             except Exception as err:
                 self.log.exception("Failed to start health check: {}".format(err))
                 if orig_state != VmStates.IN_USE:
@@ -199,7 +161,7 @@ class VmMaster(Process):
         """
         Starts spawning process if all conditions are satisfied
         """
-        # TODO: add setting "max_vm_in_ready_state", when this number reached, do not spawn more VMS, min value = 1
+        # groups with `autoscale` enabled use `autoscale_group` instead, which also respects `max_vm_in_ready_state`
 
         try:
             self._check_total_running_vm_limit(group)
@@ -219,21 +181,164 @@ class VmMaster(Process):
 
     def start_spawn_if_required(self):
         for group in self.vmm.vm_groups:
+            if self.opts.build_groups[group].get("autoscale"):
+                self.autoscale_group(group)
+            else:
+                self.try_spawn_one(group)
+
+    def get_queue_stats(self):
+        """
+        Frontend queue stats, refreshed at most once per `vm_cycle_timeout`
+
+        :return: dict arch -> stats or None when frontend is not available
+        """
+        if time.time() - self.queue_stats_loaded_on < self.opts.vm_cycle_timeout:
+            return self.queue_stats
+
+        if self.frontend_client is None:
+            self.frontend_client = FrontendClient(self.opts, self.log)
+        try:
+            self.queue_stats = self.frontend_client.get_queue_stats()
+        except (RequestException, ValueError) as error:
+            self.log.warning("Failed to get queue stats from frontend: {}".format(error))
+            self.queue_stats = None
+        self.queue_stats_loaded_on = time.time()
+        return self.queue_stats
+
+    def autoscale_group(self, group):
+        """
+        Spawn or terminate VMs of the group to follow the frontend queue,
+        falls back to `try_spawn_one` when queue stats are not available.
+        """
+        queue_stats = self.get_queue_stats()
+        if queue_stats is None:
             self.try_spawn_one(group)
+            return
+
+        vmd_list = self.vmm.get_all_vm_in_group(group)
+        ready_list = [vmd for vmd in vmd_list if vmd.state == VmStates.READY]
+        snapshot = {
+            "group": group,
+            "queue_stats": queue_stats,
+            "ready": len(ready_list),
+            "in_use": len([vmd for vmd in vmd_list if vmd.state == VmStates.IN_USE]),
+            "starting": len([vmd for vmd in vmd_list
+                             if vmd.state in [VmStates.GOT_IP, VmStates.CHECK_HEALTH]]),
+            "unavailable": len([vmd for vmd in vmd_list
+                                if vmd.state not in [VmStates.READY, VmStates.IN_USE, VmStates.GOT_IP,
+                                                     VmStates.CHECK_HEALTH, VmStates.TERMINATING]]),
+            "spawning": self.spawner.get_proc_num_per_group(group),
+        }
+        # recorded snapshots can be replayed by Autoscaler.replay
+        self.log.debug("autoscale snapshot: {}".format(json.dumps(snapshot)))
+        decision = Autoscaler(self.opts.build_groups[group]).decide(snapshot)
+
+        if decision.spawn:
+            try:
+                self._check_elapsed_time_after_spawn(group)
+                self._check_total_vm_limit(group)
+            except VmSpawnLimitReached as err:
+                self.log.debug(err.msg)
+            else:
+                self.log.info("Start spawning {} new VMs for group: {}"
+                              .format(decision.spawn, self.opts.build_groups[group]["name"]))
+                self.vmm.write_vm_pool_info(group, "last_vm_spawn_start", time.time())
+                for _ in range(decision.spawn):
+                    try:
+                        self.spawner.start_spawn(group)
+                    except Exception as error:
+                        self.log.exception("Error during spawn attempt: {}".format(error))
+                        break
+
+        # clean VMs first, then those left by the longest gone user
+        ready_list.sort(key=lambda vmd: (getattr(vmd, "bound_to_user", None) is not None,
+                                         float(getattr(vmd, "last_release", None) or 0)))
+        for vmd in ready_list[:decision.terminate]:
+            self.log.info("Terminating surplus idle VM {}".format(vmd.vm_name))
+            self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.READY)
+
+    def get_next_check_time(self, vmd):
+        """
+        :return: unixtime when the VM needs to be looked at again,
+            state changes schedule the VM immediately regardless
+        """
+        bg = self.opts.build_groups[vmd.group]
+        now = time.time()
+        last_health_check = float(getattr(vmd, "last_health_check", None) or 0)
+        health_check_due = last_health_check + bg["vm_health_check_period"]
+
+        if vmd.state == VmStates.READY:
+            last_release = getattr(vmd, "last_release", None)
+            if getattr(vmd, "bound_to_user", None) is not None and last_release is not None:
+                return min(health_check_due, float(last_release) + bg["vm_dirty_terminating_timeout"])
+            return health_check_due
+        elif vmd.state == VmStates.IN_USE:
+            lease_expires = self.get_lease_expiration(vmd)
+            if lease_expires is None:
+                return min(health_check_due, now + self.opts.vm_cycle_timeout)
+            return min(health_check_due, max(lease_expires, now + self.opts.vm_cycle_timeout))
+        elif vmd.state in [VmStates.GOT_IP, VmStates.CHECK_HEALTH_FAILED]:
+            return health_check_due
+        elif vmd.state == VmStates.CHECK_HEALTH:
+            return last_health_check + bg["vm_health_check_max_time"]
+        elif vmd.state == VmStates.TERMINATING:
+            terminating_since = float(getattr(vmd, "terminating_since", None) or 0)
+            return terminating_since + bg["vm_terminating_timeout"]
+        return now + self.opts.vm_cycle_timeout
+
+    def check_one_vm(self, vmd):
+        """
+        Run checks relevant to the current VM state
+        """
+        if vmd.state == VmStates.READY:
+            self.check_one_dirty_vm(vmd)
+            self.check_one_vm_health(vmd)
+        elif vmd.state == VmStates.IN_USE:
+            self.check_one_vm_for_dead_builder(vmd)
+            self.check_one_vm_health(vmd)
+        elif vmd.state in [VmStates.GOT_IP, VmStates.CHECK_HEALTH_FAILED]:
+            self.check_one_vm_health(vmd)
+        elif vmd.state == VmStates.CHECK_HEALTH:
+            self.finalize_one_long_health_check(vmd)
+        elif vmd.state == VmStates.TERMINATING:
+            self.terminate_one_again(vmd)
+
+    def check_due_vms(self):
+        """
+        Look only at VMs which are due according to the schedule and plan their next check
+        """
+        vm_names = self.vmm.pop_due_vms(time.time())
+        if not vm_names:
+            return
+
+        for vmd in self.vmm.get_vm_list_by_name(vm_names):
+            try:
+                self.check_one_vm(vmd)
+            except Exception as err:
+                self.log.exception("Failed to check VM {}: {}".format(vmd.vm_name, err))
+
+        # checks could change the VMs, removed ones are not loaded anymore
+        self.vmm.schedule_vms({
+            vmd.vm_name: self.get_next_check_time(vmd)
+            for vmd in self.vmm.get_vm_list_by_name(vm_names)
+        })
+
+    def get_sleep_time(self):
+        """
+        Sleep until the next VM is due, spawning is checked at least every `vm_cycle_timeout`
+        """
+        next_due = self.vmm.get_next_vm_due()
+        if next_due is None:
+            return self.opts.vm_cycle_timeout
+        return max(0, min(next_due - time.time(), self.opts.vm_cycle_timeout))
 
     def do_cycle(self):
         self.log.debug("starting do_cycle")
 
-        # TODO: each check should be executed in threads ... and finish with join?
-
-        self.remove_old_dirty_vms()
-        self.check_vms_health()
+        self.check_due_vms()
+        self.checker.start_pending_checks()
         self.start_spawn_if_required()
 
-        self.remove_vm_with_dead_builder()
-        self.finalize_long_health_checks()
-        self.terminate_again()
-
         self.spawner.recycle()
 
         # todo: self.terminate_excessive_vms() -- for case when config changed during runtime
@@ -249,7 +354,7 @@ class VmMaster(Process):
 
         self.log.info("VM master process started")
         while not self.kill_received:
-            time.sleep(self.opts.vm_cycle_timeout)
+            time.sleep(self.get_sleep_time())
             try:
                 self.do_cycle()
             except Exception as err:
@@ -262,37 +367,22 @@ class VmMaster(Process):
         if self.checker is not None:
             self.checker.terminate()
 
-    def finalize_long_health_checks(self):
-        """
-        After server crash it's possible that some VM's will remain in `check_health` state
-        Here we are looking for such records and mark them with `check_health_failed` state
-        """
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.CHECK_HEALTH]):
-
-            time_elapsed = time.time() - float(vmd.get_field(self.vmm.rc, "last_health_check") or 0)
-            if time_elapsed > self.opts.build_groups[vmd.group]["vm_health_check_max_time"]:
-                self.log.info("VM marked with check fail state, "
-                              "VM stayed too long in health check state, elapsed: {} VM: {}"
-                              .format(time_elapsed, str(vmd)))
-                self.vmm.mark_vm_check_failed(vmd.vm_name)
-
-    def terminate_again(self):
-        """
-        If we failed to terminate instance request termination once more.
-        Non-terminated instance detected as vm in the `terminating` state with
-            time.time() - `terminating since` > Threshold
-        It's possible, that VM was terminated but termination process doesn't receive confirmation from VM provider,
-        but we have already got a new VM with the same IP => it's safe to remove old vm from pool
-        """
-
-        for vmd in self.vmm.get_vm_by_group_and_state_list(None, [VmStates.TERMINATING]):
-            time_elapsed = time.time() - float(vmd.get_field(self.vmm.rc, "terminating_since") or 0)
-            if time_elapsed > self.opts.build_groups[vmd.group]["vm_terminating_timeout"]:
-                if len(self.vmm.lookup_vms_by_ip(vmd.vm_ip)) > 1:
-                    self.log.info(
-                        "Removing VM record: {}. There are more VM with the same ip, "
-                        "it's safe to remove current one from VM pool".format(vmd.vm_name))
-                    self.vmm.remove_vm_from_pool(vmd.vm_name)
-                else:
-                    self.log.info("Sent VM {} for termination again".format(vmd.vm_name))
-                    self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.TERMINATING)
+    def finalize_one_long_health_check(self, vmd):
+        time_elapsed = time.time() - float(getattr(vmd, "last_health_check", None) or 0)
+        if time_elapsed > self.opts.build_groups[vmd.group]["vm_health_check_max_time"]:
+            self.log.info("VM marked with check fail state, "
+                          "VM stayed too long in health check state, elapsed: {} VM: {}"
+                          .format(time_elapsed, str(vmd)))
+            self.vmm.mark_vm_check_failed(vmd.vm_name)
+
+    def terminate_one_again(self, vmd):
+        time_elapsed = time.time() - float(getattr(vmd, "terminating_since", None) or 0)
+        if time_elapsed > self.opts.build_groups[vmd.group]["vm_terminating_timeout"]:
+            if len(self.vmm.lookup_vms_by_ip(vmd.vm_ip)) > 1:
+                self.log.info(
+                    "Removing VM record: {}. There are more VM with the same ip, "
+                    "it's safe to remove current one from VM pool".format(vmd.vm_name))
+                self.vmm.remove_vm_from_pool(vmd.vm_name)
+            else:
+                self.log.info("Sent VM {} for termination again".format(vmd.vm_name))
+                self.vmm.start_vm_termination(vmd.vm_name, allowed_pre_state=VmStates.TERMINATING)
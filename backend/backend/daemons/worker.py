@@ -5,14 +5,21 @@ import time
 import gzip
 import shutil
 import multiprocessing
+from six.moves.queue import Empty
+from threading import Thread, Event
 from setproctitle import setproctitle
+from redis import RedisError
 
 from ..exceptions import MockRemoteError, CoprWorkerError, VmError, NoVmAvailable
 from ..job import BuildJob
 from ..mockremote import MockRemote
 from ..constants import BuildStatus, build_log_format
+from ..frontend import FrontendClient
 from ..helpers import register_build_result, get_redis_connection, get_redis_logger, \
     local_file_logger
+from ..journal import JobJournal
+from ..vm_manage import VmStates
+from ..vm_manage.manager import VmManager
 
 
 # ansible_playbook = "ansible-playbook"
@@ -24,18 +31,63 @@ except ImportError:
     fedmsg = None
 
 
+class VmLeaseRenewer(Thread):
+    """
+    Renews the lease of the VM acquired for a task every third of
+    `vm_lease_timeout` until stopped. VmMaster terminates the VM when
+    the renewals stop, e.g. after the worker died.
+    """
+
+    def __init__(self, opts, vm_manager, vm_name, task_id, log):
+        super(VmLeaseRenewer, self).__init__(name="lease-{}".format(vm_name))
+        self.daemon = True
+        self.period = opts.vm_lease_timeout / 3.0
+        self.vm_manager = vm_manager
+        self.vm_name = vm_name
+        self.task_id = task_id
+        self.log = log
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self.period):
+            try:
+                if not self.vm_manager.renew_vm_lease(self.vm_name, self.task_id):
+                    self.log.warning("VM {} is not used by task {} anymore, lease lost"
+                                     .format(self.vm_name, self.task_id))
+                    return
+            except RedisError as error:
+                self.log.exception("Failed to renew lease of VM {}: {}".format(self.vm_name, error))
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
 class Worker(multiprocessing.Process):
-    def __init__(self, opts, frontend_client, vm_manager, worker_id, vm, job):
+    """
+    Long-lived build process of one build group. Takes build tasks
+    (dicts with "job" and acquired "vm") from its `job_queue`, runs them
+    one after another and reports every finished one to `result_queue`.
+    Connections to redis and frontend are reused for all the builds.
+    """
+
+    def __init__(self, opts, worker_id, group_id, job_queue, result_queue):
         multiprocessing.Process.__init__(self, name="worker-{}".format(worker_id))
 
         self.opts = opts
-        self.frontend_client = frontend_client
-        self.vm_manager = vm_manager
         self.worker_id = worker_id
-        self.vm = vm
-        self.job = job
+        self.group_id = group_id
+        self.job_queue = job_queue
+        self.result_queue = result_queue
+        self.vm = None
+        self.vm_released = False
+        self.lease_renewer = None
+        self.job = None
 
         self.log = get_redis_logger(self.opts, self.name, "worker")
+        self.frontend_client = FrontendClient(self.opts, self.log)
+        self.vm_manager = VmManager(self.opts, logger=self.log)
+        self.journal = JobJournal(self.opts)
 
     @property
     def name(self):
@@ -44,11 +96,9 @@ class Worker(multiprocessing.Process):
     @property
     def group_name(self):
         try:
-            return self.opts.build_groups[self.vm.group]["name"]
-        except Exception as error:
-            self.log.exception("Failed to get builder group name from config, using group_id as name."
-                               "Original error: {}".format(error))
-            return str(self.vm.group)
+            return self.opts.build_groups[self.group_id]["name"]
+        except Exception:
+            return str(self.group_id)
 
     def fedmsg_notify(self, topic, template, content=None):
         """
@@ -177,14 +227,37 @@ class Worker(multiprocessing.Process):
     #     job.status = BuildStatus.SKIPPED
     #     self._announce_end(job)
 
-    def do_job(self, job):
+    def record_job(self, job):
+        """
+        Note the job into the journal, builds which are not there are
+        rescheduled after a backend restart.
+        """
+        try:
+            self.journal.record(job, self.vm)
+        except (IOError, OSError) as error:
+            self.log.exception("Failed to record job {} into the journal: {}".format(job.task_id, error))
+
+    def on_build_started(self, build_state):
+        try:
+            self.journal.update(self.job.task_id, build_state=build_state)
+        except (IOError, OSError) as error:
+            self.log.exception("Failed to record build state of job {}: {}".format(self.job.task_id, error))
+
+    def do_job(self, job, resume_from=None):
         """
         Executes new job.
 
         :param job: :py:class:`~backend.job.BuildJob`
+        :param dict resume_from: journal entry of the job interrupted by
+            backend restart, its build is reattached
         """
-
-        self._announce_start(job)
+        if resume_from:
+            # frontend knows about the running build already
+            job.started_on = resume_from["started_on"]
+            self.log.info("Resuming job {} on {}".format(job.task_id, self.vm.vm_ip))
+        else:
+            self._announce_start(job)
+            self.record_job(job)
         self.update_process_title(suffix="Task: {} chroot: {} build started"
                                   .format(job.build_id, job.chroot))
         status = BuildStatus.SUCCEEDED
@@ -221,11 +294,14 @@ class Worker(multiprocessing.Process):
                         builder_host=self.vm.vm_ip,
                         job=job,
                         logger=build_logger,
-                        opts=self.opts
+                        opts=self.opts,
+                        release_vm=self.release_vm,
+                        build_started=self.on_build_started,
                     )
                     mr.check()
 
-                    build_details = mr.build_pkg_and_process_results()
+                    build_details = mr.build_pkg_and_process_results(
+                        resume_from=resume_from["build_state"] if resume_from else None)
                     job.update(build_details)
 
                     if self.opts.do_sign:
@@ -302,19 +378,185 @@ class Worker(multiprocessing.Process):
 
     def update_process_title(self, suffix=None):
         title = "Worker-{}-{} ".format(self.worker_id, self.group_name)
-        title += "vm.vm_ip={} ".format(self.vm.vm_ip)
-        title += "vm.vm_name={} ".format(self.vm.vm_name)
+        if self.vm:
+            title += "vm.vm_ip={} ".format(self.vm.vm_ip)
+            title += "vm.vm_name={} ".format(self.vm.vm_name)
         if suffix:
             title += str(suffix)
         setproctitle(title)
 
-    def run(self):
-        self.log.info("Starting worker")
-        self.init_fedmsg()
+    def release_vm(self, terminate=False):
+        """
+        Return the VM of the current task into the pool, only once per task.
+
+        :param bool terminate: the build may still run there, terminate
+            the VM instead
+        """
+        if self.vm is None or self.vm_released:
+            return
+        if self.lease_renewer is not None:
+            self.lease_renewer.stop()
+            self.lease_renewer = None
+        if terminate:
+            self.log.warning("Build may still run on VM {}, terminating it".format(self.vm.vm_name))
+            self.vm_manager.start_vm_termination(self.vm.vm_name, allowed_pre_state=VmStates.IN_USE)
+        else:
+            self.vm_manager.release_vm(self.vm.vm_name)
+        self.vm_released = True
+
+    def run_task(self, task):
+        """
+        Build one task, the acquired VM is always released afterwards.
 
+        :return: report for the dispatcher with timestamps of the dispatch phases
+        """
+        self.job = task["job"]
+        self.vm = task["vm"]
+        self.vm_released = False
+        report = {
+            "worker_id": self.worker_id,
+            "task_id": self.job.task_id,
+            "loaded_on": task.get("loaded_on"),
+            "dispatched_on": task.get("dispatched_on"),
+            "picked_on": time.time(),
+        }
+
+        self.lease_renewer = VmLeaseRenewer(self.opts, self.vm_manager, self.vm.vm_name,
+                                            self.job.task_id, self.log)
+        self.lease_renewer.start()
         try:
-            self.do_job(self.job)
+            self.do_job(self.job, task.get("resume_from"))
         except VmError as error:
             self.log.exception("Building error: {}".format(error))
+        except Exception as error:
+            self.log.exception("Unexpected error in job {}: {}".format(self.job.task_id, error))
         finally:
-            self.vm_manager.release_vm(self.vm.vm_name)
+            # not released by MockRemote after an unexpected error, the
+            # detached build may be still running
+            entry = self.journal.get(self.job.task_id)
+            self.release_vm(terminate=bool(entry and entry.get("build_state")))
+            self.journal.remove(self.job.task_id)
+
+        report["started_on"] = self.job.started_on
+        report["ended_on"] = time.time()
+        self.job = None
+        self.vm = None
+        return report
+
+    def run(self):
+        self.log.info("Starting worker")
+        self.init_fedmsg()
+
+        while True:
+            self.update_process_title(suffix="idle")
+            task = self.job_queue.get()
+            if task is None:
+                break
+            self.result_queue.put(self.run_task(task))
+
+        self.log.info("Worker stopped")
+
+
+class WorkerPool(object):
+    """
+    Fixed set of workers for every build group, `groupX_max_workers` each.
+    Dispatcher hands a task to an idle worker of the VM group, the worker
+    is busy until its report arrives through `collect_finished`.
+    """
+
+    def __init__(self, opts, log, worker_cls=Worker):
+        self.opts = opts
+        self.log = log
+        self.worker_cls = worker_cls
+        self.result_queue = multiprocessing.Queue()
+
+        # worker_id -> Worker
+        self.workers = {}
+        # worker_id -> task running there
+        self.busy = {}
+
+    def start_worker(self, worker_id, group_id):
+        worker = self.worker_cls(
+            opts=self.opts,
+            worker_id=worker_id,
+            group_id=group_id,
+            job_queue=multiprocessing.Queue(),
+            result_queue=self.result_queue,
+        )
+        self.workers[worker_id] = worker
+        worker.start()
+        return worker
+
+    def start(self):
+        worker_id = 1
+        for group in self.opts.build_groups:
+            for _ in range(group["max_workers"]):
+                self.start_worker(worker_id, group["id"])
+                worker_id += 1
+        self.log.info("Started {} workers".format(len(self.workers)))
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.job_queue.put(None)
+        for worker in self.workers.values():
+            worker.join(5)
+
+    def idle_workers(self, group_id):
+        return [worker for worker_id, worker in sorted(self.workers.items())
+                if worker.group_id == group_id and worker_id not in self.busy]
+
+    def idle_count(self, group_id):
+        return len(self.idle_workers(group_id))
+
+    def submit(self, job, vm, loaded_on=None, resume_from=None):
+        """
+        Pass the job with acquired VM to an idle worker of the VM group.
+
+        :param dict resume_from: journal entry of the job to be reattached
+
+        :return: chosen Worker or None when all workers of the group are busy
+        """
+        idle = self.idle_workers(vm.group)
+        if not idle:
+            return None
+
+        worker = idle[0]
+        task = {"job": job, "vm": vm, "loaded_on": loaded_on, "dispatched_on": time.time(),
+                "resume_from": resume_from}
+        self.busy[worker.worker_id] = task
+        worker.job_queue.put(task)
+        return worker
+
+    def collect_finished(self):
+        """
+        Mark workers which reported a finished job as idle again.
+
+        :return: list of job reports
+        """
+        reports = []
+        while True:
+            try:
+                report = self.result_queue.get_nowait()
+            except Empty:
+                return reports
+            self.busy.pop(report["worker_id"], None)
+            reports.append(report)
+
+    def replace_dead_workers(self):
+        """
+        Start a new worker instead of each one which died.
+
+        :return: list of tasks which were being built by the dead workers
+        """
+        lost_tasks = []
+        for worker_id, worker in list(self.workers.items()):
+            if worker.is_alive():
+                continue
+            self.log.error("Worker {} died with exit code {}, starting a new one"
+                           .format(worker_id, worker.exitcode))
+            worker.join(5)
+            task = self.busy.pop(worker_id, None)
+            if task:
+                lost_tasks.append(task)
+            self.start_worker(worker_id, worker.group_id)
+        return lost_tasks
@@ -47,6 +47,10 @@ class BuilderTimeOutError(BuilderError):
     pass
 
 
+class BuildCanceledError(BuilderError):
+    pass
+
+
 class CoprSignError(MockRemoteError):
     """
     Related to invocation of /bin/sign
@@ -170,5 +174,9 @@ class CreateRepoError(CmdError):
     pass
 
 
+class RpmHeaderError(CoprBackendError):
+    pass
+
+
 class DispatchBuildError(CoprBackendError):
     pass
@@ -70,10 +70,41 @@ class FrontendClient(object):
             raise RequestException("Bad respond from the frontend")
         return response.json()["can_start"]
 
+    def lease_builds(self, count, capacity=None):
+        """
+        Lease up to `count` build tasks from the frontend queue at once.
+        Leased tasks are already in the starting state, leases which can not be
+        used should be returned by :py:meth:`defer_build`.
+
+        :param capacity: optional list of build groups able to start a build now,
+            dicts with "archs", "count", "max_per_owner" and "owners_in_use" keys,
+            frontend leases only tasks fitting in
+
+        Return: list of build task dicts
+        """
+        data = {"count": count}
+        if capacity is not None:
+            data["capacity"] = capacity
+        response = self._post_to_frontend(data, "lease_builds")
+        if "builds" not in response.json():
+            raise RequestException("Bad respond from the frontend")
+        return response.json()["builds"]
+
+    def get_queue_stats(self):
+        """
+        Return: dict arch -> {"pending", "running", "avg_duration"} describing
+                the build queue on frontend
+        """
+        response = self._post_to_frontend({}, "queue_stats")
+        if "archs" not in response.json():
+            raise RequestException("Bad respond from the frontend")
+        return response.json()["archs"]
+
     def defer_build(self, build_id, chroot_name):
         """
         Tell the frontend that the build task should be deferred
         (put aside for some time until there are resources for it).
+        Leased build task is returned back to the queue.
         """
         was_deferred = False
         data = {"build_id": build_id, "chroot": chroot_name}
@@ -94,7 +125,13 @@ class FrontendClient(object):
         data = {"build_id": build_id, "chroot": chroot_name}
         self._post_to_frontend_repeatedly(data, "reschedule_build_chroot")
 
-    def reschedule_all_running(self, attempts):
-        response = self._post_to_frontend_repeatedly({}, "reschedule_all_running", attempts)
+    def reschedule_all_running(self, attempts, keep=None):
+        """
+        Return all the starting and running builds to the queue.
+
+        :param keep: list of {"build_id", "chroot"} dicts of builds left untouched
+        """
+        data = {"keep": keep or []}
+        response = self._post_to_frontend_repeatedly(data, "reschedule_all_running", attempts)
         if response.status_code != 200:
             raise RequestException("Failed to reschedule all running jobs")
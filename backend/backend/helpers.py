@@ -22,9 +22,12 @@ import pytz
 
 from munch import Munch
 from redis import StrictRedis
+from redis.exceptions import RedisError
 from . import constants
 
 from copr.client import CoprClient
+from copr.exceptions import CoprException
+from requests import RequestException
 from backend.constants import DEF_BUILD_USER, DEF_BUILD_TIMEOUT, DEF_CONSECUTIVE_FAILURE_THRESHOLD, \
     CONSECUTIVE_FAILURE_REDIS_KEY, default_log_format
 from backend.exceptions import CoprBackendError
@@ -129,6 +132,9 @@ class BackendConfigReader(object):
         opts.dist_git_url = _get_conf(
             cp, "backend", "dist_git_url", "http://dist-git")
 
+        opts.dist_git_fetch = _get_conf(
+            cp, "backend", "dist_git_fetch", "shallow")
+
         opts.frontend_auth = _get_conf(
             cp, "backend", "frontend_auth", "PASSWORDHERE")
 
@@ -141,12 +147,21 @@ class BackendConfigReader(object):
         opts.redis_db = _get_conf(
             cp, "backend", "redis_db", "0")
 
+        opts.frontend_redis_host = _get_conf(
+            cp, "backend", "frontend_redis_host", None)
+
+        opts.frontend_redis_port = _get_conf(
+            cp, "backend", "frontend_redis_port", "6379")
+
         opts.do_sign = _get_conf(
             cp, "backend", "do_sign", False, mode="bool")
 
         opts.keygen_host = _get_conf(
             cp, "backend", "keygen_host", "copr-keygen.cloud.fedoraproject.org")
 
+        opts.sign_max_workers = _get_conf(
+            cp, "backend", "sign_max_workers", 4, mode="int")
+
         opts.build_user = _get_conf(
             cp, "backend", "build_user", DEF_BUILD_USER)
 
@@ -202,18 +217,42 @@ class BackendConfigReader(object):
                 "vm_terminating_timeout": _get_conf(
                     cp, "backend", "group{}_vm_terminating_timeout".format(group_id),
                     default=600, mode="int"),
+                "autoscale": _get_conf(
+                    cp, "backend", "group{}_autoscale".format(group_id),
+                    default=False, mode="bool"),
+                "min_vm_ready": _get_conf(
+                    cp, "backend", "group{}_min_vm_ready".format(group_id),
+                    default=1, mode="int"),
+                "max_vm_in_ready_state": _get_conf(
+                    cp, "backend", "group{}_max_vm_in_ready_state".format(group_id),
+                    default=2, mode="int"),
+                "vm_spawn_time": _get_conf(
+                    cp, "backend", "group{}_vm_spawn_time".format(group_id),
+                    default=300, mode="int"),
             }
             opts.build_groups.append(group)
 
         opts.vm_cycle_timeout = _get_conf(
             cp, "backend", "vm_cycle_timeout",
             default=10, mode="int")
+        opts.vm_lease_timeout = _get_conf(
+            cp, "backend", "vm_lease_timeout",
+            default=120, mode="int")
         opts.vm_ssh_check_timeout = _get_conf(
             cp, "backend", "vm_ssh_check_timeout",
             default=5, mode="int")
+        opts.vm_health_check_forks = _get_conf(
+            cp, "backend", "vm_health_check_forks",
+            default=20, mode="int")
 
         opts.destdir = _get_conf(cp, "backend", "destdir", None, mode="path")
 
+        opts.job_journal_dir = _get_conf(
+            cp, "backend", "job_journal_dir", "/var/lib/copr/jobs/", mode="path")
+
+        opts.createrepo_state_dir = _get_conf(
+            cp, "backend", "createrepo_state_dir", "/var/lib/copr/createrepo/", mode="path")
+
         opts.exit_on_worker = _get_conf(
             cp, "backend", "exit_on_worker", False, mode="bool")
         opts.fedmsg_enabled = _get_conf(
@@ -234,11 +273,15 @@ class BackendConfigReader(object):
 
         opts.prune_days = _get_conf(cp, "backend", "prune_days", None, mode="int")
 
+        opts.project_flags_ttl = _get_conf(
+            cp, "backend", "project_flags_ttl", 3600, mode="int")
+
         # ssh options
         opts.ssh = Munch()
-        # TODO: ansible Runner show some magic bugs with transport "ssh", using paramiko
+        # build output streaming, reattaching to builds and connection
+        # multiplexing need "ssh", with "paramiko" builds are polled
         opts.ssh.transport = _get_conf(
-            cp, "ssh", "transport", "paramiko")
+            cp, "ssh", "transport", "ssh")
 
         # thoughts for later
         # ssh key for connecting to builders?
@@ -267,6 +310,65 @@ def get_persistent_status(front_url, username, projectname):
         return True
 
 
+PROJECT_FLAGS = ["auto_createrepo", "persistent"]
+
+
+def get_project_flags(front_url, username, projectname):
+    """
+    :return: dict with PROJECT_FLAGS of the project, fetched from frontend
+    """
+    client = CoprClient(copr_url=front_url)
+    detail = client.get_project_details(projectname, username).data["detail"]
+    return {flag: bool(detail.get(flag, True)) for flag in PROJECT_FLAGS}
+
+
+class ProjectFlagsCache(object):
+    """
+    Project flags shared by backend processes in redis. Builds and actions
+    carry the current values from frontend, which is asked only when the
+    cached entry is older than `opts.project_flags_ttl`. When frontend is
+    unavailable then, the old value is used.
+    """
+    KEY = "copr:backend:project_flags::{}/{}"
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.rc = get_redis_connection(opts)
+
+    def update(self, username, projectname, **flags):
+        """
+        Store flags received in a task payload, None values are ignored.
+        """
+        mapping = {flag: int(bool(value)) for flag, value in flags.items()
+                   if flag in PROJECT_FLAGS and value is not None}
+        if not mapping:
+            return
+        mapping["updated_on"] = time.time()
+        self.rc.hmset(self.KEY.format(username, projectname), mapping)
+
+    def invalidate(self, username, projectname):
+        self.rc.delete(self.KEY.format(username, projectname))
+
+    def get(self, username, projectname, flag):
+        """
+        :raises CoprException: flag isn't cached and frontend is unavailable
+        """
+        entry = self.rc.hgetall(self.KEY.format(username, projectname))
+        age = time.time() - float(entry.get("updated_on", 0))
+        if flag in entry and age < self.opts.project_flags_ttl:
+            return entry[flag] == "1"
+
+        try:
+            flags = get_project_flags(self.opts.frontend_base_url, username, projectname)
+        except (CoprException, RequestException):
+            if flag in entry:
+                return entry[flag] == "1"
+            raise
+
+        self.update(username, projectname, **flags)
+        return flags[flag]
+
+
 # def log(lf, msg, quiet=None):
 #     if lf:
 #         now = datetime.datetime.utcnow().isoformat()
@@ -320,6 +422,74 @@ def get_redis_connection(opts):
     return StrictRedis(**kwargs)
 
 
+class NewWorkListener(object):
+    """
+    Waits for announcements of new tasks which frontend publishes to its redis.
+
+    When `frontend_redis_host` is not configured or the redis is unreachable,
+    waiting degrades to a plain sleep and the caller keeps polling.
+
+    :param opts: backend config
+    :param kind: kind of the awaited work, "build" or "action"
+    """
+
+    def __init__(self, opts, kind, log=None):
+        self.opts = opts
+        self.kind = kind
+        self.log = log
+        self.pubsub = None
+
+    @property
+    def enabled(self):
+        return bool(getattr(self.opts, "frontend_redis_host", None))
+
+    def subscribe(self):
+        if self.pubsub is not None:
+            return
+        rc = StrictRedis(host=self.opts.frontend_redis_host,
+                         port=self.opts.frontend_redis_port,
+                         decode_responses=True)
+        pubsub = rc.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(constants.NEW_WORK_PUB_SUB)
+        self.pubsub = pubsub
+
+    def wait(self, timeout):
+        """
+        Block until new work is announced or `timeout` seconds pass.
+        Announcements queued in the meantime are consumed at once.
+
+        :return bool: True when woken up by an announcement
+        """
+        if not self.enabled:
+            time.sleep(timeout)
+            return False
+
+        deadline = time.time() + timeout
+        notified = False
+        try:
+            self.subscribe()
+            while True:
+                remaining = 0 if notified else deadline - time.time()
+                if remaining <= 0 and not notified:
+                    return False
+
+                msg = self.pubsub.get_message(timeout=remaining)
+                if msg is None:
+                    if notified:
+                        return True
+                    continue
+
+                if msg["type"] == "message" and msg["data"] == self.kind:
+                    notified = True
+
+        except RedisError as err:
+            if self.log:
+                self.log.warning("Listening for new work failed: {}".format(err))
+            self.pubsub = None
+            time.sleep(max(0, deadline - time.time()))
+            return notified
+
+
 def format_tb(ex, ex_traceback):
     tb_lines = traceback.format_exception(ex.__class__, ex, ex_traceback)
     return ''.join(tb_lines)
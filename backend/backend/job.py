@@ -57,6 +57,10 @@ class BuildJob(object):
         self.pkg_epoch = None
         self.pkg_release = None
 
+        # project flags, not sent by older frontends
+        self.auto_createrepo = None
+        self.persistent = None
+
 
         # TODO: validate update data, user marshmallow
         for key, val in task_data.items():
@@ -80,7 +84,7 @@ class BuildJob(object):
         ])
         self.results_repo_url = self.results
 
-        self.built_packages = ""
+        self.built_packages = []
 
     @property
     def chroot_repos_extended(self):
@@ -131,6 +135,14 @@ class BuildJob(object):
         result["mockchain_macros"] = self.mockchain_macros
         return result
 
+    def to_task_dict(self):
+        """
+        :return dict: task data the same job can be created from again
+        """
+        result = copy.deepcopy(self.__dict__)
+        result["repos"] = " ".join(self.repos)
+        return result
+
     @property
     def mockchain_macros(self):
         return {
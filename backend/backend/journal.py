@@ -0,0 +1,90 @@
+# coding: utf-8
+
+import json
+import os
+import tempfile
+import time
+
+
+class JobJournal(object):
+    """
+    Durable local record of the build jobs owned by this backend, one JSON
+    file per task in `job_journal_dir`. The entry is written when a worker
+    takes the job and removed when the job is finished, so the entries found
+    on backend start belong to builds interrupted by the restart.
+
+    Entry keys:
+        - "task": task data of the job, see :py:meth:`BuildJob.to_task_dict`
+        - "vm_name", "vm_ip": VM the job was acquired
+        - "started_on": unixtime when the build started
+        - "build_state": set once the build runs detached from the backend
+          and can be reattached, see :py:meth:`Builder.start_detached_build`
+    """
+
+    def __init__(self, opts):
+        self.path = opts.job_journal_dir
+
+    def _entry_path(self, task_id):
+        return os.path.join(self.path, "{}.json".format(task_id))
+
+    def _write(self, task_id, entry):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # an entry is either the old or the new one even after a crash
+        handle, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        with os.fdopen(handle, "w") as tmp_file:
+            json.dump(entry, tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.rename(tmp_path, self._entry_path(task_id))
+
+    def record(self, job, vm):
+        """
+        Remember that the job is being built on the VM
+        """
+        self._write(job.task_id, {
+            "task": job.to_task_dict(),
+            "vm_name": vm.vm_name,
+            "vm_ip": vm.vm_ip,
+            "started_on": job.started_on or time.time(),
+            "build_state": None,
+        })
+
+    def get(self, task_id):
+        """
+        :return: entry of the task or None
+        """
+        try:
+            with open(self._entry_path(task_id)) as handle:
+                return json.load(handle)
+        except (IOError, ValueError):
+            return None
+
+    def update(self, task_id, **fields):
+        entry = self.get(task_id)
+        if entry is None:
+            return
+        entry.update(fields)
+        self._write(task_id, entry)
+
+    def remove(self, task_id):
+        try:
+            os.unlink(self._entry_path(task_id))
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        :return: list of all the entries, ordered by the build start
+        """
+        if not os.path.isdir(self.path):
+            return []
+
+        result = []
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                entry = self.get(name[:-len(".json")])
+                if entry is not None:
+                    result.append(entry)
+        result.sort(key=lambda entry: entry["started_on"])
+        return result
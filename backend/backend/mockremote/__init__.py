@@ -41,12 +41,14 @@ import time
 
 from ..constants import DEF_REMOTE_BASEDIR, DEF_BUILD_TIMEOUT, DEF_REPOS, \
     DEF_BUILD_USER, DEF_MACROS
-from ..exceptions import MockRemoteError, BuilderError, CreateRepoError
+from ..exceptions import MockRemoteError, BuilderError, CreateRepoError, RpmHeaderError
 
 
 # TODO: replace sign & createrepo with dependency injection
 from ..sign import sign_rpms_in_dir, get_pubkey
-from ..createrepo import createrepo
+from ..createrepo import createrepo, get_state_dir
+from ..helpers import ProjectFlagsCache
+from ..rpmheader import collect_packages_info
 
 from .builder import Builder
 
@@ -80,7 +82,7 @@ class MockRemote(object):
     #   idea: send events according to the build progress to handler
 
     def __init__(self, builder_host, job, logger,
-                 repos=None, opts=None):
+                 repos=None, opts=None, release_vm=None, build_started=None):
 
         """
         :param builder_host: builder hostname or ip
@@ -97,6 +99,11 @@ class MockRemote(object):
 
 
         :param repos: additional repositories for mock
+        :param release_vm: callback returning the builder into the VM pool,
+            called as soon as the results are downloaded; with `terminate=True`
+            when the build could not be stopped and the VM can't be reused
+        :param build_started: callback getting the state of the build
+            detached on the builder, see :py:meth:`Builder.start_detached_build`
 
         :param macros: {    "copr_username": ...,
                             "copr_projectname": ...,
@@ -130,6 +137,7 @@ class MockRemote(object):
 
         self.log = logger
         self.job = job
+        self.release_vm = release_vm
 
         self.log.info("Setting up builder: {0}".format(builder_host))
         # TODO: add option "builder_log_level" to backend config
@@ -140,6 +148,7 @@ class MockRemote(object):
             hostname=builder_host,
             job=self.job,
             logger=logger,
+            build_started=build_started,
         )
 
         self.failed = []
@@ -155,7 +164,11 @@ class MockRemote(object):
         if not self.job.chroot:
             raise MockRemoteError("No chroot specified!")
 
-        self.builder.check()
+        try:
+            self.builder.check()
+        except Exception:
+            self.builder.close()
+            raise
 
     @property
     def chroot_dir(self):
@@ -229,6 +242,15 @@ class MockRemote(object):
                        .format(self.job.project_owner, self.job.project_name,
                                self.opts.frontend_base_url, self.chroot_dir, base_url))
 
+        auto_createrepo = self.job.auto_createrepo
+        if auto_createrepo is None:
+            # job from a frontend which doesn't send project flags
+            auto_createrepo = ProjectFlagsCache(self.opts).get(
+                self.job.project_owner, self.job.project_name, "auto_createrepo")
+
+        added = [os.path.join(self.job.target_dir_name, name)
+                 for name in os.listdir(os.path.join(self.chroot_dir, self.job.target_dir_name))
+                 if name.endswith(".rpm")]
         try:
             createrepo(
                 path=self.chroot_dir,
@@ -236,6 +258,9 @@ class MockRemote(object):
                 base_url=base_url,
                 username=self.job.project_owner,
                 projectname=self.job.project_name,
+                auto_createrepo=auto_createrepo,
+                added=added,
+                state_dir=get_state_dir(self.opts, self.chroot_dir),
             )
         except CreateRepoError:
             self.log.exception("Error making local repo: {}".format(self.chroot_dir))
@@ -280,8 +305,10 @@ class MockRemote(object):
     #     except Exception as err:
     #         self.log.exception(err)
 
-    def build_pkg_and_process_results(self):
+    def build_pkg_and_process_results(self, resume_from=None):
         """
+        :param dict resume_from: state of the build started before the backend
+            restart, the build is reattached instead of started again
         :return: dict with build_details
         :raises MockRemoteError: Something happened with build itself
         :raises VmError: Something happened with builder VM
@@ -292,25 +319,49 @@ class MockRemote(object):
         self.log.info("Start build: {}".format(self.job))
 
         try:
-            build_stdout = self.builder.build()
-            build_details = {"built_packages": self.builder.collect_built_packages()}
-
-            self.log.info("builder.build finished; details: {}\n stdout: {}"
-                          .format(build_details, build_stdout))
+            if resume_from:
+                build_stdout = self.builder.resume(resume_from)
+            else:
+                build_stdout = self.builder.build()
+            self.log.info("builder.build finished; stdout: {}".format(build_stdout))
         except BuilderError as error:
             self.log.exception("builder.build error building pkg `{}`: {}"
                                .format(self.job.package_name, error))
             raise MockRemoteError("Error occurred during build {}: {}"
                                   .format(self.job, error))
         finally:
-            self.builder.download_results(self.job.results_dir)
-            self.builder.download_configs(os.path.join(self.job.results_dir, "configs"))
+            # e.g. lost ssh connection or an unexpected error leave the build running
+            build_stopped = self.builder.stop_build()
+            try:
+                self.builder.download(self.job.results_dir)
+            finally:
+                self.builder.close()
+                # the rest of the processing doesn't need the VM
+                if self.release_vm is not None:
+                    self.release_vm(terminate=not build_stopped)
             # self.add_log_symlinks()  # todo: add config option, need this for nginx
+            self.log.info("Time spent in build steps: {}".format(self.builder.format_step_times()))
             self.log.info("End Build: {0}".format(self.job))
 
+        build_details = {"built_packages": self.collect_built_packages()}
+        self.log.info("Build details: {}".format(build_details))
+
         self.on_success_build()
         return build_details
 
+    def collect_built_packages(self):
+        """
+        Read metadata of the built binary packages from the downloaded rpms
+
+        :return: list of dicts, see :py:func:`backend.rpmheader.get_package_info`
+        """
+        try:
+            return collect_packages_info(self.job.results_dir)
+        except (RpmHeaderError, IOError, OSError) as error:
+            self.log.exception("Failed to read built packages: {}".format(error))
+            raise MockRemoteError("Failed to read built packages of {}: {}"
+                                  .format(self.job, error))
+
     def mark_dir_with_build_id(self):
         """
             Places "build.info" which contains job build_id
@@ -1,24 +1,48 @@
+from contextlib import contextmanager
+import hashlib
 import os
 import pipes
+import re
+import select
+import shutil
+import signal
 import socket
-from subprocess import Popen
+from subprocess import Popen, PIPE
+import tempfile
+from threading import Timer
 import time
 from urlparse import urlparse
 
 from ansible.runner import Runner
-from backend.vm_manage import PUBSUB_INTERRUPT_BUILDER
+from redis.exceptions import RedisError
+from backend.vm_manage import PUBSUB_INTERRUPT_BUILDER, INTERRUPT_BUILD_CANCELED, KEY_BUILD_CANCELED
 from ..helpers import get_redis_connection, ensure_dir_exists
 
-from ..exceptions import BuilderError, BuilderTimeOutError, AnsibleCallError, AnsibleResponseError, VmError
+from ..exceptions import BuilderError, BuilderTimeOutError, BuildCanceledError, AnsibleCallError, \
+    AnsibleResponseError, VmError
 
-from ..constants import mockchain, rsync, DEF_BUILD_TIMEOUT
+from ..constants import mockchain, rsync, DEF_BUILD_TIMEOUT, BUILD_LOG_PUB_SUB, RSYNC_SKIP_COMPRESS
 
 import modulemd
 
+# how many times the output of a detached build is followed again after
+# the ssh connection dropped, and the delay between the attempts
+ATTACH_RETRIES = 3
+ATTACH_RETRY_DELAY = 10
+
+# seconds to establish an ssh connection; a connection is considered dead
+# after SSH_ALIVE_COUNT keepalives sent every SSH_ALIVE_INTERVAL are not answered
+SSH_CONNECT_TIMEOUT = 60
+SSH_ALIVE_INTERVAL = 30
+SSH_ALIVE_COUNT = 4
+
+# seconds given to the processes of a stopped build to exit before they are killed
+KILL_BUILD_WAIT = 10
+
 
 class Builder(object):
 
-    def __init__(self, opts, hostname, job, logger):
+    def __init__(self, opts, hostname, job, logger, build_started=None):
 
         self.opts = opts
         self.hostname = hostname
@@ -34,6 +58,24 @@ class Builder(object):
         self.remote_pkg_path = None
         self.remote_pkg_name = None
 
+        self.live_log_rc = None
+        self.live_log_enabled = True
+
+        # subscription to PUBSUB_INTERRUPT_BUILDER during the build
+        self.ps = None
+        # the task was canceled before the subscription, see KEY_BUILD_CANCELED
+        self.canceled = False
+
+        # callback getting the build state, see :py:meth:`start_detached_build`
+        self.build_started = build_started
+        # the detached build may be running on the builder
+        self.build_running = False
+
+        # local directory with the ssh control sockets of this job
+        self.control_dir = None
+        # list of (step name, seconds spent)
+        self.step_times = []
+
         # if we're at this point we've connected and done stuff on the host
         self.conn = self._create_ans_conn()
         self.root_conn = self._create_ans_conn(username="root")
@@ -55,7 +97,8 @@ class Builder(object):
             return ("." + mmd.name + '+' + mmd.version + '+' + mmd.release)
 
     def get_chroot_config_path(self, chroot):
-        return "{tempdir}/{chroot}.cfg".format(tempdir=self.tempdir, chroot=chroot)
+        # outside of the job tempdir, so that it survives for the next job on the VM
+        return "{basedir}/mock-configs/{chroot}.cfg".format(basedir=self._remote_basedir, chroot=chroot)
 
     @property
     def remote_build_dir(self):
@@ -126,6 +169,9 @@ class Builder(object):
         :param bool as_root:
         :return: ansible command result
         """
+        if (module_name or "shell") == "shell" and self.opts.ssh.transport == "ssh":
+            return self._run_ssh(cmd, as_root)
+
         if as_root:
             conn = self.root_conn
         else:
@@ -148,21 +194,13 @@ class Builder(object):
     def _get_remote_config_dir(self):
         return os.path.normpath(os.path.join(self.remote_build_dir, "configs", self.job.chroot))
 
-    def setup_mock_chroot_config(self):
+    def render_mock_config(self):
         """
-        Setup mock config for current chroot.
+        Render the mock config of the job. It includes the config of the chroot
+        installed on the builder and sets the job specific options on top of it.
 
         Packages in buildroot_pkgs are added to minimal buildroot.
         """
-        cfg_path = self.get_chroot_config_path(self.job.chroot)
-
-        try:
-            copy_cmd = "cp /etc/mock/{chroot}.cfg {dest}".format(chroot=self.job.chroot, dest=cfg_path)
-            self.run_ansible_with_check(copy_cmd, module_name="shell")
-        except BuilderError as err:
-            self.log.exception(err)
-            raise err
-
         if ("'{0} '".format(self.buildroot_pkgs) !=
                 pipes.quote(str(self.buildroot_pkgs) + ' ')):
 
@@ -170,66 +208,81 @@ class Builder(object):
             # allowed in packages name
             raise BuilderError("Do not try this kind of attack on me")
 
-        self.log.info("putting {0} into minimal buildroot of {1}"
-                      .format(self.buildroot_pkgs, self.job.chroot))
-
-        kwargs = {
-            "cfg_path": cfg_path,
-            "chroot": self.job.chroot,
-            "pkgs": self.buildroot_pkgs,
-            "net_enabled": "True" if self.job.enable_net else "False",
-        }
-        buildroot_cmd = (
-            "dest={cfg_path}"
-            " line=\"config_opts['chroot_setup_cmd'] = 'install \\1 {pkgs}'\""
-            " regexp=\"^.*chroot_setup_cmd.*(@buildsys-build|buildsys-build buildsys-macros).*$\""
-            " backrefs=yes"
-        )
-        buildroot_custom_cmd = (
-            "dest={cfg_path}"
-            " line=\"config_opts['chroot_setup_cmd'] = 'install {pkgs}'\""
-            " regexp=\"config_opts\\['chroot_setup_cmd'\\] = ''$\""
-        )
-        set_networking_cmd = (
-            "dest={cfg_path}"
-            " line=\"config_opts['use_host_resolv'] = {net_enabled}\""
-            " regexp=\"^.*use_host_resolv.*$\""
-        )
+        lines = [
+            "include('/etc/mock/{0}.cfg')".format(self.job.chroot),
+            "config_opts['use_host_resolv'] = {0}".format("True" if self.job.enable_net else "False"),
+        ]
+
+        if self.buildroot_pkgs:
+            self.log.info("putting {0} into minimal buildroot of {1}"
+                          .format(self.buildroot_pkgs, self.job.chroot))
+            lines.extend([
+                "if config_opts.get('chroot_setup_cmd'):",
+                "    config_opts['chroot_setup_cmd'] += ' {0}'".format(self.buildroot_pkgs),
+                "else:",
+                "    config_opts['chroot_setup_cmd'] = 'install {0}'".format(self.buildroot_pkgs),
+            ])
+
+        if self.module_dist_tag:
+            lines.append("config_opts['macros']['%dist'] = {0}".format(repr(str(self.module_dist_tag))))
+
+        # Caches stay on the VM for the next builds of the chroot, see
+        # VmDescriptor.is_warm_for. Root cache is separated per buildroot
+        # setup and mock updates it before the build. Mockchain writes a new
+        # copy of the config for each build, so the age check would always
+        # invalidate the cache.
+        cache_dir = "/var/cache/mock/copr-{0}".format(self.job.chroot)
+        lines.extend([
+            "config_opts['plugin_conf']['root_cache_enable'] = True",
+            "config_opts['plugin_conf']['root_cache_opts']['dir'] = '{0}/root_cache-{1}/'"
+            .format(cache_dir, self.get_buildroot_hash()),
+            "config_opts['plugin_conf']['root_cache_opts']['age_check'] = False",
+            "config_opts['plugin_conf']['yum_cache_enable'] = True",
+            "config_opts['plugin_conf']['yum_cache_opts']['dir'] = '{0}/package_cache/'".format(cache_dir),
+            "config_opts['update_before_build'] = True",
+        ])
+
+        return "\n".join(lines) + "\n"
+
+    def get_buildroot_hash(self):
+        """
+        :return: short hash of the job options which define the buildroot content
+        """
+        buildroot = "\n".join([self.job.chroot, str(self.buildroot_pkgs)] +
+                               sorted(self.job.chroot_repos_extended))
+        return hashlib.sha256(buildroot.encode("utf-8")).hexdigest()[:12]
 
-        try:
-            self.run_ansible_with_check(set_networking_cmd.format(**kwargs),
-                                        module_name="lineinfile")
-            if self.buildroot_pkgs:
-                self.run_ansible_with_check(buildroot_cmd.format(**kwargs),
-                                            module_name="lineinfile")
-                self.run_ansible_with_check(buildroot_custom_cmd.format(**kwargs),
-                                            module_name="lineinfile")
-
-            if self.module_dist_tag:
-                set_dist_tag_cmd = (
-                    "dest={cfg_path}"
-                    " line=\"config_opts['macros']['%dist'] = '{dist_tag}'\""
-                    " regexp=\"^.*config_opts['macros']['%dist'].*$\""
-                )
-                self.run_ansible_with_check(set_dist_tag_cmd.format(
-                    cfg_path=cfg_path, dist_tag=self.module_dist_tag), module_name="lineinfile")
+    def setup_mock_chroot_config(self):
+        """
+        Setup mock config for current chroot.
 
-        except Exception as err:
-            self.log.exception(err)
-            raise
+        The config is rendered locally and pushed to the builder in one
+        command, together with its sha256. A VM reused for the next build
+        keeps the config, when the hash matches it is not written again.
+        """
+        content = self.render_mock_config()
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        cfg_path = self.get_chroot_config_path(self.job.chroot)
+        hash_path = cfg_path + ".sha256"
 
-    def collect_built_packages(self):
-        self.log.info("Listing built binary packages")
-        results = self._run_ansible(
-            "cd {0} && "
-            "for f in `ls *.rpm |grep -v \"src.rpm$\"`; do"
-            "   rpm -qp --qf \"%{{NAME}} %{{VERSION}}\n\" $f; "
-            "done".format(pipes.quote(self._get_remote_results_dir()))
-        )
+        push_cmd = (
+            "if [ \"$(cat {hash_path} 2>/dev/null)\" = {hash} ]; then echo unchanged; else "
+            "mkdir -p {cfg_dir} && printf %s {content} > {cfg_path} && "
+            "echo {hash} > {hash_path} && echo updated; fi"
+        ).format(hash_path=pipes.quote(hash_path), hash=content_hash,
+                 cfg_dir=pipes.quote(os.path.dirname(cfg_path)),
+                 content=pipes.quote(content), cfg_path=pipes.quote(cfg_path))
 
-        built_packages = list(results["contacted"].values())[0][u"stdout"]
-        self.log.info("Built packages:\n{}".format(built_packages))
-        return built_packages
+        try:
+            results = self.run_ansible_with_check(push_cmd, module_name="shell")
+        except BuilderError as err:
+            self.log.exception(err)
+            raise err
+
+        if get_ans_results(results, self.hostname).get("stdout") == "unchanged":
+            self.log.info("Mock config {0} is up to date".format(cfg_path))
+        else:
+            self.log.info("Mock config {0} updated".format(cfg_path))
 
     def check_build_success(self):
         successfile = os.path.join(self._get_remote_results_dir(), "success")
@@ -240,18 +293,21 @@ class Builder(object):
         repo_url = "{}/{}.git".format(self.opts.dist_git_url, self.job.git_repo)
         self.log.info("Cloning Dist Git repo {}, branch {}, hash {}".format(
             self.job.git_repo, self.job.git_branch, self.job.git_hash))
-        results = self._run_ansible(
-            "rm -rf /tmp/build_package_repo && "
-            "mkdir /tmp/build_package_repo && "
-            "cd /tmp/build_package_repo && "
-            "git clone {repo_url} && "
-            "cd {pkg_name} && "
-            "git checkout {git_hash} && "
-            "fedpkg-copr --dist {branch} srpm"
-            .format(repo_url=repo_url,
-                    pkg_name=self.job.package_name,
-                    git_hash=self.job.git_hash,
-                    branch=self.job.git_branch))
+        if self.opts.dist_git_fetch == "shallow":
+            results = self._run_ansible(self.gen_shallow_fetch_command(repo_url))
+        else:
+            results = self._run_ansible(
+                "rm -rf /tmp/build_package_repo && "
+                "mkdir /tmp/build_package_repo && "
+                "cd /tmp/build_package_repo && "
+                "git clone {repo_url} && "
+                "cd {pkg_name} && "
+                "git checkout {git_hash} && "
+                "fedpkg-copr --dist {branch} srpm"
+                .format(repo_url=repo_url,
+                        pkg_name=self.job.package_name,
+                        git_hash=self.job.git_hash,
+                        branch=self.job.git_branch))
 
         # expected output:
         # ...
@@ -266,6 +322,51 @@ class Builder(object):
 
         self.log.info("Got srpm to build: {}".format(self.remote_pkg_path))
 
+    def gen_shallow_fetch_command(self, repo_url):
+        """
+        Fetch only the job commit into a repo kept on the builder and make
+        the srpm. Repo of the package survives for the builds of the other
+        chroots on the VM, the commit is not fetched again then.
+
+        Sources from lookaside cache are hardlinked from a cache on the VM
+        addressed by their checksum, fedpkg verifies them and downloads only
+        the missing ones, which are then added to the cache.
+        """
+        repo_dir = os.path.join(self._remote_basedir, "dist-git", self.job.git_repo)
+        cache_dir = os.path.join(self._remote_basedir, "lookaside-cache")
+        git_hash = pipes.quote(self.job.git_hash)
+        return (
+            "mkdir -p {repo_dir} {cache_dir} && cd {repo_dir} && "
+            "(test -d .git || git init -q) && "
+            "(git cat-file -e {git_hash}^{{commit}} 2>/dev/null || "
+            "git fetch -q --depth 1 {repo_url} {git_hash} || "
+            "git fetch -q {repo_url} '+refs/heads/*:refs/remotes/origin/*') && "
+            "git checkout -q -f {git_hash} && rm -f *.src.rpm && "
+            "{link_cached} && "
+            "fedpkg-copr --dist {branch} srpm && "
+            "{store_downloaded}"
+            .format(repo_dir=pipes.quote(repo_dir), cache_dir=pipes.quote(cache_dir),
+                    repo_url=pipes.quote(repo_url), git_hash=git_hash,
+                    branch=pipes.quote(self.job.git_branch),
+                    link_cached=self._lookaside_loop(
+                        cache_dir, '[ -f "$c" ] && [ ! -f "$n" ] && ln -f "$c" "$n"'),
+                    store_downloaded=self._lookaside_loop(
+                        cache_dir, '[ -f "$n" ] && [ ! -f "$c" ] && ln -f "$n" "$c"')))
+
+    @staticmethod
+    def _lookaside_loop(cache_dir, action):
+        """
+        Shell loop running `action` for each file of the `sources` file, with
+        $n set to the file name and $c to its path in the cache. Both the old
+        `<md5>  <name>` and the new `<TYPE> (<name>) = <hash>` formats are read.
+        """
+        return (
+            "{{ [ ! -f sources ] || while read -r a b c d; do "
+            "if [ \"$c\" = \"=\" ]; then n=${{b#(}}; n=${{n%)}}; s=$d; else n=$b; s=$a; fi; "
+            "[ -n \"$s\" ] || continue; c={cache_dir}/$s; {action}; "
+            "done < sources; true; }}"
+            .format(cache_dir=pipes.quote(cache_dir), action=action))
+
     def pre_process_repo_url(self, repo_url):
         """
             Expands variables and sanitize repo url to be used for mock config
@@ -304,7 +405,109 @@ class Builder(object):
         buildcmd += self.remote_pkg_path
         return buildcmd
 
+    def _ssh_options(self):
+        """
+        Options shared by all ssh connections of the job, the first one becomes
+        a control master and the others are multiplexed over it, so we pay
+        for the ssh handshake just once per user.
+        """
+        if self.control_dir is None:
+            self.control_dir = tempfile.mkdtemp(prefix="copr-ssh-")
+        return ["-o", "PasswordAuthentication=no", "-o", "StrictHostKeyChecking=no",
+                "-o", "ConnectTimeout={}".format(SSH_CONNECT_TIMEOUT),
+                "-o", "ServerAliveInterval={}".format(SSH_ALIVE_INTERVAL),
+                "-o", "ServerAliveCountMax={}".format(SSH_ALIVE_COUNT),
+                "-o", "ControlMaster=auto", "-o", "ControlPersist=600",
+                "-o", "ControlPath={}/%r@%h:%p".format(self.control_dir)]
+
+    def _ssh_command(self, cmd, username=None):
+        return (["ssh"] + self._ssh_options() +
+                ["{}@{}".format(username or self.opts.build_user, self.hostname), cmd])
+
+    def _ssh_results(self, returncode, stdout, stderr=""):
+        """
+        :return: results in the format of ansible runner
+        """
+        if returncode == 255:
+            # ssh itself failed
+            return {"contacted": {}, "dark": {self.hostname: {"msg": stderr or stdout}}}
+        return {"contacted": {self.hostname: {"rc": returncode, "stdout": stdout.rstrip("\r\n"), "stderr": stderr}},
+                "dark": {}}
+
+    def _run_ssh(self, cmd, as_root=False):
+        """
+            Executes shell command over the multiplexed ssh connection,
+            the command is killed when it doesn't finish within the timeout
+            of the job
+
+        :return: results in the format of ansible runner
+        """
+        username = "root" if as_root else None
+        proc = Popen(self._ssh_command(str(cmd), username), stdout=PIPE, stderr=PIPE, close_fds=True,
+                     preexec_fn=os.setsid)
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            self._kill_process_group(proc)
+
+        timer = Timer(self.timeout, kill)
+        timer.start()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            timer.cancel()
+
+        if timed_out:
+            return {"contacted": {}, "dark": {self.hostname: {
+                "msg": "Command timed out after {}s: {}".format(self.timeout, cmd)}}}
+        return self._ssh_results(proc.returncode, stdout, stderr)
+
+    @staticmethod
+    def _kill_process_group(proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            # the whole group exited already
+            pass
+
+    def close(self):
+        """
+        Stops the ssh control masters of the job, safe to call repeatedly.
+        """
+        if self.ps is not None:
+            self.ps.close()
+            self.ps = None
+
+        if self.control_dir is None:
+            return
+
+        for username in [self.opts.build_user, "root"]:
+            cmd = ["ssh", "-o", "ControlPath={}/%r@%h:%p".format(self.control_dir),
+                   "-O", "exit", "{}@{}".format(username, self.hostname)]
+            try:
+                Popen(cmd, stdout=PIPE, stderr=PIPE, close_fds=True).communicate()
+            except OSError as error:
+                self.log.warning("Failed to stop ssh control master: {}".format(error))
+
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
+
+    @contextmanager
+    def timed_step(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.step_times.append((name, time.time() - start))
+
+    def format_step_times(self):
+        return ", ".join("{}: {:.1f}s".format(name, spent) for name, spent in self.step_times)
+
     def run_build_and_wait(self, buildcmd):
+        if self.opts.ssh.transport == "ssh":
+            return self.run_build_streaming(buildcmd)
+
         self.log.info("executing: {0}".format(buildcmd))
         self.conn.module_name = "shell"
         self.conn.module_args = buildcmd
@@ -312,10 +515,8 @@ class Builder(object):
         waited = 0
         results = None
 
-        # self.setup_pubsub_handler()
         while True:
-            # TODO rework Builder and extrace check_pubsub, add method to interrupt build process from dispatcher
-            # self.check_pubsub()
+            self.check_build_interrupted()
             results = poller.poll()
 
             if results["contacted"] or results["dark"]:
@@ -329,21 +530,209 @@ class Builder(object):
             waited += 10
         return results
 
-    def setup_pubsub_handler(self):
+    def run_build_streaming(self, buildcmd):
+        """
+        Run the build command detached on the builder and stream its output
+        until it exits, see :py:meth:`start_detached_build` and :py:meth:`attach_build`.
+
+        :return: results in the format of ansible runner
+        :raises BuilderTimeOutError:
+        :raises BuildCanceledError:
+        """
+        self.start_detached_build(buildcmd)
+        return self.attach_build()
 
-        self.rc = get_redis_connection(self.opts)
-        self.ps = self.rc.pubsub(ignore_subscribe_messages=True)
-        channel_name = PUBSUB_INTERRUPT_BUILDER.format(self.hostname)
-        self.ps.subscribe(channel_name)
+    def start_detached_build(self, buildcmd):
+        """
+        Start the build command in its own session on the builder, so that it
+        keeps running when the ssh connection or the whole backend goes down.
+        Output of the command goes to `build-output.log` in the job tempdir,
+        the exit code to `build.rc` once the command exits.
+
+        The `build_started` callback gets the state needed to reattach to
+        the build later, see :py:meth:`resume`.
+        """
+        self.log.info("executing: {0}".format(buildcmd))
+        detached = "({}) > build-output.log 2>&1; echo $? > build.rc.tmp && mv build.rc.tmp build.rc".format(buildcmd)
+        self.build_running = True
+        results = self._run_ssh(
+            "cd {tempdir} && rm -f build.rc && touch build-output.log && "
+            "(setsid sh -c {detached} < /dev/null > /dev/null 2>&1 & echo $! > build.pid)"
+            .format(tempdir=pipes.quote(self.tempdir), detached=pipes.quote(detached)))
+        check_for_ans_error(results, self.hostname)
+
+        if self.build_started is not None:
+            self.build_started({"remote_tempdir": self.tempdir,
+                                "remote_pkg_path": self.remote_pkg_path})
+
+    def attach_build(self):
+        """
+        Pass the output of the detached build line by line into the build log
+        and to the BUILD_LOG_PUB_SUB channel of the task, from its beginning
+        until the build exits. When the ssh connection drops, the output is
+        followed again from where it stopped. The build is stopped on timeout
+        and cancel.
+
+        :return: results in the format of ansible runner, with the exit code of the build
+        :raises BuilderTimeOutError:
+        :raises BuildCanceledError:
+        """
+        start = time.time()
+        output = []
+        received = 0
+        partial_line = ""
+        attempt = 0
+        while True:
+            # tail exits once the build process is gone, a build killed before
+            # writing its exit code is reported as failed
+            attach_cmd = ("cd {tempdir} && [ -f build.pid ] && "
+                          "tail -c +{offset} -f --pid=$(cat build.pid) build-output.log; "
+                          "exit $(cat build.rc 2>/dev/null || echo 1)"
+                          ).format(tempdir=pipes.quote(self.tempdir), offset=received + 1)
+            # own process group, so that nothing keeps the output pipe open once killed
+            proc = Popen(self._ssh_command(attach_cmd), stdout=PIPE, stderr=PIPE, close_fds=True,
+                         preexec_fn=os.setsid)
+            try:
+                while True:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        self.kill_remote_build()
+                        raise BuilderTimeOutError("Build timeout expired. Time limit: {}s, time spent: {}s"
+                                                  .format(self.timeout, int(time.time() - start)))
+
+                    # wake up now and then to check for interruptions
+                    ready, _, _ = select.select([proc.stdout], [], [], min(remaining, 1))
+                    self.check_build_interrupted()
+                    if not ready:
+                        continue
+                    chunk = os.read(proc.stdout.fileno(), 4096)
+                    if not chunk:
+                        # the build exited or the connection dropped
+                        break
+
+                    received += len(chunk)
+                    output.append(chunk)
+                    lines = (partial_line + chunk).split("\n")
+                    partial_line = lines.pop()
+                    if lines:
+                        self._stream_build_log(lines)
+            finally:
+                self._kill_process_group(proc)
+                _, stderr = proc.communicate()
+
+            if proc.returncode != 255:
+                self.build_running = False
+                break
+
+            attempt += 1
+            if attempt > ATTACH_RETRIES:
+                self.log.error("Failed to follow the build on {}: {}".format(self.hostname, stderr))
+                break
+            self.log.warning("Lost connection to the build on {}, reattaching: {}"
+                             .format(self.hostname, stderr))
+            time.sleep(ATTACH_RETRY_DELAY)
+
+        if partial_line:
+            self._stream_build_log([partial_line])
+
+        return self._ssh_results(proc.returncode, "".join(output), stderr)
+
+    def _stream_build_log(self, lines):
+        for line in lines:
+            self.log.info(line)
+
+        if not self.live_log_enabled:
+            return
+        try:
+            if self.live_log_rc is None:
+                self.live_log_rc = get_redis_connection(self.opts)
+            self.live_log_rc.publish(BUILD_LOG_PUB_SUB.format(task_id=self.job.task_id), "\n".join(lines))
+        except RedisError as error:
+            self.log.warning("Failed to publish build log, live log disabled: {}".format(error))
+            self.live_log_enabled = False
+
+    def setup_pubsub_handler(self):
+        try:
+            self.rc = get_redis_connection(self.opts)
+            self.ps = self.rc.pubsub(ignore_subscribe_messages=True)
+            channel_name = PUBSUB_INTERRUPT_BUILDER.format(self.hostname)
+            self.ps.subscribe(channel_name)
+            # the cancel message published before the subscription is lost
+            if self.job.task_id:
+                self.canceled = bool(self.rc.exists(KEY_BUILD_CANCELED.format(task_id=self.job.task_id)))
+        except RedisError as error:
+            self.log.warning("Failed to subscribe to vm interruptions, the build can't be canceled: {}"
+                             .format(error))
+            self.ps = None
+            return
 
         self.log.info("Subscribed to vm interruptions channel {}".format(channel_name))
 
     def check_pubsub(self):
-        # self.log.info("Checking pubsub channel")
+        """
+        :raises BuildCanceledError: build was canceled by user
+        :raises VmError: any other interruption
+        """
+        if self.canceled:
+            raise BuildCanceledError("Build was canceled")
+        if self.ps is None:
+            return
         msg = self.ps.get_message()
         if msg is not None and msg.get("type") == "message":
+            if msg["data"] == INTERRUPT_BUILD_CANCELED:
+                raise BuildCanceledError("Build was canceled")
             raise VmError("Build interrupted by msg: {}".format(msg["data"]))
 
+    def check_build_interrupted(self):
+        """
+        Same as :py:meth:`check_pubsub`, but stops the running build on the
+        builder when canceled.
+        """
+        try:
+            self.check_pubsub()
+        except BuildCanceledError:
+            self.kill_remote_build()
+            raise
+
+    def kill_remote_build(self):
+        """
+        Kill the whole session of the detached build recorded in `build.pid`,
+        so that no process started by the build survives on the builder.
+        Mockchain and mock are stopped by name as well, in case they left the
+        session. Once nothing of the session remains, the build is not
+        considered running anymore.
+        """
+        self.log.info("Stopping the build on {}".format(self.hostname))
+        # brackets keep pkill from matching the shell running this command
+        kill_cmd = (
+            "pkill -TERM -f '[/]usr/bin/mockchain'; pkill -TERM -f '[/]usr/libexec/mock/mock'; "
+            "cd {tempdir} && [ -f build.pid ] || exit 0; sid=$(cat build.pid); "
+            "pkill -TERM -s $sid; "
+            "for i in $(seq {wait}); do pgrep -s $sid > /dev/null || exit 0; sleep 1; done; "
+            "pkill -KILL -s $sid; sleep 1; ! pgrep -s $sid > /dev/null"
+        ).format(tempdir=pipes.quote(self.tempdir), wait=KILL_BUILD_WAIT)
+        results = self._run_ansible(kill_cmd, as_root=True)
+        result = results.get("contacted", {}).get(self.hostname)
+        if result is None or result.get("rc", 0) != 0:
+            self.log.warning("Failed to stop the build on {}: {}".format(self.hostname, results))
+        else:
+            self.build_running = False
+
+    def stop_build(self):
+        """
+        Make sure the detached build doesn't run anymore, so that the VM can
+        be given to another job.
+
+        :return: False when the build may still run on the builder
+        """
+        if self.build_running:
+            try:
+                self.kill_remote_build()
+            # pylint: disable=W0703
+            except Exception as error:
+                self.log.exception("Failed to stop the build on {}: {}".format(self.hostname, error))
+        return not self.build_running
+
     # def start_build(self, pkg):
     #     # build the pkg passed in
     #     # add pkg to various lists
@@ -363,41 +752,73 @@ class Builder(object):
     #
 
     def build(self):
-        self.setup_mock_chroot_config()
+        # cancellation of the build is checked between the steps and while waiting for mockchain
+        self.setup_pubsub_handler()
+
+        with self.timed_step("mock_config"):
+            self.setup_mock_chroot_config()
 
         # download the package to the builder
-        self.download_job_pkg_to_builder()
+        with self.timed_step("srpm"):
+            self.download_job_pkg_to_builder()
+        self.check_pubsub()
 
         # construct the mockchain command
         buildcmd = self.gen_mockchain_command()
         # run the mockchain command async
-        ansible_build_results = self.run_build_and_wait(buildcmd)  # now raises BuildTimeoutError
+        with self.timed_step("build"):
+            ansible_build_results = self.run_build_and_wait(buildcmd)  # now raises BuildTimeoutError
         check_for_ans_error(ansible_build_results, self.hostname)  # on error raises AnsibleResponseError
 
         # we know the command ended successfully but not if the pkg built
         # successfully
-        self.check_build_success()
+        with self.timed_step("check_success"):
+            self.check_build_success()
         return get_ans_results(ansible_build_results, self.hostname).get("stdout", "")
 
+    def resume(self, build_state):
+        """
+        Reattach to the build started before the backend restart, which may
+        be still running or already finished, and check its result.
+
+        :param dict build_state: as passed to the `build_started` callback
+        """
+        self.tempdir = build_state["remote_tempdir"]
+        self.remote_pkg_path = build_state["remote_pkg_path"]
+        self.remote_pkg_name = os.path.basename(self.remote_pkg_path).replace(".src.rpm", "")
+        self.setup_pubsub_handler()
+        self.build_running = True
+
+        self.log.info("Reattaching to the build in {} on {}".format(self.tempdir, self.hostname))
+        with self.timed_step("build"):
+            results = self.attach_build()
+        check_for_ans_error(results, self.hostname)
+
+        with self.timed_step("check_success"):
+            self.check_build_success()
+        return get_ans_results(results, self.hostname).get("stdout", "")
+
     def rsync_call(self, source_path, target_path):
         ensure_dir_exists(target_path, self.log)
+        log_filepath = os.path.join(target_path, self.job.rsync_log_name)
 
         # make spaces work w/our rsync command below :(
         target_path = "'" + target_path.replace("'", "'\\''") + "'"
 
-        ssh_opts = "'ssh -o PasswordAuthentication=no -o StrictHostKeyChecking=no'"
+        ssh_opts = "'ssh {}'".format(" ".join(self._ssh_options()))
         full_source_path = "{}@{}:{}/*".format(self.opts.build_user,
                                                self.hostname,
                                                source_path)
-        log_filepath = os.path.join(target_path, self.job.rsync_log_name)
-        command = "{} -rlptDvH -e {} {} {}/ &> {}".format(
-            rsync, ssh_opts, full_source_path, target_path, log_filepath)
+        # logs get compressed on the wire, packages are compressed already
+        command = "{} -rlptDvH --copy-dirlinks -z --skip-compress={} --stats -e {} {} {}/ &> {}".format(
+            rsync, RSYNC_SKIP_COMPRESS, ssh_opts, full_source_path, target_path, pipes.quote(log_filepath))
 
         # dirty magic with Popen due to IO buffering
         # see http://thraxil.org/users/anders/posts/2008/03/13/Subprocess-Hanging-PIPE-is-your-enemy/
         # alternative: use tempfile.Tempfile as Popen stdout/stderr
         try:
             self.log.info("rsyncing of {0} started for job: {1}".format(full_source_path, self.job))
+            start = time.time()
             cmd = Popen(command, shell=True)
             cmd.wait()
             self.log.info("rsyncing finished.")
@@ -411,12 +832,46 @@ class Builder(object):
             self.log.error(err_msg)
             raise BuilderError(err_msg, return_code=cmd.returncode)
 
-    def download_results(self, target_path):
-        if self._get_remote_results_dir():
-            self.rsync_call(self._get_remote_results_dir(), target_path)
+        self.log_transfer_stats(log_filepath, time.time() - start)
+
+    def log_transfer_stats(self, log_filepath, elapsed):
+        """
+        Log the download throughput from the `--stats` summary in the rsync log
+        """
+        try:
+            with open(log_filepath) as handle:
+                rsync_log = handle.read()
+        except IOError:
+            return
+
+        received = re.search(r"Total bytes received: ([\d,.]+)", rsync_log)
+        size = re.search(r"Total file size: ([\d,.]+)", rsync_log)
+        if not received:
+            return
 
-    def download_configs(self, target_path):
-        self.rsync_call(self._get_remote_config_dir(), target_path)
+        received = int(re.sub(r"[,.]", "", received.group(1)))
+        rate = received / max(elapsed, 0.001) / 1024
+        self.log.info("Downloaded {} kB in {:.1f}s, {:.0f} kB/s{}".format(
+            received // 1024, elapsed, rate,
+            ", total size of the files {} kB".format(int(re.sub(r"[,.]", "", size.group(1))) // 1024)
+            if size else ""))
+
+    def download(self, target_path):
+        """
+        Download results and mock configs of the job in one rsync session.
+        The configs dir gets linked into the results dir on the builder and
+        rsync copies it as a directory.
+        """
+        results_dir = self._get_remote_results_dir()
+        config_dir = self._get_remote_config_dir()
+        with self.timed_step("download"):
+            if not results_dir:
+                self.rsync_call(config_dir, os.path.join(target_path, "configs"))
+                return
+
+            self._run_ansible("mkdir -p {res} && ([ ! -d {cfg} ] || ln -sfn {cfg} {res}/configs)".format(
+                res=pipes.quote(results_dir), cfg=pipes.quote(config_dir)))
+            self.rsync_call(results_dir, target_path)
 
     def check(self):
         # do check of host
@@ -0,0 +1,158 @@
+# coding: utf-8
+
+"""
+Reading of the basic metadata from RPM headers, without spawning `rpm`
+for each package.
+
+File layout: 96 bytes lead, signature header padded to 8 bytes, main
+header. Header is a 16 bytes intro (magic, reserved, number of index
+entries, size of the data store), index entries of (tag, type, offset,
+count) and the data store.
+"""
+
+import os
+import struct
+
+from .exceptions import RpmHeaderError
+
+
+RPM_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+RPM_LEAD_SIZE = 96
+
+TYPE_INT32 = 4
+TYPE_INT64 = 5
+TYPE_STRING = 6
+TYPE_STRING_ARRAY = 8
+TYPE_I18NSTRING = 9
+
+TAG_NAME = 1000
+TAG_VERSION = 1001
+TAG_RELEASE = 1002
+TAG_EPOCH = 1003
+TAG_SIZE = 1009
+TAG_ARCH = 1022
+TAG_SOURCERPM = 1044
+TAG_DIRINDEXES = 1116
+TAG_BASENAMES = 1117
+TAG_DIRNAMES = 1118
+TAG_LONGSIZE = 5009
+
+
+def _read_exactly(handle, size, path):
+    data = handle.read(size)
+    if len(data) != size:
+        raise RpmHeaderError("Truncated rpm header: {}".format(path))
+    return data
+
+
+def _read_header(handle, path):
+    intro = _read_exactly(handle, 16, path)
+    if intro[:4] != RPM_HEADER_MAGIC:
+        raise RpmHeaderError("Bad rpm header magic: {}".format(path))
+
+    index_count, store_size = struct.unpack(">II", intro[8:])
+    raw_index = _read_exactly(handle, 16 * index_count, path)
+    store = _read_exactly(handle, store_size, path)
+
+    index = {}
+    for position in range(index_count):
+        tag, tag_type, offset, count = struct.unpack_from(">IIII", raw_index, 16 * position)
+        index[tag] = (tag_type, offset, count)
+    return index, store
+
+
+def read_header(path):
+    """
+    :return: (index, store) of the main header, index maps tag -> (type, offset, count)
+    :raises RpmHeaderError: file is not an rpm
+    """
+    with open(path, "rb") as handle:
+        if _read_exactly(handle, RPM_LEAD_SIZE, path)[:4] != RPM_LEAD_MAGIC:
+            raise RpmHeaderError("Not an rpm file: {}".format(path))
+
+        _, signature_store = _read_header(handle, path)
+        _read_exactly(handle, (8 - len(signature_store) % 8) % 8, path)
+        return _read_header(handle, path)
+
+
+def get_tag(header, tag):
+    """
+    :return: value of the integer or string `tag`, None when not present
+    """
+    index, store = header
+    if tag not in index:
+        return None
+
+    tag_type, offset, _ = index[tag]
+    if tag_type == TYPE_INT32:
+        return struct.unpack_from(">I", store, offset)[0]
+    if tag_type == TYPE_INT64:
+        return struct.unpack_from(">Q", store, offset)[0]
+    if tag_type in [TYPE_STRING, TYPE_I18NSTRING]:
+        return store[offset:store.index(b"\0", offset)].decode("utf-8")
+    raise RpmHeaderError("Unsupported type {} of tag {}".format(tag_type, tag))
+
+
+def get_array_tag(header, tag):
+    """
+    :return: list of values of the integer or string array `tag`, [] when not present
+    """
+    index, store = header
+    if tag not in index:
+        return []
+
+    tag_type, offset, count = index[tag]
+    if tag_type == TYPE_INT32:
+        return list(struct.unpack_from(">{}I".format(count), store, offset))
+    if tag_type == TYPE_STRING_ARRAY:
+        result = []
+        for _ in range(count):
+            end = store.index(b"\0", offset)
+            result.append(store[offset:end].decode("utf-8"))
+            offset = end + 1
+        return result
+    raise RpmHeaderError("Unsupported type {} of array tag {}".format(tag_type, tag))
+
+
+def get_file_names(path):
+    """
+    :return: list of absolute paths of the files in the package
+    """
+    header = read_header(path)
+    dir_names = get_array_tag(header, TAG_DIRNAMES)
+    return [dir_names[dir_index] + base_name for base_name, dir_index in
+            zip(get_array_tag(header, TAG_BASENAMES), get_array_tag(header, TAG_DIRINDEXES))]
+
+
+def get_package_info(path):
+    """
+    :return: dict with name, epoch, version, release, arch and size of the
+        installed files of the package
+    """
+    header = read_header(path)
+    size = get_tag(header, TAG_LONGSIZE)
+    return {
+        "name": get_tag(header, TAG_NAME),
+        "epoch": get_tag(header, TAG_EPOCH),
+        "version": get_tag(header, TAG_VERSION),
+        "release": get_tag(header, TAG_RELEASE),
+        # source rpms have arch of the build host in the header
+        "arch": "src" if get_tag(header, TAG_SOURCERPM) is None else get_tag(header, TAG_ARCH),
+        "size": size if size is not None else get_tag(header, TAG_SIZE),
+    }
+
+
+def collect_packages_info(directory, include_srpm=False):
+    """
+    :return: list of :py:func:`get_package_info` of the rpms in `directory`,
+        sorted by file name
+    """
+    result = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".rpm"):
+            continue
+        if name.endswith(".src.rpm") and not include_srpm:
+            continue
+        result.append(get_package_info(os.path.join(directory, name)))
+    return result
@@ -5,8 +5,10 @@
 Wrapper for /bin/sign from obs-sign package
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
 import json
+import time
 
 import os
 from requests import request
@@ -90,9 +92,22 @@ def _sign_one(path, email):
     return stdout, stderr
 
 
+def _sign_one_timed(path, email):
+    """
+    :return: tuple (path, seconds spent, CoprSignError or None)
+    """
+    started_on = time.time()
+    try:
+        _sign_one(path, email)
+        error = None
+    except CoprSignError as e:
+        error = e
+    return path, time.time() - started_on, error
+
+
 def sign_rpms_in_dir(username, projectname, path, opts, log):
     """
-    Signs rpms using obs-signd.
+    Signs rpms using obs-signd, up to `opts.sign_max_workers` rpms at once.
 
     If some some pkgs failed to sign, entire build marked as failed,
     but we continue to try sign other pkgs.
@@ -120,15 +135,18 @@ def sign_rpms_in_dir(username, projectname, path, opts, log):
     except CoprSignNoKeyError:
         create_user_keys(username, projectname, opts)
 
-    errors = []  # tuples (rpm_filepath, exception)
-    for rpm in rpm_list:
-        try:
-            _sign_one(rpm, create_gpg_email(username, projectname))
-            log.info("signed rpm: {}".format(rpm))
+    email = create_gpg_email(username, projectname)
+    with ThreadPoolExecutor(max_workers=max(1, min(opts.sign_max_workers, len(rpm_list)))) as executor:
+        futures = [executor.submit(_sign_one_timed, rpm, email) for rpm in rpm_list]
+        results = [future.result() for future in futures]
 
-        except CoprSignError as e:
-            log.exception("failed to sign rpm: {}".format(rpm))
-            errors.append((rpm, e))
+    errors = []  # tuples (rpm_filepath, exception)
+    for rpm, latency, error in results:
+        if error is None:
+            log.info("signed rpm: {} in {:.2f}s".format(rpm, latency))
+        else:
+            log.error("failed to sign rpm: {} in {:.2f}s: {}".format(rpm, latency, error))
+            errors.append((rpm, error))
 
     if errors:
         raise CoprSignError("Rpm sign failed, affected rpms: {}"
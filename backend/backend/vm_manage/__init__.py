@@ -15,12 +15,21 @@ PUBSUB_MB = "copr:backend:vm:pubsub::"
 
 class EventTopics(object):
     HEALTH_CHECK = "health_check"
+    HEALTH_CHECK_BATCH = "health_check_batch"
     VM_SPAWNED = "vm_spawned"
     VM_TERMINATION_REQUEST = "vm_termination_request"
     VM_TERMINATED = "vm_terminated"
 
 # argument - vm_ip
 PUBSUB_INTERRUPT_BUILDER = "copr:backend:interrupt_build:pubsub::{}"
+# message on PUBSUB_INTERRUPT_BUILDER, any other one means the VM is gone
+INTERRUPT_BUILD_CANCELED = "canceled"
+
+KEY_BUILD_CANCELED = "copr:backend:build_canceled::{task_id}"
+# set when the task was canceled, so that builders which subscribed to
+# PUBSUB_INTERRUPT_BUILDER only after the cancel message still see it,
+# expires after BUILD_CANCELED_TTL seconds
+BUILD_CANCELED_TTL = 24 * 3600
 
 
 KEY_VM_POOL = "copr:backend:vm_pool:set::{group}"
@@ -37,3 +46,17 @@ KEY_SERVER_INFO = "copr:backend:server_info:hset::"
 
 KEY_VM_INSTANCE = "copr:backend:vm_instance:hset::{vm_name}"
 # hset to store VmDescriptor
+
+KEY_VM_USER_USAGE = "copr:backend:vm_user_usage:hset::{group}"
+# hset username -> number of VMs in `group` which are `in_use` by the user,
+# maintained atomically by the acquire/release/terminate lua scripts
+
+KEY_VM_STATE_INDEX = "copr:backend:vm_state_index:set::{group}::{state}"
+# set of vm_names of VMs in `group` which are in `state`, maintained by lua scripts, see models.set_vm_state_lua
+
+KEY_VM_IP_INDEX = "copr:backend:vm_ip_index:set::{vm_ip}"
+# set of vm_names of VMs with `vm_ip`
+
+KEY_VM_SCHEDULE = "copr:backend:vm_schedule:zset::"
+# sorted set vm_name -> unixtime when VmMaster should look at the VM next,
+# VM is scheduled immediately on every state change
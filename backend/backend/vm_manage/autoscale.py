@@ -0,0 +1,92 @@
+# coding: utf-8
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+from collections import namedtuple
+import math
+
+
+AutoscaleDecision = namedtuple("AutoscaleDecision", ["spawn", "terminate"])
+
+
+class Autoscaler(object):
+    """
+    Decides how many VMs of one build group should be spawned or terminated,
+    based on the frontend queue depth and recent build durations.
+
+    The policy depends only on the snapshot passed to :py:meth:`decide`,
+    VmMaster logs every snapshot, so that recorded traces can be replayed
+    offline, see :py:meth:`replay`.
+
+    :param dict group_opts: build group configuration
+    """
+    def __init__(self, group_opts):
+        self.bg = group_opts
+
+    def get_demand(self, queue_stats):
+        """
+        :param dict queue_stats: arch -> {"pending", "running", "avg_duration"},
+            as returned by frontend
+        :return: number of pending tasks for the group archs and their average duration or None
+        """
+        pending = 0
+        weighted_duration = 0.0
+        weights = 0
+        for arch in self.bg["archs"]:
+            stats = queue_stats.get(arch)
+            if not stats:
+                continue
+            pending += stats["pending"]
+            if stats.get("avg_duration") is not None:
+                weight = max(1, stats["pending"] + stats["running"])
+                weighted_duration += weight * stats["avg_duration"]
+                weights += weight
+
+        return pending, (weighted_duration / weights if weights else None)
+
+    def decide(self, snapshot):
+        """
+        :param dict snapshot: state of the group with keys
+            - "queue_stats": see :py:meth:`get_demand`
+            - "ready", "in_use", "starting": number of VMs in the pool,
+              `starting` are the VMs which are not ready yet
+            - "unavailable": number of other VMs in the pool which are not
+              being terminated, e.g. those which failed the health check
+            - "spawning": number of running spawn processes
+        :rtype: AutoscaleDecision
+        """
+        pending, avg_duration = self.get_demand(snapshot["queue_stats"])
+        ready, in_use = snapshot["ready"], snapshot["in_use"]
+        starting, spawning = snapshot["starting"], snapshot["spawning"]
+        # not present in the traces recorded by older backends
+        unavailable = snapshot.get("unavailable", 0)
+
+        # builds finishing sooner than a new VM gets ready free their VMs for the queue
+        expected_freed = 0.0
+        if avg_duration:
+            expected_freed = in_use * min(1.0, self.bg["vm_spawn_time"] / avg_duration)
+
+        wanted = pending + self.bg["min_vm_ready"]
+        available = ready + starting + spawning + expected_freed
+        missing = int(math.ceil(wanted - available))
+
+        room = self.bg["max_vm_total"] - (ready + in_use + starting + unavailable + spawning)
+        spawn_slots = self.bg["max_spawn_processes"] - spawning
+        spawn = max(0, min(missing, room, spawn_slots))
+
+        terminate = 0
+        if not pending and not spawn:
+            keep_ready = max(self.bg["min_vm_ready"], self.bg["max_vm_in_ready_state"])
+            terminate = max(0, ready - keep_ready)
+
+        return AutoscaleDecision(spawn, terminate)
+
+    def replay(self, trace):
+        """
+        :param trace: iterable of recorded snapshots
+        :return: list of decisions for each snapshot
+        """
+        return [self.decide(snapshot) for snapshot in trace]
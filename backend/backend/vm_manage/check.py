@@ -7,76 +7,113 @@ import json
 from ansible.runner import Runner
 
 from backend.helpers import get_redis_connection
-from backend.vm_manage import PUBSUB_MB, EventTopics
+from backend.vm_manage import PUBSUB_MB, EventTopics, KEY_VM_INSTANCE, VmStates
 from backend.vm_manage.executor import Executor
+from backend.vm_manage.models import set_vm_state_lua
 
 from ..helpers import get_redis_logger
 
 
-def check_health(opts, vm_name, vm_ip):
+def check_health_batch(opts, vm_list):
     """
-    Test connectivity to the VM
+    Test connectivity to many VMs at once, one ansible runner checks the VMs
+    in parallel using up to `vm_health_check_forks` connections. Only with
+    `opts.ssh.transport` set to "ssh" the connections are multiplexed by ssh
+    ControlPersist, so consecutive checks don't need a new handshake; the
+    paramiko transport connects anew for every check. All results
+    are sent to the event handler in one message.
 
-    :param vm_ip: ip address to the newly created VM
-    :raises: :py:class:`~backend.exceptions.CoprWorkerSpawnFailError`: validation fails
+    :param vm_list: list of (vm_name, vm_ip) tuples
     """
-    # setproctitle("check VM: {}".format(vm_ip))
-
     log = get_redis_logger(opts, "vmm.check_health.detached", "vmm")
 
+    host_list = [vm_ip for _, vm_ip in vm_list]
     runner_options = dict(
         remote_user=opts.build_user or "root",
-        host_list="{},".format(vm_ip),
-        pattern=vm_ip,
-        forks=1,
+        host_list="{},".format(",".join(host_list)),
+        pattern="all",
+        forks=max(1, min(len(vm_list), opts.get("vm_health_check_forks", 20))),
         transport=opts.ssh.transport,
         timeout=opts.vm_ssh_check_timeout
     )
-    connection = Runner(**runner_options)
-    connection.module_name = "shell"
-    connection.module_args = "echo hello"
-
-    result = {
-        "vm_ip": vm_ip,
-        "vm_name": vm_name,
-        "msg": "",
-        "result": "OK",
-        "topic": EventTopics.HEALTH_CHECK
-    }
-    err_msg = None
+
+    results = []
     try:
+        connection = Runner(**runner_options)
+        connection.module_name = "shell"
+        connection.module_args = "echo hello"
         res = connection.run()
-        if vm_ip not in res.get("contacted", {}):
-            err_msg = (
-                "VM is not responding to the testing playbook."
-                "Runner options: {}".format(runner_options) +
-                "Ansible raw response:\n{}".format(res))
+        for vm_name, vm_ip in vm_list:
+            result = {"vm_ip": vm_ip, "vm_name": vm_name, "msg": "", "result": "OK"}
+            if vm_ip not in res.get("contacted", {}):
+                result["result"] = "failed"
+                result["msg"] = (
+                    "VM is not responding to the testing playbook."
+                    "Runner options: {}".format(runner_options) +
+                    "Ansible raw response:\n{}".format(res.get("dark", {}).get(vm_ip)))
+            results.append(result)
 
     except Exception as error:
-        err_msg = "Failed to check  VM ({})due to ansible error: {}".format(vm_ip, error)
+        err_msg = "Failed to check VMs ({}) due to ansible error: {}".format(", ".join(host_list), error)
         log.exception(err_msg)
+        results = [{"vm_ip": vm_ip, "vm_name": vm_name, "msg": err_msg, "result": "failed"}
+                   for vm_name, vm_ip in vm_list]
 
+    msg = {"topic": EventTopics.HEALTH_CHECK_BATCH, "results": results}
     try:
-        if err_msg:
-            result["result"] = "failed"
-            result["msg"] = err_msg
         rc = get_redis_connection(opts)
-        rc.publish(PUBSUB_MB, json.dumps(result))
+        rc.publish(PUBSUB_MB, json.dumps(msg))
     except Exception as err:
         log.exception("Failed to publish msg health check result: {} with error: {}"
-                      .format(result, err))
+                      .format(msg, err))
 
 
 class HealthChecker(Executor):
+    """
+    Collects VMs to be checked, :py:meth:`start_pending_checks` then
+    checks them all in one background thread.
+    """
 
     __name_for_log__ = "health_checker"
     __who_for_log__ = "vmm"
 
-    def run_check_health(self, vm_name, vm_ip):
+    def __init__(self, opts):
+        super(HealthChecker, self).__init__(opts)
+        self.pending_checks = []
+
+    def run_check_health(self, vm_name, vm_ip, orig_state=None):
+        """
+        Queue VM for the next batch
+
+        :param orig_state: state of the VM before it was switched to the check,
+            restored when the batch fails to start
+        """
+        self.pending_checks.append((vm_name, vm_ip, orig_state))
+
+    def start_pending_checks(self):
         self.recycle()
-        self.run_detached(check_health, args=(self.opts, vm_name, vm_ip))
-        # proc = Process(target=check_health, args=(self.opts, vm_name, vm_ip))
-        # proc = Thread(target=check_health, args=(self.opts, vm_name, vm_ip))
-        # self.child_processes.append(proc)
-        # proc.start()
-        # self.log.debug("Check health process started: {}".format(proc.pid))
+        if not self.pending_checks:
+            return
+        pending, self.pending_checks = self.pending_checks, []
+        vm_list = [(vm_name, vm_ip) for vm_name, vm_ip, _ in pending]
+        self.log.debug("Checking health of {} VMs".format(len(vm_list)))
+        try:
+            self.run_detached(check_health_batch, args=(self.opts, vm_list))
+        except Exception as err:
+            self.log.exception("Failed to start health check: {}".format(err))
+            self.restore_states(pending)
+
+    def restore_states(self, pending):
+        """
+        Return VMs of a batch which didn't start back to their original state,
+        VMs in use were not switched to the check
+        """
+        rc = get_redis_connection(self.opts)
+        set_vm_state = rc.register_script(set_vm_state_lua)
+        for vm_name, _, orig_state in pending:
+            if orig_state is None or orig_state == VmStates.IN_USE:
+                continue
+            try:
+                set_vm_state(keys=[KEY_VM_INSTANCE.format(vm_name=vm_name)], args=[orig_state])
+            except Exception as err:
+                self.log.exception("Failed to restore state of VM {}: {}".format(vm_name, err))
@@ -8,6 +8,7 @@ import time
 from backend.exceptions import VmDescriptorNotFound
 from backend.helpers import get_redis_logger
 from backend.vm_manage import VmStates, PUBSUB_MB, EventTopics
+from backend.vm_manage.models import set_vm_state_lua_function
 
 
 class Recycle(Thread):
@@ -33,27 +34,27 @@ class Recycle(Thread):
         self._running = False
 
 # KEYS[1]: VMD key
-on_health_check_success_lua = """
+on_health_check_success_lua = set_vm_state_lua_function + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "check_health" and old_state ~= "in_use" then
     return nil
 else
     redis.call("HSET", KEYS[1], "check_fails", 0)
     if old_state == "check_health" then
-        redis.call("HSET", KEYS[1], "state", "{}")
+        set_vm_state(KEYS[1], "{}")
     end
 end
 """.format(VmStates.READY)
 
 # KEYS[1]: VMD key
-record_failure_lua = """
+record_failure_lua = set_vm_state_lua_function + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "check_health" and old_state ~= "in_use" and old_state ~= "check_health_failed" then
     return nil
 else
     redis.call("HINCRBY", KEYS[1], "check_fails", 1)
     if old_state == "check_health" then
-        redis.call("HSET", KEYS[1], "state", "{}")
+        set_vm_state(KEYS[1], "{}")
     end
 end
 """.format(VmStates.CHECK_HEALTH_FAILED)
@@ -75,6 +76,7 @@ class EventHandler(Process):
         # self.do_recycle_proc = None
         self.handlers_map = {
             EventTopics.HEALTH_CHECK: self.on_health_check_result,
+            EventTopics.HEALTH_CHECK_BATCH: self.on_health_check_batch_result,
             EventTopics.VM_SPAWNED: self.on_vm_spawned,
             EventTopics.VM_TERMINATION_REQUEST: self.on_vm_termination_request,
             EventTopics.VM_TERMINATED: self.on_vm_termination_result,
@@ -112,6 +114,13 @@ class EventHandler(Process):
                               .format(check_fails_count, msg))
                 self.vmm.start_vm_termination(vmd.vm_name)
 
+    def on_health_check_batch_result(self, msg):
+        for result in msg["results"]:
+            try:
+                self.on_health_check_result(result)
+            except Exception as err:
+                self.log.exception("Failed to handle health check result: {}, {}".format(result, err))
+
     def on_vm_spawned(self, msg):
         self.vmm.add_vm_to_pool(vm_ip=msg["vm_ip"], vm_name=msg["vm_name"], group=msg["group"])
 
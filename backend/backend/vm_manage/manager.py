@@ -11,23 +11,24 @@ import time
 import weakref
 from cStringIO import StringIO
 import datetime
-from backend.exceptions import VmError, NoVmAvailable, VmDescriptorNotFound
+from backend.exceptions import VmError, NoVmAvailable
 
 from backend.helpers import get_redis_connection
-from .models import VmDescriptor
+from .models import VmDescriptor, set_vm_state_lua_function
 from . import VmStates, KEY_VM_INSTANCE, KEY_VM_POOL, EventTopics, PUBSUB_MB, KEY_SERVER_INFO, \
-    KEY_VM_POOL_INFO
+    KEY_VM_POOL_INFO, KEY_VM_USER_USAGE, KEY_VM_STATE_INDEX, KEY_VM_IP_INDEX, KEY_VM_SCHEDULE, \
+    PUBSUB_INTERRUPT_BUILDER, INTERRUPT_BUILD_CANCELED, KEY_BUILD_CANCELED, BUILD_CANCELED_TTL
 from ..helpers import get_redis_logger
 
 # KEYS[1]: VMD key
 # ARGV[1] current timestamp for `last_health_check`
-set_checking_state_lua = """
+set_checking_state_lua = set_vm_state_lua_function + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "got_ip" and old_state ~= "ready" and old_state ~= "in_use" and old_state ~= "check_health_failed" then
     return nil
 else
     if old_state ~= "in_use" then
-        redis.call("HSET", KEYS[1], "state", "check_health")
+        set_vm_state(KEYS[1], "check_health")
     end
     redis.call("HSET", KEYS[1], "last_health_check", ARGV[1])
     return "OK"
@@ -35,23 +36,35 @@ end
 """
 
 # KEYS[1]: VMD key
+# KEYS[2]: server info key
+# KEYS[3]: user usage key of the VM group
 # ARGV[1]: user to bound;
 # ARGV[2]: pid of the builder process
 # ARGV[3]: current timestamp for `in_use_since`
 # ARGV[4]: task_id
 # ARGV[5]: build_id
 # ARGV[6]: chroot
-acquire_vm_lua = """
+# ARGV[7]: max number of VMs in use by one user in the group
+# ARGV[8]: unixtime when the lease expires unless renewed
+acquire_vm_lua = set_vm_state_lua_function + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "ready"  then
     return nil
 else
+    local used_by_user = tonumber(redis.call("HGET", KEYS[3], ARGV[1])) or 0
+    if used_by_user >= tonumber(ARGV[7]) then
+        return "user_limit"
+    end
+
     local last_health_check = tonumber(redis.call("HGET", KEYS[1], "last_health_check"))
     local server_restart_time = tonumber(redis.call("HGET", KEYS[2], "server_start_timestamp"))
     if last_health_check and server_restart_time and last_health_check > server_restart_time  then
-        redis.call("HMSET", KEYS[1], "state", "in_use", "bound_to_user", ARGV[1],
+        set_vm_state(KEYS[1], "in_use")
+        redis.call("HMSET", KEYS[1], "bound_to_user", ARGV[1],
                    "used_by_pid", ARGV[2], "in_use_since", ARGV[3],
-                   "task_id",  ARGV[4], "build_id", ARGV[5], "chroot", ARGV[6])
+                   "task_id",  ARGV[4], "build_id", ARGV[5], "chroot", ARGV[6],
+                   "lease_expires", ARGV[8])
+        redis.call("HINCRBY", KEYS[3], ARGV[1], 1)
         return "OK"
     else
         return nil
@@ -60,29 +73,64 @@ end
 """
 
 # KEYS[1]: VMD key
+# KEYS[2]: user usage key of the VM group
 # ARGV[1] current timestamp for `last_release`
-release_vm_lua = """
+release_vm_lua = set_vm_state_lua_function + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state ~= "in_use" then
     return nil
 else
-    redis.call("HMSET", KEYS[1], "state", "ready", "last_release", ARGV[1])
-    redis.call("HDEL", KEYS[1], "in_use_since", "used_by_pid", "task_id", "build_id", "chroot")
+    local user = redis.call("HGET", KEYS[1], "bound_to_user")
+    if user and redis.call("HINCRBY", KEYS[2], user, -1) <= 0 then
+        redis.call("HDEL", KEYS[2], user)
+    end
+
+    -- mock root and dnf caches of the chroot stay on the VM
+    local chroot = redis.call("HGET", KEYS[1], "chroot")
+    if chroot and chroot ~= "None" then
+        local warm = redis.call("HGET", KEYS[1], "warm_chroots") or ""
+        if not string.find(" " .. warm .. " ", " " .. chroot .. " ", 1, true) then
+            if warm == "" then
+                warm = chroot
+            else
+                warm = warm .. " " .. chroot
+            end
+            redis.call("HSET", KEYS[1], "warm_chroots", warm)
+        end
+    end
+
+    redis.call("HSET", KEYS[1], "last_release", ARGV[1])
+    redis.call("HDEL", KEYS[1], "in_use_since", "used_by_pid", "task_id", "build_id", "chroot",
+               "lease_expires")
     redis.call("HINCRBY", KEYS[1], "builds_count", 1)
 
     local check_fails = tonumber(redis.call("HGET", KEYS[1], "check_fails"))
     if check_fails > 0 then
-        redis.call("HSET", KEYS[1], "state", "check_health_failed")
+        set_vm_state(KEYS[1], "check_health_failed")
+    else
+        set_vm_state(KEYS[1], "ready")
     end
 
     return "OK"
 end
 """
 
+# KEYS[1]: VMD key
+# ARGV[1]: task_id the VM was acquired for
+# ARGV[2]: new unixtime of the lease expiration
+renew_lease_lua = """
+local vmd = redis.call("HMGET", KEYS[1], "state", "task_id")
+if vmd[1] == "in_use" and vmd[2] == ARGV[1] then
+    redis.call("HSET", KEYS[1], "lease_expires", ARGV[2])
+    return "OK"
+end
+"""
+
 # KEYS [1]: VMD key
+# KEYS [2]: user usage key of the VM group
 # ARGS [1]: allowed_pre_state
 # ARGS [2]: timestamp for `terminating_since`
-terminate_vm_lua = """
+terminate_vm_lua = set_vm_state_lua_function + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 
 if old_state == "in_use" and ARGV[1] ~= "in_use" then
@@ -94,19 +142,70 @@ if ARGV[1] and ARGV[1] ~= "None" and old_state ~= ARGV[1] then
 elseif old_state == "terminating" and ARGV[1] ~= "terminating" then
     return "Already terminating"
 else
-    redis.call("HMSET", KEYS[1], "state", "terminating", "terminating_since", ARGV[2])
+    if old_state == "in_use" then
+        local user = redis.call("HGET", KEYS[1], "bound_to_user")
+        if user and redis.call("HINCRBY", KEYS[2], user, -1) <= 0 then
+            redis.call("HDEL", KEYS[2], user)
+        end
+    end
+
+    set_vm_state(KEYS[1], "terminating")
+    redis.call("HSET", KEYS[1], "terminating_since", ARGV[2])
     return "OK"
 end
 """
 
-mark_vm_check_failed_lua = """
+mark_vm_check_failed_lua = set_vm_state_lua_function + """
 local old_state = redis.call("HGET", KEYS[1], "state")
 if old_state == "check_health" then
-    redis.call("HMSET", KEYS[1], "state", "check_health_failed")
+    set_vm_state(KEYS[1], "check_health_failed")
     return "OK"
 end
 """
 
+# KEYS[1]: VM pool key of the group
+# ARGV[1]: group
+# ARGV[2..]: all VM states
+# IP index sets are shared by the groups, stale members are skipped by lookup
+rebuild_state_index_lua = set_vm_state_lua_function + """
+for i = 2, #ARGV do
+    redis.call("DEL", state_index_key(ARGV[1], ARGV[i]))
+end
+for _, vm_name in ipairs(redis.call("SMEMBERS", KEYS[1])) do
+    local vmd = redis.call("HMGET", string.format("%s", vm_name), "state", "vm_ip")
+    if vmd[1] then
+        redis.call("SADD", state_index_key(ARGV[1], vmd[1]), vm_name)
+        schedule_vm_now(vm_name)
+    end
+    if vmd[2] then
+        redis.call("SADD", string.format("%s", vmd[2]), vm_name)
+    end
+end
+""" % (KEY_VM_INSTANCE.format(vm_name="%s"), KEY_VM_IP_INDEX.format(vm_ip="%s"))
+
+# KEYS[1]: VM schedule key
+# ARGV: pairs of vm_name, unixtime
+# keeps the earlier time when the VM is already scheduled
+schedule_vms_lua = """
+for i = 1, #ARGV, 2 do
+    local current = redis.call("ZSCORE", KEYS[1], ARGV[i])
+    if not current or tonumber(current) > tonumber(ARGV[i + 1]) then
+        redis.call("ZADD", KEYS[1], ARGV[i + 1], ARGV[i])
+    end
+end
+"""
+
+# KEYS[1]: VM schedule key
+# ARGV[1]: current unixtime
+# removes and returns names of VMs which are due
+pop_due_vms_lua = """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+for _, vm_name in ipairs(due) do
+    redis.call("ZREM", KEYS[1], vm_name)
+end
+return due
+"""
+
 
 class VmManager(object):
     """
@@ -134,8 +233,12 @@ class VmManager(object):
         self.lua_scripts["set_checking_state"] = self.rc.register_script(set_checking_state_lua)
         self.lua_scripts["acquire_vm"] = self.rc.register_script(acquire_vm_lua)
         self.lua_scripts["release_vm"] = self.rc.register_script(release_vm_lua)
+        self.lua_scripts["renew_lease"] = self.rc.register_script(renew_lease_lua)
         self.lua_scripts["terminate_vm"] = self.rc.register_script(terminate_vm_lua)
         self.lua_scripts["mark_vm_check_failed"] = self.rc.register_script(mark_vm_check_failed_lua)
+        self.lua_scripts["rebuild_state_index"] = self.rc.register_script(rebuild_state_index_lua)
+        self.lua_scripts["schedule_vms"] = self.rc.register_script(schedule_vms_lua)
+        self.lua_scripts["pop_due_vms"] = self.rc.register_script(pop_due_vms_lua)
 
     def set_logger(self, logger):
         """
@@ -171,6 +274,9 @@ class VmManager(object):
         pipe = self.rc.pipeline()
         pipe.sadd(KEY_VM_POOL.format(group=group), vm_name)
         pipe.hmset(KEY_VM_INSTANCE.format(vm_name=vm_name), vmd.to_dict())
+        pipe.sadd(KEY_VM_STATE_INDEX.format(group=group, state=vmd.state), vm_name)
+        pipe.sadd(KEY_VM_IP_INDEX.format(vm_ip=vm_ip), vm_name)
+        pipe.zadd(KEY_VM_SCHEDULE, 0, vm_name)
         pipe.execute()
         self.log.info("registered new VM: {} {}".format(vmd.vm_name, vmd.vm_ip))
         return vmd
@@ -181,8 +287,9 @@ class VmManager(object):
         :return: List of found VMD with the give ip
         :rtype: list of VmDescriptor
         """
+        vm_name_list = self.rc.smembers(KEY_VM_IP_INDEX.format(vm_ip=vm_ip))
         return [
-            vmd for vmd in self.get_all_vm()
+            vmd for vmd in self._load_multi_safe(vm_name_list)
             if vmd.vm_ip == vm_ip
         ]
 
@@ -192,23 +299,56 @@ class VmManager(object):
 
     def mark_server_start(self):
         self.rc.hset(KEY_SERVER_INFO, "server_start_timestamp", time.time())
+        # no VM can be acquired until it passes a health check after the server start,
+        # so the counters can't change meanwhile
+        for group in self.vm_groups:
+            self.rebuild_state_index(group)
+            self.recount_user_usage(group)
+
+    def rebuild_state_index(self, group):
+        """
+        Recreate the state index sets of the group from the VM descriptors
+        and add its VMs to the IP index, lua scripts changing VM state and
+        :py:meth:`VmDescriptor.store_field` keep them up to date afterwards.
+        Every VM of the group is scheduled for VmMaster immediately.
+        """
+        self.lua_scripts["rebuild_state_index"](
+            keys=[KEY_VM_POOL.format(group=group)],
+            args=[group] + [getattr(VmStates, attr) for attr in dir(VmStates)
+                            if not attr.startswith("_")])
+
+    def recount_user_usage(self, group):
+        """
+        Set per-user counters of VMs in use from the VM descriptors,
+        lua scripts keep them up to date afterwards.
+        """
+        usage = {}
+        for vmd in self.get_all_vm_in_group(group):
+            if vmd.state == VmStates.IN_USE and vmd.bound_to_user:
+                usage[vmd.bound_to_user] = usage.get(vmd.bound_to_user, 0) + 1
+
+        usage_key = KEY_VM_USER_USAGE.format(group=group)
+        pipe = self.rc.pipeline()
+        pipe.delete(usage_key)
+        if usage:
+            pipe.hmset(usage_key, usage)
+        pipe.execute()
+
+    def get_user_usage(self, group):
+        """
+        :return dict: username -> number of VMs in use in the group
+        """
+        usage = self.rc.hgetall(KEY_VM_USER_USAGE.format(group=group))
+        return {user: int(count) for user, count in usage.items()}
 
     def can_user_acquire_more_vm(self, username, group):
         """
+        Quick check of the user limit, authoritative one is done by `acquire_vm` lua script
+
         :return bool: True when user are allowed to acquire more VM
         """
-        vmd_list = self.get_all_vm_in_group(group)
-        vm_count_used_by_user = len([
-            vmd for vmd in vmd_list if
-            vmd.bound_to_user == username and vmd.state == VmStates.IN_USE
-        ])
-        self.log.debug("# vm by user: {}, limit:{} ".format(
-            vm_count_used_by_user, self.opts.build_groups[group]["max_vm_per_user"]
-        ))
+        vm_count_used_by_user = int(self.rc.hget(KEY_VM_USER_USAGE.format(group=group), username) or 0)
         if vm_count_used_by_user >= self.opts.build_groups[group]["max_vm_per_user"]:
-            # TODO: this check isn't reliable, if two (or more) processes check VM list
-            # at the +- same time, they could acquire more VMs
-            #  proper solution: do this check inside lua script
             self.log.debug("No VM are available, user `{}` already acquired #{} VMs"
                            .format(username, vm_count_used_by_user))
             return False
@@ -222,31 +362,39 @@ class VmManager(object):
         :param group: builder group id, as defined in config
         :type group: int
         :param username: build owner username, VMM prefer to reuse an existing VM which was used by the same user
-        :param pid: builder pid to release VM after build process unhandled death
+        :param pid: pid of the acquiring process, informational only, the VM is
+            reclaimed when its lease isn't renewed, see :py:meth:`renew_vm_lease`
+        :param chroot: VMs of the user with warm caches for the chroot are preferred
 
         :rtype: VmDescriptor
         :raises: NoVmAvailable  when manager couldn't find suitable VM for the given group and user
         """
-        vmd_list = self.get_all_vm_in_group(group)
         if not self.can_user_acquire_more_vm(username, group):
             raise NoVmAvailable("No VM are available, user `{}` already acquired too much VMs"
                                 .format(username))
 
-        ready_vmd_list = [vmd for vmd in vmd_list if vmd.state == VmStates.READY]
+        ready_vmd_list = self.get_vm_by_group_and_state_list(group, [VmStates.READY])
         # trying to find VM used by this user
         dirtied_by_user = [vmd for vmd in ready_vmd_list if vmd.bound_to_user == username]
+        dirtied_by_user.sort(key=lambda vmd: not vmd.is_warm_for(chroot))
         clean_list = [vmd for vmd in ready_vmd_list if vmd.bound_to_user is None]
         all_vms = list(chain(dirtied_by_user, clean_list))
 
         for vmd in all_vms:
-            if vmd.get_field(self.rc, "check_fails") != "0":
+            if vmd.check_fails != "0":
                 self.log.debug("VM {} has check fails, skip acquire".format(vmd.vm_name))
             vm_key = KEY_VM_INSTANCE.format(vm_name=vmd.vm_name)
-            if self.lua_scripts["acquire_vm"](keys=[vm_key, KEY_SERVER_INFO],
-                                              args=[username, pid, time.time(),
-                                                    task_id, build_id, chroot]) == "OK":
+            lua_result = self.lua_scripts["acquire_vm"](
+                keys=[vm_key, KEY_SERVER_INFO, KEY_VM_USER_USAGE.format(group=group)],
+                args=[username, pid, time.time(), task_id, build_id, chroot,
+                      self.opts.build_groups[group]["max_vm_per_user"],
+                      time.time() + self.opts.vm_lease_timeout])
+            if lua_result == "OK":
                 self.log.info("Acquired VM :{} {} for pid: {}".format(vmd.vm_name, vmd.vm_ip, pid))
                 return vmd
+            elif lua_result == "user_limit":
+                raise NoVmAvailable("No VM are available, user `{}` already acquired too much VMs"
+                                    .format(username))
         else:
             raise NoVmAvailable("No VM are available, please wait in queue. Group: {}".format(group))
 
@@ -259,10 +407,49 @@ class VmManager(object):
         # in_use -> ready
         self.log.info("Releasing VM {}".format(vm_name))
         vm_key = KEY_VM_INSTANCE.format(vm_name=vm_name)
-        lua_result = self.lua_scripts["release_vm"](keys=[vm_key], args=[time.time()])
+        usage_key = KEY_VM_USER_USAGE.format(group=self.rc.hget(vm_key, "group"))
+        lua_result = self.lua_scripts["release_vm"](keys=[vm_key, usage_key], args=[time.time()])
         self.log.debug("release vm result `{}`".format(lua_result))
         return lua_result == "OK"
 
+    def renew_vm_lease(self, vm_name, task_id):
+        """
+        Prolong the lease of the VM acquired for the task by `vm_lease_timeout`.
+        Builder processes have to renew the lease periodically, VmMaster
+        reclaims VMs with expired lease.
+
+        :return: False if the VM isn't used by the task anymore
+        :rtype: bool
+        """
+        vm_key = KEY_VM_INSTANCE.format(vm_name=vm_name)
+        lua_result = self.lua_scripts["renew_lease"](
+            keys=[vm_key], args=[task_id, time.time() + self.opts.vm_lease_timeout])
+        return lua_result == "OK"
+
+    def interrupt_build(self, build_id, chroot=None):
+        """
+        Ask the builders running the build to stop it, the workers then
+        release their VMs. Canceled tasks are also flagged in redis for the
+        builders which didn't subscribe to the interruptions yet.
+
+        :param chroot: interrupt only this chroot of the build
+        :return: number of interrupted VMs
+        """
+        interrupted = 0
+        for vmd in self.get_vm_by_group_and_state_list(None, [VmStates.IN_USE]):
+            if str(getattr(vmd, "build_id", None)) != str(build_id):
+                continue
+            if chroot is not None and getattr(vmd, "chroot", None) != chroot:
+                continue
+
+            self.log.info("Interrupting build {} on VM {}".format(build_id, vmd.vm_name))
+            task_id = getattr(vmd, "task_id", None)
+            if task_id:
+                self.rc.set(KEY_BUILD_CANCELED.format(task_id=task_id), 1, ex=BUILD_CANCELED_TTL)
+            self.rc.publish(PUBSUB_INTERRUPT_BUILDER.format(vmd.vm_ip), INTERRUPT_BUILD_CANCELED)
+            interrupted += 1
+        return interrupted
+
     def start_vm_termination(self, vm_name, allowed_pre_state=None):
         """
         Initiate VM termination process using redis publish.
@@ -271,7 +458,9 @@ class VmManager(object):
         :type allowed_pre_state: str constant from VmState
         """
         vmd = self.get_vm_by_name(vm_name)
-        lua_result = self.lua_scripts["terminate_vm"](keys=[vmd.vm_key], args=[allowed_pre_state, time.time()])
+        lua_result = self.lua_scripts["terminate_vm"](
+            keys=[vmd.vm_key, KEY_VM_USER_USAGE.format(group=vmd.group)],
+            args=[allowed_pre_state, time.time()])
         if lua_result == "OK":
             msg = {
                 "group": vmd.group,
@@ -298,16 +487,27 @@ class VmManager(object):
             raise VmError("VM should have `terminating` state to be removable")
         pipe = self.rc.pipeline()
         pipe.srem(KEY_VM_POOL.format(group=vmd.group), vm_name)
+        pipe.srem(KEY_VM_STATE_INDEX.format(group=vmd.group, state=VmStates.TERMINATING), vm_name)
+        pipe.srem(KEY_VM_IP_INDEX.format(vm_ip=vmd.vm_ip), vm_name)
+        pipe.zrem(KEY_VM_SCHEDULE, vm_name)
         pipe.delete(KEY_VM_INSTANCE.format(vm_name=vm_name))
         pipe.execute()
         self.log.info("removed vm `{}` from pool".format(vm_name))
 
     def _load_multi_safe(self, vm_name_list):
-        result = []
+        """
+        Load VM descriptors using one round trip to redis
+        """
+        vm_name_list = list(vm_name_list)
+        pipe = self.rc.pipeline(transaction=False)
         for vm_name in vm_name_list:
-            try:
-                result.append(VmDescriptor.load(self.rc, vm_name))
-            except VmDescriptorNotFound:
+            pipe.hgetall(KEY_VM_INSTANCE.format(vm_name=vm_name))
+
+        result = []
+        for vm_name, raw in zip(vm_name_list, pipe.execute()):
+            if raw:
+                result.append(VmDescriptor.from_dict(raw))
+            else:
                 self.log.debug("Failed to load VMD: {}".format(vm_name))
         return result
 
@@ -322,10 +522,42 @@ class VmManager(object):
         """
         :rtype: list of VmDescriptor
         """
-        vmd_list = []
+        pipe = self.rc.pipeline(transaction=False)
         for group in self.vm_groups:
-            vmd_list.extend(self.get_all_vm_in_group(group))
-        return vmd_list
+            pipe.smembers(KEY_VM_POOL.format(group=group))
+        return self._load_multi_safe(chain.from_iterable(pipe.execute()))
+
+    def get_vm_list_by_name(self, vm_name_list):
+        """
+        :return: VMs which still exist
+        :rtype: list of VmDescriptor
+        """
+        return self._load_multi_safe(vm_name_list)
+
+    def schedule_vms(self, schedule):
+        """
+        Schedule VMs for VmMaster, earlier time wins if a VM is already scheduled
+
+        :param dict schedule: vm_name -> unixtime
+        """
+        if schedule:
+            self.lua_scripts["schedule_vms"](keys=[KEY_VM_SCHEDULE],
+                                             args=list(chain.from_iterable(schedule.items())))
+
+    def pop_due_vms(self, now):
+        """
+        Take VMs scheduled at `now` or earlier out of the schedule
+
+        :rtype: list of str
+        """
+        return self.lua_scripts["pop_due_vms"](keys=[KEY_VM_SCHEDULE], args=[now])
+
+    def get_next_vm_due(self):
+        """
+        :return: unixtime when the next VM is scheduled or None
+        """
+        first = self.rc.zrange(KEY_VM_SCHEDULE, 0, 0, withscores=True)
+        return first[0][1] if first else None
 
     def get_vm_by_name(self, vm_name):
         """
@@ -344,11 +576,16 @@ class VmManager(object):
         :rtype: list of VmDescriptor
         """
         states = set(state_list)
-        if group is None:
-            vmd_list = self.get_all_vm()
-        else:
-            vmd_list = self.get_all_vm_in_group(group)
-        return [vmd for vmd in vmd_list if vmd.state in states]
+        groups = self.vm_groups if group is None else [group]
+
+        pipe = self.rc.pipeline(transaction=False)
+        for group_id in groups:
+            for state in states:
+                pipe.smembers(KEY_VM_STATE_INDEX.format(group=group_id, state=state))
+        vm_name_list = set(chain.from_iterable(pipe.execute()))
+
+        # the index might change between reads, so check the loaded state
+        return [vmd for vmd in self._load_multi_safe(vm_name_list) if vmd.state in states]
 
     def info(self):
         """
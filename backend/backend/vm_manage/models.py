@@ -1,10 +1,43 @@
 # coding: utf-8
 
 from pprint import pformat
-from . import KEY_VM_INSTANCE
+from . import KEY_VM_INSTANCE, KEY_VM_STATE_INDEX, KEY_VM_SCHEDULE, KEY_VM_IP_INDEX
 from backend.exceptions import VmDescriptorNotFound
 
 
+# Lua function which changes VM state together with the state index sets
+# and schedules the VM for VmMaster, every lua script changing the VM state
+# should include it and use `set_vm_state(vmd_key, state)` instead of HSET.
+# Index keys are composed inside the script, so redis cluster isn't supported.
+set_vm_state_lua_function = """
+local function state_index_key(group, state)
+    return string.format("%s", group, state)
+end
+
+local function schedule_vm_now(vm_name)
+    redis.call("ZADD", "%s", 0, vm_name)
+end
+
+local function set_vm_state(vmd_key, new_state)
+    local vmd = redis.call("HMGET", vmd_key, "state", "group", "vm_name")
+    if vmd[2] and vmd[3] then
+        if vmd[1] then
+            redis.call("SREM", state_index_key(vmd[2], vmd[1]), vmd[3])
+        end
+        redis.call("SADD", state_index_key(vmd[2], new_state), vmd[3])
+        schedule_vm_now(vmd[3])
+    end
+    redis.call("HSET", vmd_key, "state", new_state)
+end
+""" % (KEY_VM_STATE_INDEX.format(group="%s", state="%s"), KEY_VM_SCHEDULE)
+
+# KEYS[1]: VMD key
+# ARGV[1]: new state
+set_vm_state_lua = set_vm_state_lua_function + """
+set_vm_state(KEYS[1], ARGV[1])
+"""
+
+
 class VmDescriptor(object):
     def __init__(self, vm_ip, vm_name, group, state):
         self.vm_ip = vm_ip
@@ -26,6 +59,14 @@ class VmDescriptor(object):
     def vm_key(self):
         return KEY_VM_INSTANCE.format(vm_name=self.vm_name)
 
+    def is_warm_for(self, chroot):
+        """
+        :return: True when a build of the `chroot` already ran on the VM,
+            so mock root and dnf caches of the chroot are there
+        """
+        warm_chroots = getattr(self, "warm_chroots", None) or ""
+        return chroot is not None and chroot in warm_chroots.split()
+
     def __str__(self):
         return pformat(self.__dict__)
 
@@ -56,7 +97,22 @@ class VmDescriptor(object):
         """
         :type rc: StrictRedis
         """
-        rc.hmset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), self.__dict__)
+        fields = dict(self.__dict__)
+        # state goes last, the index update needs to see the previous one
+        fields.pop("state")
+        self._update_ip_index(rc, self.vm_ip)
+        rc.hmset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), fields)
+        rc.register_script(set_vm_state_lua)(keys=[self.vm_key], args=[self.state])
+
+    def _update_ip_index(self, rc, new_ip):
+        old_ip = rc.hget(self.vm_key, "vm_ip")
+        if old_ip == new_ip:
+            return
+        pipe = rc.pipeline()
+        if old_ip is not None:
+            pipe.srem(KEY_VM_IP_INDEX.format(vm_ip=old_ip), self.vm_name)
+        pipe.sadd(KEY_VM_IP_INDEX.format(vm_ip=new_ip), self.vm_name)
+        pipe.execute()
 
     def store_field(self, rc, field, value):
         """
@@ -64,7 +120,12 @@ class VmDescriptor(object):
         """
         # TODO: add option `save_with_existnse_check`, use lua script to ensure that VMD still exists
         setattr(self, field, value)
-        rc.hset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), field, value)
+        if field == "state":
+            rc.register_script(set_vm_state_lua)(keys=[self.vm_key], args=[value])
+        else:
+            if field == "vm_ip":
+                self._update_ip_index(rc, value)
+            rc.hset(KEY_VM_INSTANCE.format(vm_name=self.vm_name), field, value)
 
     def get_field(self, rc, field):
         """
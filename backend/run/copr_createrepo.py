@@ -16,7 +16,7 @@ log = logging.getLogger(__name__)
 
 sys.path.append("/usr/share/copr/")
 
-from backend.createrepo import createrepo
+from backend.createrepo import createrepo, get_state_dir
 from backend.helpers import SortedOptParser, BackendConfigReader
 
 
@@ -55,7 +55,8 @@ def main(args):
             path = os.path.join(project_path, subdir)
             log.info("entering dir: {}".format(subdir))
             createrepo(path=path, front_url=front_url,
-                       username=cli_opts.user, projectname=cli_opts.project)
+                       username=cli_opts.user, projectname=cli_opts.project,
+                       state_dir=get_state_dir(opts, path))
             log.info("done dir: {}".format(subdir))
     log.info("finished processing {}/{}".format(cli_opts.user, cli_opts.project))
 
@@ -15,7 +15,7 @@ import pwd
 sys.path.append("/usr/share/copr/")
 from backend.helpers import BackendConfigReader
 from backend.sign import get_pubkey, unsign_rpms_in_dir, sign_rpms_in_dir, create_user_keys, create_gpg_email
-from backend.createrepo import createrepo_unsafe, add_appdata
+from backend.createrepo import createrepo_unsafe, add_appdata, get_state_dir
 
 logging.basicConfig(
     filename="/var/log/copr-backend/fix_gpg.log",
@@ -77,7 +77,7 @@ def fix_copr(opts, copr_full_name):
         createrepo_unsafe(dir_path)
 
         log.info("> > Running add_appdata for {}".format(dir_path))
-        add_appdata(dir_path, owner, coprname)
+        add_appdata(dir_path, owner, coprname, state_dir=get_state_dir(opts, dir_path))
 
 
 def main():
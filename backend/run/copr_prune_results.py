@@ -20,7 +20,8 @@ from copr.exceptions import CoprRequestException
 sys.path.append("/usr/share/copr/")
 
 from backend.helpers import BackendConfigReader
-from backend.helpers import get_auto_createrepo_status,get_persistent_status
+from backend.helpers import ProjectFlagsCache
+from backend.createrepo import record_changes, get_state_dir
 
 DEF_DAYS = 14
 
@@ -61,6 +62,7 @@ class Pruner(object):
     def __init__(self, opts):
         self.opts = opts
         self.prune_days = getattr(self.opts, "prune_days", DEF_DAYS)
+        self.project_flags = ProjectFlagsCache(self.opts)
 
     def run(self):
         results_dir = self.opts.destdir
@@ -84,11 +86,11 @@ class Pruner(object):
         loginfo("Going to prune {}/{}".format(username, projectname))
 
         try:
-            if not get_auto_createrepo_status(self.opts.frontend_base_url, username, projectname):
+            if not self.project_flags.get(username, projectname, "auto_createrepo"):
                 loginfo("Skipped {}/{} since auto createrepo option is disabled"
                           .format(username, projectname))
                 return
-            if get_persistent_status(self.opts.frontend_base_url, username, projectname):
+            if self.project_flags.get(username, projectname, "persistent"):
                 loginfo("Skipped {}/{} since the project is persistent"
                           .format(username, projectname))
                 return
@@ -114,6 +116,9 @@ class Pruner(object):
                 logexception(err)
                 logerror("Error pruning chroot {}/{}:{}".format(username, projectname, sub_dir_name))
 
+            # prunerepo removes rpms behind the back of the incremental createrepo
+            record_changes(chroot_path, "createrepo", state_dir=get_state_dir(self.opts, chroot_path))
+
             loginfo("Pruning done for chroot {}/{}:{}".format(username, projectname, sub_dir_name))
 
         loginfo("Pruning finished for project {}/{}".format(username, projectname))
@@ -27,7 +27,7 @@ sys.path.append("/usr/share/copr/")
 from backend.helpers import BackendConfigReader, create_file_logger
 from backend.sign import get_pubkey, sign_rpms_in_dir, create_user_keys
 from backend.exceptions import CoprSignNoKeyError
-from backend.createrepo import createrepo
+from backend.createrepo import createrepo, get_state_dir
 
 
 def check_signed_rpms_in_pkg_dir(pkg_dir, user, project, chroot, chroot_dir, opts):
@@ -47,6 +47,7 @@ def check_signed_rpms_in_pkg_dir(pkg_dir, user, project, chroot, chroot_dir, opt
             base_url=base_url,
             username=user,
             projectname=project,
+            state_dir=get_state_dir(opts, chroot_dir),
         )
 
     except Exception as err:
@@ -25,7 +25,7 @@ done
 # tests/mockremote/test_mockremote.py that are currently failing due to complete code rewrite
 # TODO: prune tests (case-by-case) that are no longer relevant. We mostly rely on
 # integration & regression tests now.
-TESTS="tests/test_createrepo.py tests/test_frontend.py tests/test_helpers.py tests/test_sign.py"
+TESTS="tests/test_createrepo.py tests/test_frontend.py tests/test_helpers.py tests/test_sign.py tests/daemons/test_worker_pool.py tests/vm_manager/test_autoscale.py tests/test_rpmheader.py tests/test_journal.py tests/daemons/test_vm_master.py"
 
 if [[ -n $@ ]]; then
 	TESTS=$@
@@ -25,7 +25,6 @@ from backend.helpers import get_redis_connection
 from backend.vm_manage import VmStates
 from backend.vm_manage.manager import VmManager
 from backend.daemons.vm_master import VmMaster
-from backend.constants import JOB_GRAB_TASK_END_PUBSUB
 from backend.exceptions import VmError, VmSpawnLimitReached
 
 
@@ -51,11 +50,6 @@ def mc_time():
     with mock.patch("{}.time".format(MODULE_REF)) as handle:
         yield handle
 
-@pytest.yield_fixture
-def mc_psutil():
-    with mock.patch("{}.psutil".format(MODULE_REF)) as handle:
-        yield handle
-
 @pytest.yield_fixture
 def mc_setproctitle():
     with mock.patch("{}.setproctitle".format(MODULE_REF)) as handle:
@@ -112,6 +106,7 @@ class TestVmMaster(object):
             fedmsg_enabled=False,
             sleeptime=0.1,
             vm_cycle_timeout=10,
+            vm_lease_timeout=120,
 
 
         )
@@ -179,7 +174,11 @@ class TestVmMaster(object):
     def test_pass(self, add_vmd):
         pass
 
-    def test_remove_old_dirty_vms(self, mc_time, add_vmd):
+    def check_vms(self, check, states):
+        for vmd in self.vmm.get_vm_by_group_and_state_list(None, states):
+            check(vmd)
+
+    def test_check_one_dirty_vm(self, mc_time, add_vmd):
         # pass
         self.vmm.start_vm_termination = types.MethodType(MagicMock(), self.vmm)
         # VM in ready state, with not empty bount_to_user and (NOW - last_release) > threshold
@@ -198,78 +197,48 @@ class TestVmMaster(object):
 
         mc_time.time.return_value = 1
         # no vm terminated
-        self.vm_master.remove_old_dirty_vms()
+        self.check_vms(self.vm_master.check_one_dirty_vm, [VmStates.READY])
         assert not self.vmm.start_vm_termination.called
 
         mc_time.time.return_value = self.opts.build_groups[0]["vm_dirty_terminating_timeout"] + 1
 
         # only "a1" and "b1" should be terminated
-        self.vm_master.remove_old_dirty_vms()
+        self.check_vms(self.vm_master.check_one_dirty_vm, [VmStates.READY])
         assert self.vmm.start_vm_termination.called
         terminated_names = set([call[0][1] for call
                                in self.vmm.start_vm_termination.call_args_list])
         assert set(["a1", "b1"]) == terminated_names
 
-    def disabled_test_remove_vm_with_dead_builder(self, mc_time, add_vmd, mc_psutil):
-        # todo: re-enable after psutil.Process.cmdline will be in use
-        mc_time.time.return_value = time.time()
+    def test_check_one_vm_for_dead_builder(self, mc_time, add_vmd):
+        mc_time.time.return_value = 1000
         self.vm_master.log = MagicMock()
 
         self.vmm.start_vm_termination = MagicMock()
         self.vmm.start_vm_termination.return_value = "OK"
 
-        for idx, vmd in enumerate([self.vmd_a1, self.vmd_a2,
-                                   self.vmd_b1, self.vmd_b2, self.vmd_b3]):
+        for vmd in [self.vmd_a1, self.vmd_a2, self.vmd_b1, self.vmd_b2]:
             vmd.store_field(self.rc, "state", VmStates.IN_USE)
-            vmd.store_field(self.rc, "chroot", "fedora-20-x86_64")
-            vmd.store_field(self.rc, "task_id", "{}-fedora-20-x86_64".format(idx + 1))
-            vmd.store_field(self.rc, "build_id", idx + 1)
-            vmd.store_field(self.rc, "in_use_since", 0)
-
-        self.rc.hdel(self.vmd_b3.vm_key, "chroot")
-
-        for idx, vmd in enumerate([self.vmd_a1, self.vmd_a2, self.vmd_b2, self.vmd_b3]):
-            vmd.store_field(self.rc, "used_by_pid", idx + 1)
-
-        for vmd in [self.vmd_a3, self.vmd_a3]:
-            vmd.store_field(self.rc, "state", VmStates.READY)
+            vmd.store_field(self.rc, "in_use_since", 500)
+
+        # renewed lease
+        self.vmd_a1.store_field(self.rc, "lease_expires", 1050)
+        # expired lease
+        self.vmd_a2.store_field(self.rc, "lease_expires", 999)
+        # acquired without lease, falls back to in_use_since
+        self.vmd_b2.store_field(self.rc, "in_use_since", 950)
+        self.vmd_a3.store_field(self.rc, "state", VmStates.READY)
 
-        def mc_psutil_process(pid):
-            p = MagicMock()
-            mapping = {
-                "1": "a1",
-                "2": "a2",
-                "3": "b1",
-                "4": "None",
-                "5": "None",
-            }
-            p.cmdline = ["builder vm_name={} suffix".format(mapping.get(str(pid))),]
-            return p
-
-        def mc_psutil_pid_exists(pid):
-            if str(pid) in ["1", "4"]:
-                return True
-
-            return False
-
-        mc_psutil.Process.side_effect = mc_psutil_process
-        mc_psutil.pid_exists.side_effect = mc_psutil_pid_exists
-
-        self.ps = self.vmm.rc.pubsub(ignore_subscribe_messages=True)
-        self.ps.subscribe(JOB_GRAB_TASK_END_PUBSUB)
-        self.vm_master.remove_vm_with_dead_builder()
-
-        msg_list = self.rcv_from_ps_message_bus()
-        assert self.vmm.start_vm_termination.call_args_list == [
-            mock.call('a2', allowed_pre_state='in_use'),
-            mock.call('b2', allowed_pre_state='in_use'),
-            mock.call('b3', allowed_pre_state='in_use')
-        ]
-        # changed logic for the moment
-        # assert set(["2", "4"]) == set([json.loads(m["data"])["build_id"] for m in msg_list])
+        self.check_vms(self.vm_master.check_one_vm_for_dead_builder, [VmStates.IN_USE])
+        terminated = set(call[0][0] for call in self.vmm.start_vm_termination.call_args_list)
+        assert terminated == set(["a2", "b1"])
+        assert all(call[1] == {"allowed_pre_state": VmStates.IN_USE}
+                   for call in self.vmm.start_vm_termination.call_args_list)
 
-    def test_check_vms_health(self, mc_time, add_vmd):
+    def test_check_one_vm_health(self, mc_time, add_vmd):
         self.vm_master.start_vm_check = types.MethodType(MagicMock(), self.vmm)
+        # VmMaster.check_one_vm checks health of VMs in these states
+        states_to_check = [VmStates.CHECK_HEALTH_FAILED, VmStates.READY,
+                           VmStates.GOT_IP, VmStates.IN_USE]
         for vmd in [self.vmd_a1, self.vmd_a2, self.vmd_a3, self.vmd_b1, self.vmd_b2, self.vmd_b3]:
             vmd.store_field(self.rc, "last_health_check", 0)
 
@@ -281,11 +250,11 @@ class TestVmMaster(object):
         self.vmd_b3.store_field(self.rc, "state", VmStates.TERMINATING)
 
         mc_time.time.return_value = 1
-        self.vm_master.check_vms_health()
+        self.check_vms(self.vm_master.check_one_vm_health, states_to_check)
         assert not self.vm_master.start_vm_check.called
 
         mc_time.time.return_value = 1 + self.opts.build_groups[0]["vm_health_check_period"]
-        self.vm_master.check_vms_health()
+        self.check_vms(self.vm_master.check_one_vm_health, states_to_check)
         to_check = set(call[0][1] for call in self.vm_master.start_vm_check.call_args_list)
         assert set(['a1', 'a3', 'b1', 'b2']) == to_check
 
@@ -293,11 +262,11 @@ class TestVmMaster(object):
         for vmd in [self.vmd_a1, self.vmd_a2, self.vmd_a3, self.vmd_b1, self.vmd_b2, self.vmd_b3]:
             self.rc.hdel(vmd.vm_key, "last_health_check")
 
-        self.vm_master.check_vms_health()
+        self.check_vms(self.vm_master.check_one_vm_health, states_to_check)
         to_check = set(call[0][1] for call in self.vm_master.start_vm_check.call_args_list)
         assert set(['a1', 'a3', 'b1', 'b2']) == to_check
 
-    def test_finalize_long_health_checks(self, mc_time, add_vmd):
+    def test_finalize_one_long_health_check(self, mc_time, add_vmd):
 
         mc_time.time.return_value = 0
         self.vmd_a1.store_field(self.rc, "state", VmStates.IN_USE)
@@ -311,11 +280,11 @@ class TestVmMaster(object):
         mc_time.time.return_value = self.opts.build_groups[0]["vm_health_check_max_time"] + 11
 
         self.vmm.mark_vm_check_failed = MagicMock()
-        self.vm_master.finalize_long_health_checks()
+        self.check_vms(self.vm_master.finalize_one_long_health_check, [VmStates.CHECK_HEALTH])
         assert self.vmm.mark_vm_check_failed.called_once
         assert self.vmm.mark_vm_check_failed.call_args[0][0] == "a2"
 
-    def test_terminate_again(self, mc_time, add_vmd):
+    def test_terminate_one_again(self, mc_time, add_vmd):
         mc_time.time.return_value = 0
         self.vmd_a1.store_field(self.rc, "state", VmStates.IN_USE)
         self.vmd_a2.store_field(self.rc, "state", VmStates.CHECK_HEALTH)
@@ -327,7 +296,7 @@ class TestVmMaster(object):
         # case 1 no VM in terminating states =>
         #   no start_vm_termination, no remove_vm_from_pool
         # import ipdb; ipdb.set_trace()
-        self.vm_master.terminate_again()
+        self.check_vms(self.vm_master.terminate_one_again, [VmStates.TERMINATING])
         assert not self.vmm.remove_vm_from_pool.called
         assert not self.vmm.start_vm_termination.called
 
@@ -336,7 +305,7 @@ class TestVmMaster(object):
         self.vmd_a1.store_field(self.rc, "state", VmStates.TERMINATING)
         self.vmd_a1.store_field(self.rc, "terminating_since", 0)
 
-        self.vm_master.terminate_again()
+        self.check_vms(self.vm_master.terminate_one_again, [VmStates.TERMINATING])
         assert not self.vmm.remove_vm_from_pool.called
         assert not self.vmm.start_vm_termination.called
 
@@ -344,7 +313,7 @@ class TestVmMaster(object):
         #   start_vm_termination called, no remove_vm_from_pool
         mc_time.time.return_value = 1 + self.opts.build_groups[0]["vm_terminating_timeout"]
 
-        self.vm_master.terminate_again()
+        self.check_vms(self.vm_master.terminate_one_again, [VmStates.TERMINATING])
         assert not self.vmm.remove_vm_from_pool.called
         assert self.vmm.start_vm_termination.called
         assert self.vmm.start_vm_termination.call_args[0][0] == self.vmd_a1.vm_name
@@ -356,14 +325,14 @@ class TestVmMaster(object):
         mc_time.time.return_value = 1
         self.vmd_a2.store_field(self.rc, "vm_ip", self.vmd_a1.vm_ip)
 
-        self.vm_master.terminate_again()
+        self.check_vms(self.vm_master.terminate_one_again, [VmStates.TERMINATING])
         assert not self.vmm.remove_vm_from_pool.called
         assert not self.vmm.start_vm_termination.called
 
         # case 4: two VM with the same IP, one in terminating states, , time_elapsed > threshold
         #   no start_vm_termination, remove_vm_from_pool
         mc_time.time.return_value = 1 + self.opts.build_groups[0]["vm_terminating_timeout"]
-        self.vm_master.terminate_again()
+        self.check_vms(self.vm_master.terminate_one_again, [VmStates.TERMINATING])
         assert self.vmm.remove_vm_from_pool.called
         assert self.vmm.remove_vm_from_pool.call_args[0][0] == self.vmd_a1.vm_name
         assert not self.vmm.start_vm_termination.called
@@ -406,18 +375,67 @@ class TestVmMaster(object):
         assert self.vm_master.spawner.terminate.called
 
     def test_dummy_do_cycle(self):
-        self.vm_master.remove_old_dirty_vms = types.MethodType(MagicMock(), self.vm_master)
-        self.vm_master.check_vms_health = types.MethodType(MagicMock(), self.vm_master)
+        self.vm_master.check_due_vms = types.MethodType(MagicMock(), self.vm_master)
         self.vm_master.start_spawn_if_required = types.MethodType(MagicMock(), self.vm_master)
-        # self.vm_master.remove_old_dirty_vms = types(MagicMock, self.vm_master)
 
         self.vm_master.do_cycle()
 
-        assert self.vm_master.remove_old_dirty_vms.called
-        assert self.vm_master.check_vms_health.called
+        assert self.vm_master.check_due_vms.called
+        assert self.vm_master.checker.start_pending_checks.called
         assert self.vm_master.start_spawn_if_required.called
         assert self.vm_master.spawner.recycle.called
 
+    def test_check_due_vms(self, mc_time, add_vmd):
+        mc_time.time.return_value = 0
+        self.vm_master.check_one_vm = MagicMock()
+        self.vmm.pop_due_vms(0)
+
+        self.vmd_a1.store_field(self.rc, "state", VmStates.READY)
+        self.vmd_a1.store_field(self.rc, "last_health_check", 0)
+        self.vmd_a2.store_field(self.rc, "state", VmStates.TERMINATING)
+        self.vmd_a2.store_field(self.rc, "terminating_since", 0)
+
+        self.vm_master.check_due_vms()
+        checked = set(call[0][0].vm_name for call in self.vm_master.check_one_vm.call_args_list)
+        assert checked == set(["a1", "a2"])
+
+        # nothing is due until the earliest deadline
+        self.vm_master.check_one_vm.reset_mock()
+        assert self.vmm.get_next_vm_due() == self.opts.build_groups[0]["vm_health_check_period"]
+        mc_time.time.return_value = 5
+        self.vm_master.check_due_vms()
+        assert not self.vm_master.check_one_vm.called
+        assert self.vm_master.get_sleep_time() == 5
+
+        mc_time.time.return_value = self.opts.build_groups[0]["vm_terminating_timeout"]
+        self.vm_master.check_due_vms()
+        checked = set(call[0][0].vm_name for call in self.vm_master.check_one_vm.call_args_list)
+        assert checked == set(["a1", "a2"])
+
+    def test_get_next_check_time(self, mc_time, add_vmd):
+        mc_time.time.return_value = 100
+        bg = self.opts.build_groups[0]
+
+        self.vmd_a1.state = VmStates.READY
+        self.vmd_a1.last_health_check = 95
+        assert self.vm_master.get_next_check_time(self.vmd_a1) == 95 + bg["vm_health_check_period"]
+
+        self.vmd_a1.bound_to_user = "bob"
+        self.vmd_a1.last_release = -100
+        assert self.vm_master.get_next_check_time(self.vmd_a1) == bg["vm_dirty_terminating_timeout"] - 100
+
+        self.vmd_a1.state = VmStates.IN_USE
+        self.vmd_a1.last_health_check = 105
+        assert self.vm_master.get_next_check_time(self.vmd_a1) == 100 + self.opts.vm_cycle_timeout
+
+        self.vmd_a1.lease_expires = 112
+        assert self.vm_master.get_next_check_time(self.vmd_a1) == 112
+        self.vmd_a1.lease_expires = 90
+        assert self.vm_master.get_next_check_time(self.vmd_a1) == 100 + self.opts.vm_cycle_timeout
+
+        self.vmd_a1.state = VmStates.CHECK_HEALTH
+        assert self.vm_master.get_next_check_time(self.vmd_a1) == 105 + bg["vm_health_check_max_time"]
+
     def test_dummy_start_spawn_if_required(self):
         self.vm_master.try_spawn_one = MagicMock()
         self.vm_master.start_spawn_if_required()
@@ -425,6 +443,38 @@ class TestVmMaster(object):
             mock.call(group) for group in range(self.opts.build_groups_count)
         ]
 
+    def test_autoscale_group(self, mc_time, add_vmd):
+        mc_time.time.return_value = 1000
+        self.opts.build_groups[0].update({
+            "autoscale": True,
+            "min_vm_ready": 1,
+            "max_vm_in_ready_state": 1,
+            "vm_spawn_time": 300,
+        })
+        self.vm_master.frontend_client = MagicMock()
+        self.spawner.get_proc_num_per_group.return_value = 0
+        self.vmm.start_vm_termination = MagicMock()
+
+        # burst of builds: several VMs are spawned at once, up to max_vm_total
+        # which counts also the VM failing health checks
+        self.vmd_a3.store_field(self.rc, "state", VmStates.CHECK_HEALTH_FAILED)
+        self.vm_master.frontend_client.get_queue_stats.return_value = {
+            "x86_64": {"pending": 10, "running": 0, "avg_duration": None}}
+        self.vm_master.autoscale_group(0)
+        assert self.spawner.start_spawn.call_args_list == [mock.call(0)] * 2
+        assert not self.vmm.start_vm_termination.called
+
+        # empty queue, surplus ready VMs are terminated, clean ones first
+        for vmd in [self.vmd_a1, self.vmd_a2, self.vmd_a3]:
+            vmd.store_field(self.rc, "state", VmStates.READY)
+        self.vmd_a1.store_field(self.rc, "bound_to_user", "bob")
+        self.vmd_a1.store_field(self.rc, "last_release", 0)
+        self.vm_master.frontend_client.get_queue_stats.return_value = {}
+        mc_time.time.return_value = 1000 + self.opts.vm_cycle_timeout
+        self.vm_master.autoscale_group(0)
+        terminated = set(call[0][0] for call in self.vmm.start_vm_termination.call_args_list)
+        assert terminated == set(["a2", "a3"])
+
     def test__check_total_running_vm_limit_raises(self):
         self.vm_master.log = MagicMock()
         active_vm_states = [VmStates.GOT_IP, VmStates.READY, VmStates.IN_USE, VmStates.CHECK_HEALTH]
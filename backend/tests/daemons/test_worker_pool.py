@@ -0,0 +1,169 @@
+# coding: utf-8
+
+import multiprocessing
+import time
+
+from munch import Munch
+import six
+
+from backend.daemons.worker import Worker, WorkerPool, VmLeaseRenewer
+
+if six.PY3:
+    from unittest import mock
+else:
+    import mock
+
+
+
+class FakeWorker(object):
+    def __init__(self, opts, worker_id, group_id, job_queue, result_queue):
+        self.worker_id = worker_id
+        self.group_id = group_id
+        self.job_queue = job_queue
+        self.result_queue = result_queue
+        self.alive = True
+        self.exitcode = None
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self, timeout=None):
+        pass
+
+
+class TestWorkerPool(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            build_groups=[
+                {"id": 0, "name": "PC", "max_workers": 2},
+                {"id": 1, "name": "ARM", "max_workers": 1},
+            ]
+        )
+        self.log = mock.MagicMock()
+        self.pool = WorkerPool(self.opts, self.log, worker_cls=FakeWorker)
+        self.pool.start()
+
+        self.job = Munch(task_id="20-fedora-20-x86_64", build_id=20, chroot="fedora-20-x86_64")
+        self.vm = Munch(vm_name="vm_0", group=0)
+
+    def test_start(self):
+        assert len(self.pool.workers) == 3
+        assert self.pool.idle_count(0) == 2
+        assert self.pool.idle_count(1) == 1
+
+    def test_submit(self):
+        worker = self.pool.submit(self.job, self.vm, loaded_on=10)
+        assert worker.group_id == 0
+        assert self.pool.idle_count(0) == 1
+
+        task = worker.job_queue.get(timeout=1)
+        assert task["job"] == self.job
+        assert task["vm"] == self.vm
+        assert task["loaded_on"] == 10
+        assert task["dispatched_on"] >= 10
+        assert task["resume_from"] is None
+
+        entry = {"task": {}, "build_state": {"remote_tempdir": "/tmp/x"}}
+        worker = self.pool.submit(self.job, self.vm, resume_from=entry)
+        assert worker.job_queue.get(timeout=1)["resume_from"] == entry
+        assert self.pool.submit(self.job, self.vm) is None
+        assert self.pool.submit(self.job, self.vm) is None
+
+    def test_collect_finished(self):
+        worker = self.pool.submit(self.job, self.vm)
+        assert self.pool.collect_finished() == []
+
+        report = {"worker_id": worker.worker_id, "task_id": self.job.task_id}
+        self.pool.result_queue.put(report)
+        for _ in range(50):
+            reports = self.pool.collect_finished()
+            if reports:
+                break
+            multiprocessing.Event().wait(0.05)
+
+        assert reports == [report]
+        assert self.pool.idle_count(0) == 2
+
+    def test_replace_dead_workers(self):
+        worker = self.pool.submit(self.job, self.vm)
+        worker.alive = False
+
+        lost = self.pool.replace_dead_workers()
+        assert [task["job"] for task in lost] == [self.job]
+
+        new_worker = self.pool.workers[worker.worker_id]
+        assert new_worker is not worker
+        assert new_worker.group_id == 0
+        assert self.pool.idle_count(0) == 2
+        assert self.pool.replace_dead_workers() == []
+
+
+class TestVmLeaseRenewer(object):
+
+    def test_renews_until_stopped(self):
+        vm_manager = mock.MagicMock()
+        vm_manager.renew_vm_lease.return_value = True
+        renewer = VmLeaseRenewer(Munch(vm_lease_timeout=0.03), vm_manager, "vm_0",
+                                 "20-fedora-20-x86_64", mock.MagicMock())
+        renewer.start()
+        time.sleep(0.1)
+        renewer.stop()
+        renewals = vm_manager.renew_vm_lease.call_count
+        assert renewals >= 2
+        assert vm_manager.renew_vm_lease.call_args == mock.call("vm_0", "20-fedora-20-x86_64")
+
+        time.sleep(0.05)
+        assert vm_manager.renew_vm_lease.call_count == renewals
+
+    def test_stops_when_lease_lost(self):
+        vm_manager = mock.MagicMock()
+        vm_manager.renew_vm_lease.return_value = False
+        renewer = VmLeaseRenewer(Munch(vm_lease_timeout=0.03), vm_manager, "vm_0",
+                                 "20-fedora-20-x86_64", mock.MagicMock())
+        renewer.start()
+        renewer.join(1)
+        assert not renewer.is_alive()
+        assert vm_manager.renew_vm_lease.call_count == 1
+
+
+class TestWorkerRunTask(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            build_groups=[{"id": 0, "name": "PC", "max_workers": 1}],
+            vm_lease_timeout=60,
+        )
+        self.patchers = [mock.patch("backend.daemons.worker.{}".format(name))
+                         for name in ["get_redis_logger", "FrontendClient", "VmManager", "JobJournal"]]
+        for patcher in self.patchers:
+            patcher.start()
+
+        self.worker = Worker(self.opts, 1, 0, mock.MagicMock(), mock.MagicMock())
+        self.worker.do_job = mock.MagicMock(side_effect=RuntimeError("unexpected"))
+        self.task = {
+            "job": Munch(task_id="20-fedora-20-x86_64", started_on=None),
+            "vm": Munch(vm_name="vm_0", vm_ip="127.0.0.1"),
+        }
+
+    def teardown_method(self, method):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def test_vm_released_after_error(self):
+        self.worker.journal.get.return_value = {"build_state": None}
+        self.worker.run_task(self.task)
+        assert self.worker.vm_manager.release_vm.call_args == mock.call("vm_0")
+        assert not self.worker.vm_manager.start_vm_termination.called
+        assert self.worker.journal.remove.called
+
+    def test_vm_terminated_when_build_may_run(self):
+        self.worker.journal.get.return_value = {"build_state": {"remote_tempdir": "/tmp/x"}}
+        self.worker.run_task(self.task)
+        assert not self.worker.vm_manager.release_vm.called
+        assert self.worker.vm_manager.start_vm_termination.call_args == \
+            mock.call("vm_0", allowed_pre_state="in_use")
+        assert self.worker.journal.remove.called
@@ -5,11 +5,14 @@ from collections import defaultdict
 from pprint import pprint
 import socket
 from munch import Munch
-from backend.exceptions import BuilderError, BuilderTimeOutError, AnsibleCallError, AnsibleResponseError, VmError
+from backend.exceptions import BuilderError, BuilderTimeOutError, BuildCanceledError, AnsibleCallError, \
+    AnsibleResponseError, VmError
 
 import tempfile
 import shutil
 import os
+from subprocess import call, check_call, check_output
+import time
 
 import six
 from backend.job import BuildJob
@@ -25,6 +28,8 @@ import pytest
 from types import MethodType
 
 import backend.mockremote.builder as builder_module
+from backend.helpers import get_redis_connection
+from backend.vm_manage import KEY_BUILD_CANCELED
 from backend.mockremote.builder import Builder
 
 # @pytest.yield_fixture
@@ -87,6 +92,7 @@ class TestBuilder(object):
         remote_basedir=BUILDER_REMOTE_BASEDIR,
         remote_tempdir=BUILDER_REMOTE_TMPDIR,
         results_baseurl="http://example.com",
+        dist_git_fetch="shallow",
 
         redis_db=9,
         redis_port=7777,
@@ -459,47 +465,78 @@ class TestBuilder(object):
         ]:
             with pytest.raises(BuilderError) as err:
                 builder.buildroot_pkgs = bad_pkg
-                builder.modify_mock_chroot_config()
-
-    def test_modify_chroot_disable_networking(self):
-        storage = []
-
-        def fake_run_ansible(self, cmd, *args, **kwargs):
-            storage.append(cmd)
+                builder.setup_mock_chroot_config()
 
+    def test_render_mock_config(self):
         builder = self.get_test_builder()
-        builder.run_ansible_with_check = MethodType(fake_run_ansible, builder)
-        builder.root_conn.run.return_value = {
-            "contacted": {self.BUILDER_HOSTNAME: {"rc": 0, "stdout": None}},
-            "dark": {}
-        }
+        builder.module_dist_tag = ".foo+1+2"
 
         self.job.enable_net = False
-        # net should be disabled
-        builder.modify_mock_chroot_config()
-
-        expected = (
-            'dest=/etc/mock/fedora-20-i386.cfg '
-            'line="config_opts[\'use_host_resolv\'] = False" '
-            'regexp="^.*user_host_resolv.*$"')
-        assert any([expected in r for r in storage])
-
-    def test_collect_build_packages(self):
+        builder.buildroot_pkgs = "pkg1 pkg2"
+        config = builder.render_mock_config()
+        assert "config_opts['use_host_resolv'] = False" in config
+
+        def evaluate(chroot_setup_cmd):
+            config_opts = {"chroot_setup_cmd": chroot_setup_cmd, "macros": {},
+                           "plugin_conf": {"root_cache_opts": {}, "yum_cache_opts": {}}}
+            included = []
+            exec(config, {"config_opts": config_opts, "include": included.append})
+            assert included == ["/etc/mock/fedora-20-i386.cfg"]
+            return config_opts
+
+        config_opts = evaluate("install @buildsys-build")
+        assert config_opts["chroot_setup_cmd"] == "install @buildsys-build pkg1 pkg2"
+        assert config_opts["macros"]["%dist"] == ".foo+1+2"
+        assert config_opts["use_host_resolv"] is False
+        assert evaluate("")["chroot_setup_cmd"] == "install pkg1 pkg2"
+
+        self.job.enable_net = True
+        builder.buildroot_pkgs = ""
+        builder.module_dist_tag = None
+        config = builder.render_mock_config()
+        assert "config_opts['use_host_resolv'] = True" in config
+        assert "chroot_setup_cmd" not in config
+        assert "%dist" not in config
+
+    def test_render_mock_config_caches(self):
         builder = self.get_test_builder()
-        stdout = "stdout"
-
-        builder.conn.run.return_value = {
-            "contacted": {self.BUILDER_HOSTNAME: {"rc": 0, "stdout": stdout}},
-            "dark": {}
-        }
-        builder.collect_built_packages()
-        expected = (
-            "cd {} && "
-            "for f in `ls *.rpm |grep -v \"src.rpm$\"`; do"
-            "   rpm -qp --qf \"%{{NAME}} %{{VERSION}}\n\" $f; "
-            "done".format(builder._get_remote_results_dir())
-        )
-        assert builder.conn.module_args == expected
+        config = builder.render_mock_config()
+        cache_dir = "/var/cache/mock/copr-fedora-20-i386"
+        assert "'{}/package_cache/'".format(cache_dir) in config
+        assert "'{}/root_cache-{}/'".format(cache_dir, builder.get_buildroot_hash()) in config
+        assert "config_opts['plugin_conf']['root_cache_opts']['age_check'] = False" in config
+
+        # different buildroot gets a separate root cache
+        buildroot_hash = builder.get_buildroot_hash()
+        builder.buildroot_pkgs = "foo"
+        assert builder.get_buildroot_hash() != buildroot_hash
+        builder.buildroot_pkgs = ""
+        self.job.repos = ["http://example.com/other"]
+        assert builder.get_buildroot_hash() != buildroot_hash
+
+    def test_setup_mock_chroot_config(self):
+        builder = self.get_test_builder()
+        builder._remote_basedir = self.test_root_path
+        builder.opts = copy.deepcopy(self.opts)
+        builder.opts.ssh.transport = "ssh"
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+
+        cfg_path = os.path.join(self.test_root_path, "mock-configs", "fedora-20-i386.cfg")
+        builder.setup_mock_chroot_config()
+        with open(cfg_path) as handle:
+            assert handle.read() == builder.render_mock_config()
+        assert "Mock config {} updated".format(cfg_path) in str(self.mc_logger.info.call_args)
+
+        # same config on a reused VM is not pushed again
+        os.utime(cfg_path, (0, 0))
+        builder.setup_mock_chroot_config()
+        assert os.stat(cfg_path).st_mtime == 0
+        assert "is up to date" in str(self.mc_logger.info.call_args)
+
+        builder.buildroot_pkgs = "foo"
+        builder.setup_mock_chroot_config()
+        with open(cfg_path) as handle:
+            assert "install foo" in handle.read()
 
     @mock.patch("backend.mockremote.builder.check_for_ans_error")
     def test_run_ansible_with_check(self, mc_check_for_ans_errror):
@@ -654,6 +691,214 @@ class TestBuilder(object):
         mc_time.sleep.side_effect = incr_stage
         builder.run_build_and_wait(build_cmd)
 
+    def test_run_build_streaming(self):
+        builder = self.get_test_builder()
+        builder.job.task_id = "12345-fedora-20-i386"
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+
+        rc = builder.live_log_rc = MagicMock()
+        builder.tempdir = self.test_root_path
+        build_states = []
+        builder.build_started = build_states.append
+        results = builder.run_build_streaming("echo first; echo second >&2; printf third; exit 3")
+
+        assert results == {
+            "contacted": {self.BUILDER_HOSTNAME: {
+                "rc": 3, "stdout": "first\nsecond\nthird", "stderr": ""}},
+            "dark": {},
+        }
+        logged = [call[0][0] for call in self.mc_logger.info.call_args_list[1:]]
+        assert logged == ["first", "second", "third"]
+        published = "\n".join(call[0][1] for call in rc.publish.call_args_list)
+        assert published == "first\nsecond\nthird"
+        assert rc.publish.call_args[0][0] == "copr:backend:build_log:pubsub::12345-fedora-20-i386"
+        assert build_states == [{"remote_tempdir": self.test_root_path,
+                                 "remote_pkg_path": builder.remote_pkg_path}]
+
+    def test_resume(self):
+        builder = self.get_test_builder()
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+        builder.live_log_enabled = False
+        builder.check_build_success = MagicMock()
+        builder.tempdir = self.test_root_path
+        builder.start_detached_build("echo building; sleep 0.3; echo built")
+
+        # backend restarted, nothing known but the build state
+        builder = self.get_test_builder()
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+        builder.live_log_enabled = False
+        builder.setup_pubsub_handler = MagicMock()
+        builder.check_build_success = MagicMock()
+        builder.remote_pkg_name = builder.remote_pkg_path = None
+
+        stdout = builder.resume({"remote_tempdir": self.test_root_path,
+                                 "remote_pkg_path": "/tmp/foo/foovar-2.41.f21.src.rpm"})
+        assert stdout == "building\nbuilt"
+        assert builder.remote_pkg_name == "foovar-2.41.f21"
+        assert builder.check_build_success.called
+
+        # finished while nobody was attached
+        assert builder.resume({"remote_tempdir": self.test_root_path,
+                               "remote_pkg_path": "/tmp/foo/foovar-2.41.f21.src.rpm"}) == "building\nbuilt"
+
+        os.unlink(os.path.join(self.test_root_path, "build.rc"))
+        with pytest.raises(AnsibleResponseError):
+            builder.resume({"remote_tempdir": self.test_root_path,
+                            "remote_pkg_path": "/tmp/foo/foovar-2.41.f21.src.rpm"})
+
+    def test_run_build_streaming_timeout(self):
+        builder = self.get_test_builder()
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+        builder.live_log_enabled = False
+        builder.timeout = 0.5
+
+        builder.tempdir = self.test_root_path
+        start = time.time()
+        with pytest.raises(BuilderTimeOutError):
+            builder.run_build_streaming("echo started; sleep 10")
+        assert time.time() - start < 5
+
+    def test_run_build_streaming_ssh_error(self):
+        builder = self.get_test_builder()
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+        builder.live_log_enabled = False
+
+        builder.tempdir = self.test_root_path
+        with patch.object(builder_module, "ATTACH_RETRY_DELAY", 0):
+            results = builder.run_build_streaming("echo 'Connection refused'; exit 255")
+        assert results["dark"][self.BUILDER_HOSTNAME]["msg"] == "Connection refused\n"
+
+    def prepare_local_dist_git(self, builder):
+        """
+        Setup a dist-git repo of the job with one lookaside source and a fake
+        fedpkg-copr, which records source downloads
+        """
+        dist_git = os.path.join(self.test_root_path, "dist-git-server")
+        workdir = os.path.join(self.test_root_path, "dist-git-work")
+        git = ["git", "-c", "user.name=Copr", "-c", "user.email=copr@example.com"]
+        check_call(["git", "init", "-q", workdir])
+        with open(os.path.join(workdir, "sources"), "w") as handle:
+            handle.write("SHA512 (foo.tar.gz) = 0123abcd\n")
+        check_call(git + ["add", "sources"], cwd=workdir)
+        check_call(git + ["commit", "-q", "-m", "init"], cwd=workdir)
+        check_call(["git", "clone", "-q", "--bare", workdir,
+                    os.path.join(dist_git, self.GIT_REPO + ".git")])
+        builder.job.git_hash = check_output(["git", "rev-parse", "HEAD"], cwd=workdir).strip()
+
+        bin_dir = os.path.join(self.test_root_path, "bin")
+        os.makedirs(bin_dir)
+        fedpkg = os.path.join(bin_dir, "fedpkg-copr")
+        with open(fedpkg, "w") as handle:
+            handle.write(
+                "#!/bin/sh\n"
+                "[ -f foo.tar.gz ] || {{ echo source > foo.tar.gz; echo x >> {downloads}; }}\n"
+                "touch xyz-1-1.src.rpm\n"
+                "echo \"Wrote: $PWD/xyz-1-1.src.rpm\"\n".format(
+                    downloads=os.path.join(self.test_root_path, "downloads")))
+        os.chmod(fedpkg, 0o755)
+
+        builder._remote_basedir = os.path.join(self.test_root_path, "builder")
+        builder.opts = copy.deepcopy(self.opts)
+        builder.opts.ssh.transport = "ssh"
+        builder.opts.dist_git_url = "file://" + dist_git
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+        return bin_dir
+
+    def test_download_job_pkg_shallow(self):
+        builder = self.get_test_builder()
+        bin_dir = self.prepare_local_dist_git(builder)
+        repo_dir = os.path.join(builder._remote_basedir, "dist-git", self.GIT_REPO)
+        cached_source = os.path.join(builder._remote_basedir, "lookaside-cache", "0123abcd")
+
+        with mock.patch.dict(os.environ, {"PATH": bin_dir + os.pathsep + os.environ["PATH"]}):
+            builder.download_job_pkg_to_builder()
+            assert builder.remote_pkg_path == os.path.join(repo_dir, "xyz-1-1.src.rpm")
+            assert builder.remote_pkg_name == "xyz-1-1"
+            assert os.path.exists(cached_source)
+
+            # next chroot on the same VM
+            builder.download_job_pkg_to_builder()
+
+            # source cached on the VM is reused for a fresh repo
+            shutil.rmtree(repo_dir)
+            builder.download_job_pkg_to_builder()
+            assert os.path.exists(os.path.join(repo_dir, "foo.tar.gz"))
+
+        with open(os.path.join(self.test_root_path, "downloads")) as handle:
+            assert handle.read() == "x\n"
+
+    def test_run_ssh(self):
+        builder = self.get_test_builder()
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+
+        results = builder._run_ssh("echo out; echo err >&2; exit 1")
+        assert results == {
+            "contacted": {self.BUILDER_HOSTNAME: {"rc": 1, "stdout": "out", "stderr": "err\n"}},
+            "dark": {},
+        }
+
+        results = builder._run_ssh("echo 'Connection refused' >&2; exit 255")
+        assert results["dark"][self.BUILDER_HOSTNAME]["msg"] == "Connection refused\n"
+
+    def test_run_ssh_timeout(self):
+        builder = self.get_test_builder()
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+        builder.timeout = 0.5
+
+        start = time.time()
+        results = builder._run_ssh("sleep 10")
+        assert time.time() - start < 5
+        assert results["contacted"] == {}
+        assert "timed out" in results["dark"][self.BUILDER_HOSTNAME]["msg"]
+
+    def test_run_ansible_shell_over_ssh(self):
+        builder = self.get_test_builder()
+        builder.opts = copy.deepcopy(self.opts)
+        builder.opts.ssh.transport = "ssh"
+        builder._run_ssh = MagicMock()
+        builder.conn = MagicMock()
+
+        builder._run_ansible("/bin/true", as_root=True)
+        assert builder._run_ssh.call_args == mock.call("/bin/true", True)
+        assert not builder.conn.run.called
+
+        builder._run_ansible("dest=/tmp/foo line=bar", module_name="lineinfile")
+        assert builder.conn.run.called
+
+    def test_ssh_control_connection(self):
+        builder = self.get_test_builder()
+        cmd = builder._ssh_command("ls", username="root")
+        control_dir = builder.control_dir
+        assert os.path.isdir(control_dir)
+        assert "ControlPath={}/%r@%h:%p".format(control_dir) in cmd
+        assert "ControlMaster=auto" in cmd
+        assert cmd[-2:] == ["root@{}".format(self.BUILDER_HOSTNAME), "ls"]
+
+        # all connections of the job share one control directory
+        assert builder._ssh_command("ls")[-2] == "{}@{}".format(self.BUILDER_USER, self.BUILDER_HOSTNAME)
+        assert builder.control_dir == control_dir
+
+        with mock.patch("backend.mockremote.builder.Popen") as mc_popen:
+            mc_popen.return_value.communicate.return_value = ("", "")
+            builder.close()
+            builder.close()
+
+        assert mc_popen.call_count == 2
+        assert "-O" in mc_popen.call_args[0][0]
+        assert not os.path.exists(control_dir)
+        assert builder.control_dir is None
+
+    def test_timed_step(self):
+        builder = self.get_test_builder()
+        with builder.timed_step("foo"):
+            pass
+        with pytest.raises(BuilderError):
+            with builder.timed_step("bar"):
+                raise BuilderError("error")
+
+        assert [name for name, _ in builder.step_times] == ["foo", "bar"]
+        assert builder.format_step_times().startswith("foo: 0.0s, bar: ")
+
     @mock.patch("backend.mockremote.builder.Popen")
     def test_download(self, mc_popen):
         builder = self.get_test_builder()
@@ -679,6 +924,47 @@ class TestBuilder(object):
             #
             # assert mc_popen.call_args[0][0] == expected_arg
 
+    @mock.patch("backend.mockremote.builder.Popen")
+    def test_download_single_session(self, mc_popen):
+        builder = self.get_test_builder()
+        builder._run_ansible = MagicMock()
+        mc_popen.return_value.returncode = 0
+
+        builder.download(self.test_root_path)
+        link_cmd = builder._run_ansible.call_args[0][0]
+        assert "ln -sfn /tmp/copr-backend-test-tmp/build/configs/fedora-20-i386 " in link_cmd
+
+        assert mc_popen.call_count == 1
+        rsync_cmd = mc_popen.call_args[0][0]
+        assert "--copy-dirlinks -z --skip-compress=rpm/" in rsync_cmd
+        assert "ControlPath=" in rsync_cmd
+        assert "/build/results/fedora-20-i386/{}/*".format(self.BUILDER_PKG_BASE) in rsync_cmd
+        assert [name for name, _ in builder.step_times] == ["download"]
+
+        # nothing was built, only configs are there
+        builder.remote_pkg_name = None
+        builder._run_ansible.reset_mock()
+        builder.download(self.test_root_path)
+        assert not builder._run_ansible.called
+        assert "/build/configs/fedora-20-i386/* '{}/configs'/".format(self.test_root_path) in mc_popen.call_args[0][0]
+
+    def test_log_transfer_stats(self):
+        builder = self.get_test_builder()
+        log_path = os.path.join(self.test_root_path, "rsync.log")
+        with open(log_path, "w") as handle:
+            handle.write("Number of files: 12\n"
+                         "Total file size: 20,971,520 bytes\n"
+                         "Total bytes sent: 1,024\n"
+                         "Total bytes received: 10,485,760\n")
+
+        builder.log_transfer_stats(log_path, 2.0)
+        assert self.mc_logger.info.call_args[0][0] == \
+            "Downloaded 10240 kB in 2.0s, 5120 kB/s, total size of the files 20480 kB"
+
+        self.mc_logger.info.reset_mock()
+        builder.log_transfer_stats(os.path.join(self.test_root_path, "missing.log"), 2.0)
+        assert not self.mc_logger.info.called
+
     @mock.patch("backend.mockremote.builder.Popen")
     def test_download_popen_error(self, mc_popen):
         builder = self.get_test_builder()
@@ -790,3 +1076,64 @@ class TestBuilder(object):
         with pytest.raises(VmError):
             builder.check_pubsub()
 
+        builder.ps.get_message.return_value = {"type": "message", "data": "canceled"}
+        with pytest.raises(BuildCanceledError):
+            builder.check_pubsub()
+
+        builder.ps = None
+        builder.check_pubsub()
+
+    def test_run_build_streaming_canceled(self):
+        builder = self.get_test_builder()
+        builder._ssh_command = lambda cmd, username=None: ["sh", "-c", cmd]
+        builder.live_log_enabled = False
+        # the kill command runs locally as well
+        builder._run_ansible = MagicMock(side_effect=lambda cmd, as_root=False: builder._run_ssh(cmd))
+        builder.ps = MagicMock()
+        builder.ps.get_message.side_effect = [None, {"type": "message", "data": "canceled"}]
+
+        builder.tempdir = self.test_root_path
+        start = time.time()
+        with pytest.raises(BuildCanceledError):
+            builder.run_build_streaming("sleep 30")
+        assert time.time() - start < 5
+
+        kill_cmd = builder._run_ansible.call_args
+        assert "pkill -TERM -s $sid" in kill_cmd[0][0]
+        assert kill_cmd[1] == {"as_root": True}
+        assert not builder.build_running
+
+        with open(os.path.join(self.test_root_path, "build.pid")) as handle:
+            sid = handle.read().strip()
+        # no process of the build session is left
+        assert call(["pgrep", "-s", sid]) == 1
+
+    def test_kill_remote_build_failed(self):
+        builder = self.get_test_builder()
+        builder.build_running = True
+        builder._run_ansible = MagicMock(return_value={"contacted": {self.BUILDER_HOSTNAME: {"rc": 1}}})
+        assert not builder.stop_build()
+
+        builder._run_ansible.return_value = {"contacted": {}, "dark": {self.BUILDER_HOSTNAME: {}}}
+        assert not builder.stop_build()
+
+        builder._run_ansible.return_value = {"contacted": {self.BUILDER_HOSTNAME: {"rc": 0}}}
+        assert builder.stop_build()
+        assert not builder.build_running
+
+    def test_setup_pubsub_handler_canceled_before(self):
+        builder = self.get_test_builder()
+        builder.job.task_id = "10-fedora-20-x86_64"
+        builder.setup_pubsub_handler()
+        builder.check_pubsub()
+
+        rc = get_redis_connection(self.opts)
+        rc.set(KEY_BUILD_CANCELED.format(task_id=builder.job.task_id), 1)
+        try:
+            builder.setup_pubsub_handler()
+            with pytest.raises(BuildCanceledError):
+                builder.check_pubsub()
+        finally:
+            rc.delete(KEY_BUILD_CANCELED.format(task_id=builder.job.task_id))
+            builder.close()
+
@@ -207,11 +207,13 @@ class TestMockRemote(object):
 
         build_details = MagicMock()
         self.mr.builder.build.return_value = STDOUT
-        self.mr.builder.collect_built_packages.return_value = "foo bar"
+        built_packages = [{"name": "foo", "epoch": None, "version": "1.0", "release": "1",
+                           "arch": "noarch", "size": 10}]
+        self.mr.collect_built_packages = MagicMock(return_value=built_packages)
 
         result = self.mr.build_pkg_and_process_results()
 
-        assert result["built_packages"] == "foo bar"
+        assert result["built_packages"] == built_packages
 
         assert self.mr.builder.build.called
         assert self.mr.builder.download.called
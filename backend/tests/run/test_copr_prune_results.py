@@ -34,9 +34,9 @@ def mc_bcr():
         yield handle
 
 @pytest.yield_fixture
-def mc_gacs():
-    with mock.patch('{}.get_auto_createrepo_status'.format(MODULE_REF)) as handle:
-        yield handle
+def mc_flags():
+    with mock.patch('{}.ProjectFlagsCache'.format(MODULE_REF)) as handle:
+        yield handle.return_value
 
 @pytest.yield_fixture
 def mc_pruner():
@@ -64,7 +64,8 @@ class TestPruneResults(object):
         self.opts = Munch(
             prune_days=14,
             frontend_base_url = '<frontend_url>',
-            destdir=self.testresults_dir
+            destdir=self.testresults_dir,
+            createrepo_state_dir=os.path.join(self.tmp_dir, 'createrepo-state'),
         )
 
     def teardown_method(self, method):
@@ -79,8 +80,8 @@ class TestPruneResults(object):
 
     ################################ tests ################################
 
-    def test_run(self, mc_runcmd, mc_gacs):
-        mc_gacs.return_value = True
+    def test_run(self, mc_runcmd, mc_flags):
+        mc_flags.get.side_effect = lambda username, projectname, flag: flag == "auto_createrepo"
 
         pruner = Pruner(self.opts)
         pruner.run()
@@ -90,16 +91,27 @@ class TestPruneResults(object):
             for projectdir in self.testresults[userdir]:
                 for chrootdir in self.testresults[userdir][projectdir]:
                     prune_path = os.path.join(self.opts.destdir, userdir, projectdir, chrootdir)
-                    mc_runcmd.assert_has_calls(
+                    mc_runcmd.assert_has_calls([
                         mock.call(
                             ['prunerepo', '--verbose', '--days={0}'.format(self.opts.prune_days), '--cleancopr', prune_path]
                         )
-                    )
+                    ])
+                    # next createrepo run walks the directory
+                    state_dir = os.path.join(self.opts.createrepo_state_dir, userdir, projectdir, chrootdir)
+                    with open(os.path.join(state_dir, ".createrepo.changes")) as handle:
+                        assert handle.read() == "*\n"
                     expected_call_count += 1
         assert mc_runcmd.call_count == expected_call_count
 
-    def test_project_skipped_when_acr_disabled(self, mc_runcmd, mc_gacs):
-        mc_gacs.return_value = False
+    def test_project_skipped_when_acr_disabled(self, mc_runcmd, mc_flags):
+        mc_flags.get.return_value = False
+        pruner = Pruner(self.opts)
+        pruner.prune_project('<project_path>', '<username>', '<coprname>')
+
+        assert not mc_runcmd.called
+
+    def test_project_skipped_when_persistent(self, mc_runcmd, mc_flags):
+        mc_flags.get.return_value = True
         pruner = Pruner(self.opts)
         pruner.prune_project('<project_path>', '<username>', '<coprname>')
 
@@ -50,14 +50,21 @@ class TestAction(object):
             redis_port=7777,
 
             destdir=None,
+            createrepo_state_dir=tempfile.mkdtemp(),
             frontend_base_url=None,
             results_baseurl=RESULTS_ROOT_URL,
 
             do_sign=True,
         )
 
+        self.flags_patcher = mock.patch("backend.actions.ProjectFlagsCache")
+        self.mc_flags = self.flags_patcher.start().return_value
+        self.mc_flags.get.return_value = True
+
     def teardown_method(self, method):
+        self.flags_patcher.stop()
         self.rm_tmp_dir()
+        shutil.rmtree(self.opts.createrepo_state_dir)
 
     def rm_tmp_dir(self):
         if self.tmp_dir_name:
@@ -102,6 +109,30 @@ class TestAction(object):
 
         self.dummy = str(test_action)
 
+    @mock.patch("backend.actions.VmManager")
+    def test_action_cancel_build(self, mc_vmm, mc_time):
+        mc_time.time.return_value = self.test_time
+        mc_front_cb = MagicMock()
+        mc_vmm.return_value.interrupt_build.return_value = 2
+
+        test_action = Action(
+            opts=self.opts,
+            action={
+                "action_type": ActionType.CANCEL_BUILD,
+                "id": 1,
+                "object_type": "build",
+                "object_id": 10,
+                "data": json.dumps({"build_id": 10}),
+            },
+            frontend_client=mc_front_cb,
+        )
+        test_action.run()
+
+        assert mc_vmm.return_value.interrupt_build.call_args == mock.call(10)
+        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        assert result_dict["id"] == 1
+        assert result_dict["result"] == ActionResult.SUCCESS
+
     def test_action_run_rename(self, mc_time):
 
         mc_time.time.return_value = self.test_time
@@ -110,6 +141,8 @@ class TestAction(object):
         tmp_dir = self.make_temp_dir()
         with open(os.path.join(self.tmp_dir_name, "old_dir", "foobar.txt"), "w") as handle:
             handle.write(self.test_content)
+        state_dir = self.opts.createrepo_state_dir
+        os.makedirs(os.path.join(state_dir, "old_dir", "fedora20"))
 
         self.opts.destdir = tmp_dir
         test_action = Action(
@@ -135,6 +168,10 @@ class TestAction(object):
         with open(os.path.join(tmp_dir, "new_dir", "foobar.txt")) as handle:
             assert handle.read() == self.test_content
 
+        # createrepo state goes along with the repos
+        assert not os.path.exists(os.path.join(state_dir, "old_dir"))
+        assert os.path.isdir(os.path.join(state_dir, "new_dir", "fedora20"))
+
     def test_action_run_rename_success_on_empty_src(self, mc_time):
         mc_time.time.return_value = self.test_time
         mc_front_cb = MagicMock()
@@ -225,6 +262,7 @@ class TestAction(object):
 
         tmp_dir = self.make_temp_dir()
         self.opts.destdir=tmp_dir
+        os.makedirs(os.path.join(self.opts.createrepo_state_dir, "old_dir", "fedora20"))
         test_action = Action(
             opts=self.opts,
             action={
@@ -243,6 +281,30 @@ class TestAction(object):
         assert result_dict["job_ended_on"] == self.test_time
 
         assert not os.path.exists(os.path.join(tmp_dir, "old_dir"))
+        assert not os.path.exists(os.path.join(self.opts.createrepo_state_dir, "old_dir"))
+        assert not self.mc_flags.invalidate.called
+
+    def test_action_run_delete_copr_invalidates_flags(self, mc_time):
+        mc_time.time.return_value = self.test_time
+        mc_front_cb = MagicMock()
+
+        tmp_dir = self.make_temp_dir()
+        self.opts.destdir = tmp_dir
+        test_action = Action(
+            opts=self.opts,
+            action={
+                "action_type": ActionType.DELETE,
+                "object_type": "copr",
+                "id": 6,
+                "old_value": "foo/bar",
+            },
+            frontend_client=mc_front_cb
+        )
+        test_action.run()
+
+        result_dict = mc_front_cb.update.call_args[0][0]["actions"][0]
+        assert result_dict["result"] == ActionResult.SUCCESS
+        assert self.mc_flags.invalidate.call_args == mock.call("foo", "bar")
 
     def test_delete_no_chroot_dirs(self, mc_time):
         mc_time.time.return_value = self.test_time
@@ -315,10 +377,49 @@ class TestAction(object):
             projectname=u'bar',
             base_url=u'http://example.com/results/foo/bar/fedora20',
             path='{}/old_dir/fedora20'.format(self.tmp_dir_name),
-            front_url=None
+            front_url=None,
+            auto_createrepo=True,
+            removed=['foo/foo.src.rpm'],
+            state_dir=os.path.join(self.opts.createrepo_state_dir, "old_dir", "fedora20"),
         )
         assert mc_createrepo.call_args == create_repo_expected_call
 
+    @mock.patch("backend.actions.createrepo")
+    def test_delete_build_flags_unavailable(self, mc_createrepo, mc_time):
+        mc_time.time.return_value = self.test_time
+        mc_front_cb = MagicMock()
+        self.mc_flags.get.side_effect = RequestException()
+
+        tmp_dir = self.make_temp_dir()
+        chroot_1_dir = os.path.join(tmp_dir, "old_dir", "fedora20")
+        os.makedirs(os.path.join(chroot_1_dir, "foo"))
+        with open(os.path.join(chroot_1_dir, "foo", "foo.src.rpm"), "w") as fh:
+            fh.write("foo\n")
+
+        self.opts.destdir = tmp_dir
+        test_action = Action(
+            opts=self.opts,
+            action={
+                "action_type": ActionType.DELETE,
+                "object_type": "build",
+                "id": 7,
+                "old_value": "old_dir",
+                "data": self.ext_data_for_delete_build,
+                "object_id": 42
+            },
+            frontend_client=mc_front_cb,
+        )
+        test_action.run()
+
+        assert not os.path.exists(os.path.join(chroot_1_dir, "foo"))
+        assert not mc_createrepo.called
+        # removals are left for the next createrepo run, outside of the published dir
+        assert not [name for name in os.listdir(chroot_1_dir) if name.startswith(".")]
+        state_dir = os.path.join(self.opts.createrepo_state_dir, "old_dir", "fedora20")
+        for name in ["createrepo", "createrepo-devel"]:
+            with open(os.path.join(state_dir, ".{}.changes".format(name))) as handle:
+                assert handle.read() == "-foo/foo.src.rpm\n"
+
     @mock.patch("backend.actions.createrepo")
     def test_delete_build_succeeded_createrepo_error(self, mc_createrepo, mc_time):
         mc_time.time.return_value = self.test_time
@@ -552,12 +653,15 @@ class TestAction(object):
         assert result_dict["id"] == 8
         assert result_dict["result"] == ActionResult.SUCCESS
 
+        state_dir = self.opts.createrepo_state_dir
         exp_call_1 = mock.call(path=tmp_dir + u'/foo/bar/epel-6-i386',
                                front_url=self.opts.frontend_base_url, override_acr_flag=True,
-                               username=u"foo", projectname=u"bar")
+                               username=u"foo", projectname=u"bar",
+                               state_dir=state_dir + u'/foo/bar/epel-6-i386')
         exp_call_2 = mock.call(path=tmp_dir + u'/foo/bar/fedora-20-x86_64',
                                front_url=self.opts.frontend_base_url, override_acr_flag=True,
-                               username=u"foo", projectname=u"bar")
+                               username=u"foo", projectname=u"bar",
+                               state_dir=state_dir + u'/foo/bar/fedora-20-x86_64')
         assert exp_call_1 in mc_createrepo.call_args_list
         assert exp_call_2 in mc_createrepo.call_args_list
         assert len(mc_createrepo.call_args_list) == 2
@@ -4,9 +4,11 @@ import tarfile
 import tempfile
 import shutil
 import time
+import threading
 import pytest
 
 import six
+from munch import Munch
 
 
 if six.PY3:
@@ -17,25 +19,26 @@ else:
     from mock import MagicMock
 
 
-from backend.createrepo import createrepo, createrepo_unsafe, add_appdata, run_cmd_unsafe
+from backend.createrepo import createrepo, createrepo_unsafe, add_appdata, run_cmd_unsafe, run_coalesced, \
+    run_incremental, find_appdata_packages, get_state_dir
 from backend.exceptions import CreateRepoError
 
 @mock.patch('backend.createrepo.createrepo_unsafe')
 @mock.patch('backend.createrepo.add_appdata')
 @mock.patch('backend.helpers.CoprClient')
-def test_createrepo_conditional_true(mc_client, mc_add_appdata, mc_create_unsafe):
+def test_createrepo_conditional_true(mc_client, mc_add_appdata, mc_create_unsafe, tmpdir):
     mc_client.return_value.get_project_details.return_value = MagicMock(data={"detail": {}})
     mc_create_unsafe.return_value = ""
     mc_add_appdata.return_value = ""
 
-    createrepo(path="/tmp/", front_url="http://example.com/api",
+    createrepo(path=str(tmpdir), front_url="http://example.com/api",
                username="foo", projectname="bar")
     mc_create_unsafe.reset_mock()
 
     mc_client.return_value.get_project_details.return_value = MagicMock(
         data={"detail": {"auto_createrepo": True}})
 
-    createrepo(path="/tmp/", front_url="http://example.com/api",
+    createrepo(path=str(tmpdir), front_url="http://example.com/api",
                username="foo", projectname="bar")
 
     mc_create_unsafe.reset_mock()
@@ -43,14 +46,16 @@ def test_createrepo_conditional_true(mc_client, mc_add_appdata, mc_create_unsafe
 
 @mock.patch('backend.createrepo.createrepo_unsafe')
 @mock.patch('backend.helpers.CoprClient')
-def test_createrepo_conditional_false(mc_client, mc_create_unsafe):
+def test_createrepo_conditional_false(mc_client, mc_create_unsafe, tmpdir):
     mc_client.return_value.get_project_details.return_value = MagicMock(data={"detail": {"auto_createrepo": False}})
 
     base_url = "http://example.com/repo/"
-    createrepo(path="/tmp/", front_url="http://example.com/api",
+    createrepo(path=str(tmpdir), front_url="http://example.com/api",
                username="foo", projectname="bar", base_url=base_url)
 
-    assert mc_create_unsafe.call_args == mock.call('/tmp/', dest_dir='devel', base_url=base_url)
+    assert mc_create_unsafe.call_args == mock.call(
+        str(tmpdir), dest_dir='devel', base_url=base_url,
+        pkglist=str(tmpdir.join(".createrepo-devel.pkglist")), skip_stat=False)
 
 
 @pytest.yield_fixture
@@ -246,3 +251,202 @@ class TestCreaterepo(object):
 
             createrepo_unsafe(path, base_url=self.base_url, dest_dir="devel")
             assert os.path.exists(os.path.join(path, "devel"))
+
+    def test_run_coalesced(self):
+        runs = []
+
+        def regenerate():
+            runs.append(time.time())
+            time.sleep(0.3)
+            return "done"
+
+        assert run_coalesced(self.tmp_dir_name, "createrepo", regenerate) == "done"
+
+        # requests made while a run is in progress are merged into one run
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            run_coalesced(self.tmp_dir_name, "createrepo", regenerate))) for _ in range(6)]
+        threads[0].start()
+        time.sleep(0.1)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(runs) == 3
+        assert sorted(results) == [""] * 4 + ["done"] * 2
+
+        # failed run doesn't cover anything
+        def fail():
+            raise CreateRepoError("failed", cmd="createrepo_c")
+        with pytest.raises(CreateRepoError):
+            run_coalesced(self.tmp_dir_name, "createrepo-devel", fail)
+        assert run_coalesced(self.tmp_dir_name, "createrepo-devel", regenerate) == "done"
+
+    def test_createrepo_generated_commands_pkglist(self, mc_run_cmd_unsafe):
+        path = os.path.join(self.tmp_dir_name, "fedora-21")
+        os.makedirs(os.path.join(path, "repodata"))
+        with open(os.path.join(path, "repodata", "repomd.xml"), "w") as handle:
+            handle.write("1")
+
+        pkglist = os.path.join(path, ".createrepo.pkglist")
+        createrepo_unsafe(path, pkglist=pkglist, skip_stat=True)
+        assert mc_run_cmd_unsafe.call_args[0][0] == (
+            "/usr/bin/createrepo_c --database --ignore-lock --update "
+            "--pkglist " + pkglist + " --skip-stat " + path)
+
+    def add_build(self, build_dir, *names):
+        os.makedirs(os.path.join(self.tmp_dir_name, build_dir))
+        for name in names:
+            with open(os.path.join(self.tmp_dir_name, build_dir, name), "w") as handle:
+                handle.write(name)
+        return [os.path.join(build_dir, name) for name in names]
+
+    def test_run_incremental(self):
+        runs = []
+
+        def regenerate(pkglist, skip_stat):
+            with open(pkglist) as handle:
+                runs.append((set(handle.read().splitlines()), skip_stat))
+            return "done"
+
+        old = self.add_build("00000001-foo", "foo-1.0-1.x86_64.rpm", "foo-1.0-1.src.rpm", "build.log")
+
+        # no list of packages yet, directory is walked
+        assert run_incremental(self.tmp_dir_name, "createrepo", regenerate, added=[]) == "done"
+        assert runs.pop() == (set(old[:2]), False)
+
+        new = self.add_build("00000002-foo", "foo-2.0-1.x86_64.rpm")
+        run_incremental(self.tmp_dir_name, "createrepo", regenerate, added=new)
+        assert runs.pop() == (set(old[:2] + new), True)
+
+        shutil.rmtree(os.path.join(self.tmp_dir_name, "00000001-foo"))
+        run_incremental(self.tmp_dir_name, "createrepo", regenerate, removed=old[:2])
+        assert runs.pop() == (set(new), True)
+
+        # rebuilt package keeps the file name, metadata must not be reused blindly
+        run_incremental(self.tmp_dir_name, "createrepo", regenerate, added=new)
+        assert runs.pop() == (set(new), False)
+
+        # unknown changes
+        os.remove(os.path.join(self.tmp_dir_name, new[0]))
+        run_incremental(self.tmp_dir_name, "createrepo", regenerate)
+        assert runs.pop() == (set(), False)
+
+    def test_run_incremental_failure_and_period(self):
+        runs = []
+
+        def regenerate(pkglist, skip_stat):
+            runs.append(skip_stat)
+            return "done"
+
+        def fail(pkglist, skip_stat):
+            raise CreateRepoError("failed", cmd="createrepo_c")
+
+        run_incremental(self.tmp_dir_name, "createrepo", regenerate)
+        with pytest.raises(CreateRepoError):
+            run_incremental(self.tmp_dir_name, "createrepo", fail, added=[])
+        # changes of the failed run are unknown
+        run_incremental(self.tmp_dir_name, "createrepo", regenerate, added=[])
+        run_incremental(self.tmp_dir_name, "createrepo", regenerate, added=[])
+        assert runs == [False, False, True]
+
+        with mock.patch("backend.createrepo.CREATEREPO_FULL_PASS_PERIOD", 0):
+            run_incremental(self.tmp_dir_name, "createrepo", regenerate, added=[])
+        assert runs[-1] is False
+
+    def test_get_state_dir(self):
+        opts = Munch(destdir="/var/lib/copr/public_html/results",
+                     createrepo_state_dir="/var/lib/copr/createrepo/")
+        assert get_state_dir(opts, "/var/lib/copr/public_html/results/foo/bar/fedora-20-x86_64/") \
+            == "/var/lib/copr/createrepo/foo/bar/fedora-20-x86_64"
+        assert get_state_dir(opts, "/var/lib/copr/public_html/results-other/foo") \
+            == "/var/lib/copr/createrepo/var/lib/copr/public_html/results-other/foo"
+
+    @mock.patch("backend.createrepo.ships_appdata")
+    def test_state_dir(self, mc_ships_appdata):
+        mc_ships_appdata.return_value = True
+        state_dir = os.path.join(self.tmp_dir_name, "state")
+        repo_dir = os.path.join(self.tmp_dir_name, "repo")
+        os.mkdir(repo_dir)
+        pkg_dir = os.path.join(repo_dir, "00000001-foo")
+        os.mkdir(pkg_dir)
+        with open(os.path.join(pkg_dir, "foo-1.0-1.x86_64.rpm"), "w") as handle:
+            handle.write("foo")
+
+        def regenerate(pkglist, skip_stat):
+            find_appdata_packages(repo_dir, ["00000001-foo/foo-1.0-1.x86_64.rpm"], state_dir)
+            return "done"
+
+        assert run_incremental(repo_dir, "createrepo", regenerate, state_dir=state_dir) == "done"
+        assert os.listdir(repo_dir) == ["00000001-foo"]
+        assert set(os.listdir(state_dir)) >= {".createrepo.changes", ".createrepo.pkglist",
+                                              ".createrepo.stamp", ".appdata.cache"}
+
+    @mock.patch("backend.createrepo.ships_appdata")
+    def test_find_appdata_packages(self, mc_ships_appdata):
+        gui = self.add_build("00000001-gui", "gui-1.0-1.x86_64.rpm")
+        cli = self.add_build("00000002-cli", "cli-1.0-1.x86_64.rpm")
+        mc_ships_appdata.side_effect = lambda pkg_path: "gui" in os.path.basename(pkg_path)
+
+        assert find_appdata_packages(self.tmp_dir_name, gui + cli) == gui
+        assert mc_ships_appdata.call_count == 2
+
+        # known packages are not inspected again, missing ones are ignored
+        assert find_appdata_packages(self.tmp_dir_name, gui + cli + ["missing.rpm"]) == gui
+        assert mc_ships_appdata.call_count == 2
+
+        # rebuilt package with the same content
+        os.utime(os.path.join(self.tmp_dir_name, cli[0]), (0, 0))
+        assert find_appdata_packages(self.tmp_dir_name, gui + cli) == gui
+        assert mc_ships_appdata.call_count == 2
+
+        gui2 = self.add_build("00000003-gui", "gui-2.0-1.x86_64.rpm")
+        assert find_appdata_packages(self.tmp_dir_name, gui + cli + gui2) == gui + gui2
+        assert mc_ships_appdata.call_count == 3
+
+    @mock.patch("backend.createrepo.ships_appdata")
+    def test_add_appdata(self, mc_ships_appdata, mc_run_cmd_unsafe):
+        mc_run_cmd_unsafe.return_value = ""
+        mc_ships_appdata.side_effect = lambda pkg_path: "gui" in os.path.basename(pkg_path)
+        cli = self.add_build("00000001-cli", "cli-1.0-1.x86_64.rpm")
+
+        # headless project
+        add_appdata(self.tmp_dir_name, self.username, self.projectname)
+        assert not mc_run_cmd_unsafe.called
+
+        gui = self.add_build("00000002-gui", "gui-1.0-1.x86_64.rpm")
+        add_appdata(self.tmp_dir_name, self.username, self.projectname)
+        builder_cmd = mc_run_cmd_unsafe.call_args_list[0][0][0]
+        assert builder_cmd.startswith("/usr/bin/timeout")
+        assert builder_cmd.endswith(" " + os.path.join(self.tmp_dir_name, gui[0]))
+        assert "--old-metadata" not in builder_cmd
+        assert cli[0] not in builder_cmd
+
+        # appstream-builder produced metadata
+        os.makedirs(os.path.join(self.tmp_dir_name, "appdata"))
+        with open(os.path.join(self.tmp_dir_name, "appdata", "appstream.xml.gz"), "w") as handle:
+            handle.write("1")
+
+        # no new package with appdata, metadata only get included again
+        mc_run_cmd_unsafe.reset_mock()
+        self.add_build("00000003-cli", "cli-2.0-1.x86_64.rpm")
+        add_appdata(self.tmp_dir_name, self.username, self.projectname)
+        assert [call[0][0].split()[0] for call in mc_run_cmd_unsafe.call_args_list] == \
+            ["/usr/bin/modifyrepo_c"]
+
+        mc_run_cmd_unsafe.reset_mock()
+        gui2 = self.add_build("00000004-gui", "gui-2.0-1.x86_64.rpm")
+        add_appdata(self.tmp_dir_name, self.username, self.projectname)
+        builder_cmd = mc_run_cmd_unsafe.call_args_list[0][0][0]
+        assert "--old-metadata={}/appdata".format(self.tmp_dir_name) in builder_cmd
+        assert builder_cmd.endswith(" ".join(os.path.join(self.tmp_dir_name, pkg) for pkg in gui + gui2))
+
+        # last package with appdata is gone
+        mc_run_cmd_unsafe.reset_mock()
+        pkglist = os.path.join(self.tmp_dir_name, ".createrepo.pkglist")
+        with open(pkglist, "w") as handle:
+            handle.write("\n".join(cli) + "\n")
+        add_appdata(self.tmp_dir_name, self.username, self.projectname, pkglist=pkglist)
+        assert not mc_run_cmd_unsafe.called
+        assert not os.path.exists(os.path.join(self.tmp_dir_name, "appdata"))
@@ -135,3 +135,34 @@ class TestFrontendClient(object):
         expected = mock.call({'build_id': self.build_id, 'chroot': self.chroot_name},
                              'reschedule_build_chroot')
         assert ptfr.call_args == expected
+
+    def test_lease_builds(self, mask_post_to_fe):
+        builds = [{"task_id": "12345-fedora-20-x86_64"}]
+        self.ptf.return_value.json.return_value = {"builds": builds}
+
+        assert self.fc.lease_builds(5) == builds
+        assert self.ptf.call_args == mock.call({"count": 5}, "lease_builds")
+
+    def test_lease_builds_capacity(self, mask_post_to_fe):
+        self.ptf.return_value.json.return_value = {"builds": []}
+        capacity = [{"archs": ["x86_64"], "count": 2, "max_per_owner": 4, "owners_in_use": {}}]
+
+        assert self.fc.lease_builds(2, capacity) == []
+        assert self.ptf.call_args == mock.call({"count": 2, "capacity": capacity}, "lease_builds")
+
+    def test_lease_builds_err(self, mask_post_to_fe):
+        self.ptf.return_value.json.return_value = {}
+
+        with pytest.raises(RequestException):
+            self.fc.lease_builds(5)
+
+    def test_get_queue_stats(self, mask_post_to_fe):
+        stats = {"x86_64": {"pending": 3, "running": 1, "avg_duration": 600.0}}
+        self.ptf.return_value.json.return_value = {"archs": stats}
+
+        assert self.fc.get_queue_stats() == stats
+        assert self.ptf.call_args == mock.call({}, "queue_stats")
+
+        self.ptf.return_value.json.return_value = {}
+        with pytest.raises(RequestException):
+            self.fc.get_queue_stats()
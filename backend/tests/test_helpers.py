@@ -16,9 +16,12 @@ import six
 from backend.exceptions import CoprSpawnFailError
 
 from backend.exceptions import BuilderError
-from backend.helpers import get_redis_connection, get_redis_logger, BackendConfigReader
+from backend.constants import NEW_WORK_PUB_SUB
+from backend.helpers import get_redis_connection, get_redis_logger, BackendConfigReader, NewWorkListener, \
+    ProjectFlagsCache
+from copr.exceptions import CoprRequestException
 from backend.vm_manage import EventTopics, PUBSUB_MB
-from backend.vm_manage.check import HealthChecker, check_health
+from backend.vm_manage.check import HealthChecker, check_health_batch
 
 if six.PY3:
     from unittest import mock
@@ -53,3 +56,97 @@ class TestHelpers(object):
             raise BuilderError("foobar", return_code=1, stdout="STDOUT", stderr="STDERR")
         except Exception as err:
             log.exception("error occurred: {}".format(err))
+
+
+class TestNewWorkListener(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            frontend_redis_host="127.0.0.1",
+            frontend_redis_port=7777,
+        )
+        self.rc = get_redis_connection(Munch(redis_port=7777))
+        self.listener = NewWorkListener(self.opts, "build")
+        self.listener.subscribe()
+
+    def test_wait_notified(self):
+        self.rc.publish(NEW_WORK_PUB_SUB, "build")
+        self.rc.publish(NEW_WORK_PUB_SUB, "build")
+        t0 = time.time()
+        assert self.listener.wait(5)
+        assert time.time() - t0 < 1
+        # both announcements were consumed at once
+        assert not self.listener.wait(0.1)
+
+    def test_wait_ignores_other_kinds(self):
+        self.rc.publish(NEW_WORK_PUB_SUB, "action")
+        assert not self.listener.wait(0.3)
+
+    def test_wait_timeout(self):
+        t0 = time.time()
+        assert not self.listener.wait(0.3)
+        assert time.time() - t0 >= 0.3
+
+    def test_wait_disabled(self):
+        self.opts.frontend_redis_host = None
+        listener = NewWorkListener(self.opts, "build")
+        with mock.patch("{}.time".format(MODULE_REF)) as mc_time:
+            assert not listener.wait(10)
+            assert mc_time.sleep.call_args == mock.call(10)
+
+    def test_wait_redis_error(self):
+        self.opts.frontend_redis_port = 1
+        listener = NewWorkListener(self.opts, "build")
+        with mock.patch("{}.time".format(MODULE_REF)) as mc_time:
+            mc_time.time.return_value = 100
+            assert not listener.wait(10)
+            assert mc_time.sleep.called
+        assert listener.pubsub is None
+
+
+class TestProjectFlagsCache(object):
+
+    def setup_method(self, method):
+        self.opts = Munch(
+            redis_db=9,
+            redis_port=7777,
+            frontend_base_url="http://example.com",
+            project_flags_ttl=3600,
+        )
+        self.cache = ProjectFlagsCache(self.opts)
+        self.cache.rc.flushdb()
+
+    def teardown_method(self, method):
+        self.cache.rc.flushdb()
+
+    @mock.patch("{}.get_project_flags".format(MODULE_REF))
+    def test_get(self, mc_get_flags):
+        mc_get_flags.return_value = {"auto_createrepo": False, "persistent": True}
+
+        assert self.cache.get("foo", "bar", "auto_createrepo") is False
+        assert self.cache.get("foo", "bar", "persistent") is True
+        assert mc_get_flags.call_count == 1
+
+        # payload values, nothing is fetched
+        self.cache.update("foo", "bar", auto_createrepo=True, persistent=None)
+        assert self.cache.get("foo", "bar", "auto_createrepo") is True
+        assert self.cache.get("foo", "bar", "persistent") is True
+        assert mc_get_flags.call_count == 1
+
+        self.cache.invalidate("foo", "bar")
+        assert self.cache.get("foo", "bar", "auto_createrepo") is False
+        assert mc_get_flags.call_count == 2
+
+    @mock.patch("{}.get_project_flags".format(MODULE_REF))
+    def test_get_expired(self, mc_get_flags):
+        self.cache.update("foo", "bar", auto_createrepo=True, persistent=False)
+        self.opts.project_flags_ttl = 0
+
+        mc_get_flags.return_value = {"auto_createrepo": False, "persistent": False}
+        assert self.cache.get("foo", "bar", "auto_createrepo") is False
+
+        # frontend unavailable, old value is better than nothing
+        mc_get_flags.side_effect = CoprRequestException("unavailable")
+        assert self.cache.get("foo", "bar", "auto_createrepo") is False
+        with pytest.raises(CoprRequestException):
+            self.cache.get("foo", "baz", "auto_createrepo")
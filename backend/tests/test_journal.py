@@ -0,0 +1,74 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+
+from munch import Munch
+
+from backend.job import BuildJob
+from backend.journal import JobJournal
+
+
+class TestJobJournal(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.opts = Munch(
+            job_journal_dir=os.path.join(self.tmp_dir, "jobs"),
+            destdir="/var/lib/copr/public_html/results",
+            results_baseurl="http://example.com/results",
+            timeout=1800,
+        )
+        self.journal = JobJournal(self.opts)
+        self.vm = Munch(vm_name="vm_0", vm_ip="127.0.0.1")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_job(self, build_id, started_on):
+        job = BuildJob({
+            "task_id": "{}-fedora-24-x86_64".format(build_id),
+            "build_id": build_id,
+            "chroot": "fedora-24-x86_64",
+            "project_owner": "bob",
+            "project_name": "foo",
+            "repos": "http://example.com/repo1 http://example.com/repo2",
+            "package_name": "foo",
+        }, self.opts)
+        job.started_on = started_on
+        return job
+
+    def test_record_and_restore(self):
+        job = self.get_job(20, 100)
+        self.journal.record(job, self.vm)
+
+        entry = self.journal.get(job.task_id)
+        assert entry["vm_name"] == "vm_0"
+        assert entry["started_on"] == 100
+        assert entry["build_state"] is None
+
+        restored = BuildJob(entry["task"], self.opts)
+        assert restored.task_id == job.task_id
+        assert restored.repos == job.repos
+        assert restored.destdir == job.destdir
+        assert restored.mockchain_macros == job.mockchain_macros
+
+    def test_update_remove_entries(self):
+        assert self.journal.entries() == []
+
+        self.journal.record(self.get_job(21, 200), self.vm)
+        self.journal.record(self.get_job(20, 100), self.vm)
+        self.journal.update("21-fedora-24-x86_64", build_state={"remote_tempdir": "/tmp/x"})
+        # nothing happens for unknown jobs
+        self.journal.update("22-fedora-24-x86_64", build_state={})
+        self.journal.remove("23-fedora-24-x86_64")
+
+        entries = self.journal.entries()
+        assert [e["task"]["build_id"] for e in entries] == [20, 21]
+        assert entries[1]["build_state"] == {"remote_tempdir": "/tmp/x"}
+        assert sorted(os.listdir(self.opts.job_journal_dir)) == \
+            ["20-fedora-24-x86_64.json", "21-fedora-24-x86_64.json"]
+
+        self.journal.remove("20-fedora-24-x86_64")
+        assert [e["task"]["build_id"] for e in self.journal.entries()] == [21]
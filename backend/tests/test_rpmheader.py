@@ -0,0 +1,126 @@
+# coding: utf-8
+
+import os
+import shutil
+import struct
+import tempfile
+
+import pytest
+
+from backend.exceptions import RpmHeaderError
+from backend.rpmheader import get_package_info, collect_packages_info, get_file_names, \
+    RPM_LEAD_MAGIC, RPM_HEADER_MAGIC, TYPE_INT32, TYPE_INT64, TYPE_STRING, TYPE_STRING_ARRAY, \
+    TAG_NAME, TAG_VERSION, TAG_RELEASE, TAG_EPOCH, TAG_SIZE, TAG_ARCH, TAG_SOURCERPM, TAG_LONGSIZE, \
+    TAG_DIRINDEXES, TAG_BASENAMES, TAG_DIRNAMES
+
+
+def make_header(tags):
+    index = b""
+    store = b""
+    for tag, tag_type, value in tags:
+        # lists are stored as arrays
+        values = value if isinstance(value, list) else [value]
+        if tag_type == TYPE_INT32:
+            store += b"\0" * (-len(store) % 4)
+            data = b"".join(struct.pack(">I", item) for item in values)
+        elif tag_type == TYPE_INT64:
+            store += b"\0" * (-len(store) % 8)
+            data = b"".join(struct.pack(">Q", item) for item in values)
+        else:
+            data = b"".join(item.encode("utf-8") + b"\0" for item in values)
+        index += struct.pack(">IIII", tag, tag_type, len(store), len(values))
+        store += data
+    return RPM_HEADER_MAGIC + b"\0" * 4 + struct.pack(">II", len(tags), len(store)) + index + store
+
+
+def make_rpm(path, name="foo", version="1.0", release="1.fc24", arch="x86_64",
+             epoch=None, size=1234, longsize=None, srpm=False, files=None):
+    tags = [
+        (TAG_NAME, TYPE_STRING, name),
+        (TAG_VERSION, TYPE_STRING, version),
+        (TAG_RELEASE, TYPE_STRING, release),
+        (TAG_SIZE, TYPE_INT32, size),
+        (TAG_ARCH, TYPE_STRING, arch),
+    ]
+    if epoch is not None:
+        tags.append((TAG_EPOCH, TYPE_INT32, epoch))
+    if longsize is not None:
+        tags.append((TAG_LONGSIZE, TYPE_INT64, longsize))
+    if not srpm:
+        tags.append((TAG_SOURCERPM, TYPE_STRING, "{}-{}-{}.src.rpm".format(name, version, release)))
+    if files:
+        dir_names = sorted(set(os.path.dirname(name) + "/" for name in files))
+        tags.extend([
+            (TAG_DIRINDEXES, TYPE_INT32, [dir_names.index(os.path.dirname(name) + "/") for name in files]),
+            (TAG_BASENAMES, TYPE_STRING_ARRAY, [os.path.basename(name) for name in files]),
+            (TAG_DIRNAMES, TYPE_STRING_ARRAY, dir_names),
+        ])
+
+    # signature store of 4 bytes gets padded to 8
+    signature = make_header([(1000, TYPE_INT32, 42)])
+    with open(path, "wb") as handle:
+        handle.write(RPM_LEAD_MAGIC + b"\0" * 92 + signature + b"\0" * 4 + make_header(tags))
+        handle.write(b"payload")
+
+
+class TestRpmHeader(object):
+
+    def setup_method(self, method):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_package_info(self):
+        path = os.path.join(self.tmp_dir, "foo.rpm")
+        make_rpm(path, epoch=2)
+        assert get_package_info(path) == {
+            "name": "foo", "epoch": 2, "version": "1.0", "release": "1.fc24",
+            "arch": "x86_64", "size": 1234,
+        }
+
+        make_rpm(path, size=1, longsize=2 ** 33)
+        assert get_package_info(path)["size"] == 2 ** 33
+        assert get_package_info(path)["epoch"] is None
+
+        make_rpm(path, srpm=True)
+        assert get_package_info(path)["arch"] == "src"
+
+    def test_get_package_info_not_rpm(self):
+        path = os.path.join(self.tmp_dir, "foo.rpm")
+        with open(path, "wb") as handle:
+            handle.write(b"\0" * 200)
+        with pytest.raises(RpmHeaderError):
+            get_package_info(path)
+
+        make_rpm(path)
+        with open(path, "rb") as handle:
+            data = handle.read()
+        with open(path, "wb") as handle:
+            handle.write(data[:150])
+        with pytest.raises(RpmHeaderError):
+            get_package_info(path)
+
+    def test_collect_packages_info(self):
+        make_rpm(os.path.join(self.tmp_dir, "foo-1.0-1.fc24.x86_64.rpm"))
+        make_rpm(os.path.join(self.tmp_dir, "foo-devel-1.0-1.fc24.noarch.rpm"),
+                 name="foo-devel", arch="noarch")
+        make_rpm(os.path.join(self.tmp_dir, "foo-1.0-1.fc24.src.rpm"), srpm=True)
+        with open(os.path.join(self.tmp_dir, "build.log"), "w") as handle:
+            handle.write("log")
+
+        packages = collect_packages_info(self.tmp_dir)
+        assert [(pkg["name"], pkg["arch"]) for pkg in packages] == \
+            [("foo", "x86_64"), ("foo-devel", "noarch")]
+
+        packages = collect_packages_info(self.tmp_dir, include_srpm=True)
+        assert [pkg["arch"] for pkg in packages] == ["src", "x86_64", "noarch"]
+
+    def test_get_file_names(self):
+        path = os.path.join(self.tmp_dir, "foo.rpm")
+        files = ["/usr/bin/foo", "/usr/share/applications/foo.desktop", "/usr/share/doc/foo/README"]
+        make_rpm(path, files=files)
+        assert get_file_names(path) == files
+
+        make_rpm(path)
+        assert get_file_names(path) == []
@@ -1,6 +1,7 @@
 import os
 import tempfile
 import shutil
+import threading
 import time
 
 from munch import Munch
@@ -33,7 +34,7 @@ class TestSign(object):
         self.test_time = time.time()
         self.tmp_dir_path = None
 
-        self.opts = Munch(keygen_host="example.com")
+        self.opts = Munch(keygen_host="example.com", sign_max_workers=4)
 
     def teardown_method(self, method):
         if self.tmp_dir_path:
@@ -277,3 +278,39 @@ class TestSign(object):
 
         assert mc_so.called
 
+    @mock.patch("backend.sign._sign_one")
+    @mock.patch("backend.sign.create_user_keys")
+    @mock.patch("backend.sign.get_pubkey")
+    def test_sign_rpms_id_dir_parallel(self, mc_gp, mc_cuk, mc_so, tmp_dir):
+        rpm_names = ["pkg{}.rpm".format(num) for num in range(10)]
+        for name in rpm_names:
+            with open(os.path.join(self.tmp_dir_path, name), "w") as handle:
+                handle.write("1")
+
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def sign_one(path, email):
+            with lock:
+                running.append(path)
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(path)
+            if path.endswith("pkg3.rpm"):
+                raise CoprSignError("foobar")
+
+        mc_so.side_effect = sign_one
+        self.opts.sign_max_workers = 3
+        log = MagicMock()
+        with pytest.raises(CoprSignError) as err:
+            sign_rpms_in_dir(self.username, self.projectname,
+                             self.tmp_dir_path, self.opts, log=log)
+
+        assert mc_gp.call_count == 1
+        assert mc_so.call_count == 10
+        assert max(max_running) == 3
+        assert "pkg3.rpm" in str(err.value)
+        assert "pkg4.rpm" not in str(err.value)
+        assert log.info.call_count == 9
@@ -0,0 +1,87 @@
+# coding: utf-8
+
+from backend.vm_manage.autoscale import Autoscaler, AutoscaleDecision
+
+
+class TestAutoscaler(object):
+
+    def setup_method(self, method):
+        self.group_opts = {
+            "name": "base",
+            "archs": ["i386", "x86_64"],
+            "max_vm_total": 10,
+            "max_spawn_processes": 4,
+            "min_vm_ready": 1,
+            "max_vm_in_ready_state": 2,
+            "vm_spawn_time": 300,
+        }
+        self.autoscaler = Autoscaler(self.group_opts)
+
+    def snapshot(self, pending=0, running=0, avg_duration=None, ready=0, in_use=0,
+                 starting=0, unavailable=0, spawning=0):
+        return {
+            "queue_stats": {
+                "x86_64": {"pending": pending, "running": running, "avg_duration": avg_duration},
+                "armhfp": {"pending": 100, "running": 0, "avg_duration": 10},
+            },
+            "ready": ready,
+            "in_use": in_use,
+            "starting": starting,
+            "unavailable": unavailable,
+            "spawning": spawning,
+        }
+
+    def test_get_demand(self):
+        queue_stats = {
+            "i386": {"pending": 1, "running": 1, "avg_duration": 100},
+            "x86_64": {"pending": 2, "running": 0, "avg_duration": 400},
+            "armhfp": {"pending": 5, "running": 0, "avg_duration": None},
+        }
+        assert self.autoscaler.get_demand(queue_stats) == (3, 250.0)
+        assert self.autoscaler.get_demand({}) == (0, None)
+
+    def test_keeps_warm_vm(self):
+        assert self.autoscaler.decide(self.snapshot()) == AutoscaleDecision(1, 0)
+        assert self.autoscaler.decide(self.snapshot(spawning=1)) == AutoscaleDecision(0, 0)
+        assert self.autoscaler.decide(self.snapshot(ready=1)) == AutoscaleDecision(0, 0)
+
+    def test_burst_spawns_in_parallel(self):
+        decision = self.autoscaler.decide(self.snapshot(pending=20, ready=1))
+        assert decision == AutoscaleDecision(self.group_opts["max_spawn_processes"], 0)
+
+        # limited by max_vm_total
+        decision = self.autoscaler.decide(self.snapshot(pending=20, ready=1, in_use=7))
+        assert decision == AutoscaleDecision(2, 0)
+
+        # VMs which failed the health check still count towards max_vm_total
+        decision = self.autoscaler.decide(self.snapshot(pending=20, ready=1, in_use=7, unavailable=2))
+        assert decision == AutoscaleDecision(0, 0)
+
+    def test_short_builds_reuse_running_vms(self):
+        # builds take 60s and spawn 300s, all VMs in use get free before a new one is ready
+        decision = self.autoscaler.decide(
+            self.snapshot(pending=3, running=4, avg_duration=60, ready=1, in_use=4))
+        assert decision == AutoscaleDecision(0, 0)
+
+        # long builds don't free VMs soon enough
+        decision = self.autoscaler.decide(
+            self.snapshot(pending=3, running=4, avg_duration=3000, ready=1, in_use=4))
+        assert decision == AutoscaleDecision(3, 0)
+
+    def test_terminates_surplus(self):
+        assert self.autoscaler.decide(self.snapshot(ready=5)) == AutoscaleDecision(0, 3)
+        assert self.autoscaler.decide(self.snapshot(ready=5, pending=1)) == AutoscaleDecision(0, 0)
+
+    def test_replay_trace(self):
+        # queue fills up, VMs get spawned and used, queue drains
+        trace = [
+            self.snapshot(ready=1),
+            self.snapshot(pending=6, ready=1),
+            self.snapshot(pending=6, ready=1, spawning=4),
+            self.snapshot(pending=2, running=5, avg_duration=1200, in_use=5, ready=1),
+            self.snapshot(running=5, avg_duration=1200, in_use=5, ready=1),
+            self.snapshot(ready=6),
+        ]
+        decisions = self.autoscaler.replay(trace)
+        assert [d.spawn for d in decisions] == [0, 4, 0, 1, 0, 0]
+        assert [d.terminate for d in decisions] == [0, 0, 0, 0, 0, 4]
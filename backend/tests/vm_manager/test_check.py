@@ -14,8 +14,8 @@ import six
 from backend.exceptions import CoprSpawnFailError
 
 from backend.helpers import get_redis_connection
-from backend.vm_manage import EventTopics, PUBSUB_MB
-from backend.vm_manage.check import HealthChecker, check_health
+from backend.vm_manage import EventTopics, PUBSUB_MB, KEY_VM_INSTANCE, VmStates
+from backend.vm_manage.check import HealthChecker, check_health_batch
 
 if six.PY3:
     from unittest import mock
@@ -120,6 +120,12 @@ class TestChecker(object):
         if keys:
             self.rc.delete(*keys)
 
+    def get_published_results(self, mc_rc):
+        assert mc_rc.publish.call_args[0][0] == PUBSUB_MB
+        msg = json.loads(mc_rc.publish.call_args[0][1])
+        assert msg["topic"] == EventTopics.HEALTH_CHECK_BATCH
+        return dict((result["vm_name"], result) for result in msg["results"])
+
     def test_check_health_runner_no_response(self, mc_ans_runner, mc_grc):
         mc_runner = MagicMock()
         mc_ans_runner.return_value = mc_runner
@@ -129,11 +135,10 @@ class TestChecker(object):
         mc_grc.return_value = mc_rc
 
         # didn't raise exception
-        check_health(self.opts, self.vm_name, self.vm_ip)
-        assert mc_rc.publish.call_args[0][0] == PUBSUB_MB
-        dict_result = json.loads(mc_rc.publish.call_args[0][1])
-        assert dict_result["result"] == "failed"
-        assert "VM is not responding to the testing playbook." in dict_result["msg"]
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip)])
+        result = self.get_published_results(mc_rc)[self.vm_name]
+        assert result["result"] == "failed"
+        assert "VM is not responding to the testing playbook." in result["msg"]
 
     def test_check_health_runner_exception(self, mc_ans_runner, mc_grc):
         mc_conn = MagicMock()
@@ -144,37 +149,70 @@ class TestChecker(object):
         mc_grc.return_value = mc_rc
 
         # didn't raise exception
-        check_health(self.opts, self.vm_name, self.vm_ip)
-        assert mc_rc.publish.call_args[0][0] == PUBSUB_MB
-        dict_result = json.loads(mc_rc.publish.call_args[0][1])
-        assert dict_result["result"] == "failed"
-        assert "Failed to check  VM" in dict_result["msg"]
-        assert "due to ansible error:" in dict_result["msg"]
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip), ("other", "127.0.0.2")])
+        results = self.get_published_results(mc_rc)
+        assert set(results) == set([self.vm_name, "other"])
+        for result in results.values():
+            assert result["result"] == "failed"
+            assert "Failed to check VMs" in result["msg"]
+            assert "due to ansible error:" in result["msg"]
 
     def test_check_health_runner_ok(self, mc_ans_runner, mc_grc):
         mc_conn = MagicMock()
         mc_ans_runner.return_value = mc_conn
-        mc_conn.run.return_value = {"contacted": [self.vm_ip]}
+        mc_conn.run.return_value = {"contacted": {self.vm_ip: {}}, "dark": {"127.0.0.2": {}}}
 
         mc_rc = MagicMock()
         mc_grc.return_value = mc_rc
 
         # didn't raise exception
-        check_health(self.opts, self.vm_name, self.vm_ip)
-        assert mc_rc.publish.call_args[0][0] == PUBSUB_MB
-        dict_result = json.loads(mc_rc.publish.call_args[0][1])
-        assert dict_result["result"] == "OK"
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip), ("other", "127.0.0.2")])
+        results = self.get_published_results(mc_rc)
+        assert results[self.vm_name]["result"] == "OK"
+        assert results["other"]["result"] == "failed"
+
+        # one runner checks all VMs
+        assert mc_ans_runner.call_count == 1
+        assert mc_ans_runner.call_args[1]["host_list"] == "{},127.0.0.2,".format(self.vm_ip)
+        assert mc_ans_runner.call_args[1]["forks"] == 2
 
     def test_check_health_pubsub_publish_error(self, mc_ans_runner, mc_grc):
         mc_conn = MagicMock()
         mc_ans_runner.return_value = mc_conn
-        mc_conn.run.return_value = {"contacted": [self.vm_ip]}
+        mc_conn.run.return_value = {"contacted": {self.vm_ip: {}}}
 
         mc_grc.side_effect = ConnectionError()
 
         # didn't raise exception
-        check_health(self.opts, self.vm_name, self.vm_ip)
+        check_health_batch(self.opts, [(self.vm_name, self.vm_ip)])
 
         assert mc_conn.run.called
         assert mc_grc.called
 
+    def test_start_pending_checks(self):
+        self.checker.run_detached = MagicMock()
+        self.checker.start_pending_checks()
+        assert not self.checker.run_detached.called
+
+        self.checker.run_check_health(self.vm_name, self.vm_ip)
+        self.checker.run_check_health("other", "127.0.0.2")
+        self.checker.start_pending_checks()
+        assert self.checker.run_detached.call_args == mock.call(
+            check_health_batch, args=(self.opts, [(self.vm_name, self.vm_ip), ("other", "127.0.0.2")]))
+
+        self.checker.start_pending_checks()
+        assert self.checker.run_detached.call_count == 1
+
+    def test_start_pending_checks_restores_states(self):
+        for vm_name, state in [(self.vm_name, VmStates.CHECK_HEALTH), ("other", VmStates.IN_USE)]:
+            self.rc.hmset(KEY_VM_INSTANCE.format(vm_name=vm_name),
+                          {"vm_name": vm_name, "group": self.group, "state": state})
+        self.checker.run_detached = MagicMock(side_effect=RuntimeError())
+
+        self.checker.run_check_health(self.vm_name, self.vm_ip, VmStates.READY)
+        self.checker.run_check_health("other", "127.0.0.2", VmStates.IN_USE)
+        self.checker.start_pending_checks()
+
+        assert self.rc.hget(KEY_VM_INSTANCE.format(vm_name=self.vm_name), "state") == VmStates.READY
+        assert self.rc.hget(KEY_VM_INSTANCE.format(vm_name="other"), "state") == VmStates.IN_USE
+        assert not self.checker.pending_checks
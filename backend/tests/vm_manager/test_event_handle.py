@@ -13,7 +13,7 @@ import six
 
 from backend.exceptions import VmDescriptorNotFound
 from backend.helpers import get_redis_connection
-from backend.vm_manage import VmStates
+from backend.vm_manage import VmStates, EventTopics
 from backend.vm_manage.event_handle import EventHandler, Recycle
 from backend.vm_manage.models import VmDescriptor
 
@@ -174,6 +174,15 @@ class TestEventHandle(object):
         self.eh.on_health_check_result(self.msg)
         assert not self.eh.lua_scripts["on_health_check_success"].called
 
+    def test_health_check_batch_result(self):
+        self.eh.on_health_check_result = MagicMock()
+        self.eh.on_health_check_result.side_effect = [IOError(), None]
+        results = [{"vm_name": "a", "result": "OK"}, {"vm_name": "b", "result": "failed"}]
+
+        self.eh.on_health_check_batch_result({"topic": EventTopics.HEALTH_CHECK_BATCH,
+                                              "results": results})
+        assert self.eh.on_health_check_result.call_args_list == [mock.call(r) for r in results]
+
     def test_health_check_result_on_ok(self):
         # on success should change state from "check_health" to "ready"
         # and reset check fails to zero
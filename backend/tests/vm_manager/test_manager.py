@@ -11,7 +11,8 @@ import six
 
 from backend import exceptions
 from backend.exceptions import VmError, NoVmAvailable
-from backend.vm_manage import VmStates, KEY_VM_POOL, PUBSUB_MB, EventTopics, KEY_SERVER_INFO
+from backend.vm_manage import VmStates, KEY_VM_POOL, PUBSUB_MB, EventTopics, KEY_SERVER_INFO, \
+    KEY_VM_STATE_INDEX, KEY_VM_IP_INDEX, PUBSUB_INTERRUPT_BUILDER, INTERRUPT_BUILD_CANCELED, KEY_BUILD_CANCELED
 from backend.vm_manage.manager import VmManager
 from backend.daemons.vm_master import VmMaster
 from backend.helpers import get_redis_connection
@@ -66,6 +67,7 @@ class TestManager(object):
             sleeptime=0.1,
             do_sign=True,
             timeout=1800,
+            vm_lease_timeout=120,
             # destdir=self.tmp_dir_path,
             results_baseurl="/tmp",
         )
@@ -177,6 +179,27 @@ class TestManager(object):
         for k, v in kwargs.items():
             assert vmd_got.get_field(self.rc, k) == v
 
+    def test_renew_vm_lease(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+
+        mc_time.time.return_value = 10
+        self.vmm.acquire_vm(self.group, self.username, self.pid, task_id="20-fedora-20-x86_64")
+        assert float(vmd.get_field(self.rc, "lease_expires")) == 130
+
+        mc_time.time.return_value = 100
+        assert not self.vmm.renew_vm_lease(self.vm_name, "21-fedora-20-x86_64")
+        assert float(vmd.get_field(self.rc, "lease_expires")) == 130
+        assert self.vmm.renew_vm_lease(self.vm_name, "20-fedora-20-x86_64")
+        assert float(vmd.get_field(self.rc, "lease_expires")) == 220
+
+        self.vmm.release_vm(self.vm_name)
+        assert vmd.get_field(self.rc, "lease_expires") is None
+        assert not self.vmm.renew_vm_lease(self.vm_name, "20-fedora-20-x86_64")
+
     def test_acquire_vm(self, mc_time):
         mc_time.time.return_value = 0
         self.vmm.mark_server_start()
@@ -198,6 +221,41 @@ class TestManager(object):
         with pytest.raises(NoVmAvailable):
             self.vmm.acquire_vm(group=self.group, username=self.username, pid=self.pid)
 
+    def test_acquire_vm_prefers_warm_chroot(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+
+        for vm_name, warm_chroots in [("cold", None), ("other", "epel-7-x86_64"),
+                                      ("warm", "epel-7-x86_64 fedora-20-x86_64")]:
+            vmd = self.vmm.add_vm_to_pool(self.vm_ip, vm_name, self.group)
+            vmd.store_field(self.rc, "state", VmStates.READY)
+            vmd.store_field(self.rc, "last_health_check", 2)
+            vmd.store_field(self.rc, "bound_to_user", self.username)
+            if warm_chroots:
+                vmd.store_field(self.rc, "warm_chroots", warm_chroots)
+
+        vmd_got = self.vmm.acquire_vm(self.group, self.username, self.pid, chroot="fedora-20-x86_64")
+        assert vmd_got.vm_name == "warm"
+        vmd_got = self.vmm.acquire_vm(self.group, self.username, self.pid, chroot="epel-7-x86_64")
+        assert vmd_got.vm_name == "other"
+
+    def test_release_vm_marks_chroot_warm(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+
+        for chroot in ["fedora-20-x86_64", "epel-7-x86_64", "fedora-20-x86_64"]:
+            self.vmm.acquire_vm(self.group, self.username, self.pid, chroot=chroot)
+            assert self.vmm.release_vm(self.vm_name)
+
+        vmd = self.vmm.get_vm_by_name(self.vm_name)
+        assert vmd.warm_chroots == "fedora-20-x86_64 epel-7-x86_64"
+        assert vmd.is_warm_for("epel-7-x86_64")
+        assert not vmd.is_warm_for("fedora-21-x86_64")
+        assert not vmd.is_warm_for(None)
+
     def test_acquire_vm_per_user_limit(self, mc_time):
         mc_time.time.return_value = 0
         self.vmm.mark_server_start()
@@ -215,10 +273,41 @@ class TestManager(object):
 
         with pytest.raises(NoVmAvailable):
             self.vmm.acquire_vm(0, self.username, 42)
+        assert self.vmm.get_user_usage(0) == {self.username: max_vm_per_user}
 
-        acquired_vmd_list[-1].store_field(self.rc, "state", VmStates.READY)
+        # limit is enforced by the lua script itself as well
+        self.vmm.can_user_acquire_more_vm = types.MethodType(MagicMock(return_value=True), self.vmm)
+        with pytest.raises(NoVmAvailable):
+            self.vmm.acquire_vm(0, self.username, 42)
+
+        self.vmm.release_vm(vmd.vm_name)
+        assert self.vmm.get_user_usage(0) == {self.username: max_vm_per_user - 1}
         self.vmm.acquire_vm(0, self.username, 42)
 
+    def test_user_usage_on_termination(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+
+        self.vmm.acquire_vm(0, self.username, 42)
+        assert self.vmm.get_user_usage(0) == {self.username: 1}
+
+        self.vmm.start_vm_termination(self.vm_name, allowed_pre_state=VmStates.IN_USE)
+        assert self.vmm.get_user_usage(0) == {}
+
+    def test_recount_user_usage(self):
+        for idx, (state, user) in enumerate([(VmStates.IN_USE, "bob"), (VmStates.IN_USE, "bob"),
+                                             (VmStates.IN_USE, "alice"), (VmStates.READY, "alice")]):
+            vmd = self.vmm.add_vm_to_pool("127.0.{}.1".format(idx), "vm_{}".format(idx), self.group)
+            vmd.store_field(self.rc, "state", state)
+            vmd.store_field(self.rc, "bound_to_user", user)
+
+        self.vmm.mark_server_start()
+        assert self.vmm.get_user_usage(0) == {"bob": 2, "alice": 1}
+
     def test_acquire_only_ready_state(self, mc_time):
         mc_time.time.return_value = 0
         self.vmm.mark_server_start()
@@ -290,6 +379,34 @@ class TestManager(object):
         assert data["topic"] == EventTopics.VM_TERMINATION_REQUEST
         assert data["vm_name"] == self.vm_name
 
+    def test_interrupt_build(self):
+        self.vmm.mark_server_start()
+        for idx, (build_id, chroot) in enumerate([("10", "fedora-20-x86_64"), ("10", "epel-7-x86_64"),
+                                                   ("11", "fedora-20-x86_64")]):
+            vmd = self.vmm.add_vm_to_pool("127.0.0.{}".format(idx + 1), "vm_{}".format(idx), self.group)
+            vmd.store_field(self.rc, "state", VmStates.READY)
+            vmd.store_field(self.rc, "last_health_check", time.time() + 1)
+            self.vmm.acquire_vm(self.group, self.username, self.pid, task_id="{}-{}".format(build_id, chroot),
+                                build_id=build_id, chroot=chroot)
+
+        self.ps = self.vmm.rc.pubsub(ignore_subscribe_messages=True)
+        self.ps.psubscribe(PUBSUB_INTERRUPT_BUILDER.format("*"))
+
+        assert self.vmm.interrupt_build(10, chroot="epel-7-x86_64") == 1
+        assert self.rc.exists(KEY_BUILD_CANCELED.format(task_id="10-epel-7-x86_64"))
+        assert not self.rc.exists(KEY_BUILD_CANCELED.format(task_id="10-fedora-20-x86_64"))
+        assert self.vmm.interrupt_build(10) == 2
+        assert self.vmm.interrupt_build(12) == 0
+
+        rcv_msg_list = self.rcv_from_ps_message_bus()
+        channels = [msg["channel"] for msg in rcv_msg_list]
+        assert channels[0] == PUBSUB_INTERRUPT_BUILDER.format("127.0.0.2")
+        assert sorted(channels[1:]) == [PUBSUB_INTERRUPT_BUILDER.format("127.0.0.1"),
+                                        PUBSUB_INTERRUPT_BUILDER.format("127.0.0.2")]
+        assert all(msg["data"] == INTERRUPT_BUILD_CANCELED for msg in rcv_msg_list)
+        assert self.rc.ttl(KEY_BUILD_CANCELED.format(task_id="10-fedora-20-x86_64")) > 0
+        assert not self.rc.exists(KEY_BUILD_CANCELED.format(task_id="11-fedora-20-x86_64"))
+
     def test_start_vm_termination_2(self):
         self.ps = self.vmm.rc.pubsub(ignore_subscribe_messages=True)
         self.ps.subscribe(PUBSUB_MB)
@@ -387,6 +504,82 @@ class TestManager(object):
         assert r3[0].vm_name == "a1"
         assert r3[1].vm_name == "a2"
 
+    def get_state_index(self, state, group=0):
+        return self.rc.smembers(KEY_VM_STATE_INDEX.format(group=group, state=state))
+
+    def test_state_index_follows_transitions(self, mc_time):
+        mc_time.time.return_value = 0
+        self.vmm.mark_server_start()
+
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        assert self.get_state_index(VmStates.GOT_IP) == set([self.vm_name])
+
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        vmd.store_field(self.rc, "last_health_check", 2)
+        assert self.get_state_index(VmStates.GOT_IP) == set()
+        assert self.get_state_index(VmStates.READY) == set([self.vm_name])
+
+        self.vmm.acquire_vm(self.group, self.username, self.pid)
+        assert self.get_state_index(VmStates.READY) == set()
+        assert self.get_state_index(VmStates.IN_USE) == set([self.vm_name])
+
+        self.vmm.release_vm(self.vm_name)
+        assert self.get_state_index(VmStates.IN_USE) == set()
+        assert self.get_state_index(VmStates.READY) == set([self.vm_name])
+
+        self.vmm.start_vm_termination(self.vm_name)
+        assert self.get_state_index(VmStates.READY) == set()
+        assert self.get_state_index(VmStates.TERMINATING) == set([self.vm_name])
+
+        self.vmm.remove_vm_from_pool(self.vm_name)
+        assert self.get_state_index(VmStates.TERMINATING) == set()
+        assert self.vmm.lookup_vms_by_ip(self.vm_ip) == []
+
+    def test_rebuild_state_index(self):
+        self.vmm.add_vm_to_pool(self.vm_ip, "a1", self.group)
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, "a2", self.group)
+        # e.g. redis populated by an older backend
+        self.rc.hset(vmd.vm_key, "state", VmStates.READY)
+        self.rc.sadd(KEY_VM_STATE_INDEX.format(group=self.group, state=VmStates.IN_USE), "gone")
+
+        self.rc.delete(KEY_VM_IP_INDEX.format(vm_ip=self.vm_ip))
+
+        self.vmm.mark_server_start()
+        assert self.get_state_index(VmStates.GOT_IP) == set(["a1"])
+        assert self.get_state_index(VmStates.READY) == set(["a2"])
+        assert self.get_state_index(VmStates.IN_USE) == set()
+        assert set(vmd.vm_name for vmd in self.vmm.lookup_vms_by_ip(self.vm_ip)) == set(["a1", "a2"])
+
+    def test_ip_index_follows_ip_change(self):
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        vmd.store_field(self.rc, "vm_ip", "127.0.0.2")
+        assert self.vmm.lookup_vms_by_ip(self.vm_ip) == []
+        assert [vmd.vm_name for vmd in self.vmm.lookup_vms_by_ip("127.0.0.2")] == [self.vm_name]
+
+        vmd.vm_ip = "127.0.0.3"
+        vmd.store(self.rc)
+        assert self.vmm.lookup_vms_by_ip("127.0.0.2") == []
+        assert [vmd.vm_name for vmd in self.vmm.lookup_vms_by_ip("127.0.0.3")] == [self.vm_name]
+
+    def test_vm_schedule(self):
+        vmd = self.vmm.add_vm_to_pool(self.vm_ip, self.vm_name, self.group)
+        assert self.vmm.get_next_vm_due() == 0
+        assert self.vmm.pop_due_vms(10) == [self.vm_name]
+        assert self.vmm.get_next_vm_due() is None
+
+        self.vmm.schedule_vms({self.vm_name: 100})
+        self.vmm.schedule_vms({self.vm_name: 200})
+        assert self.vmm.get_next_vm_due() == 100
+        assert self.vmm.pop_due_vms(10) == []
+
+        # state change makes VM due immediately
+        vmd.store_field(self.rc, "state", VmStates.READY)
+        assert self.vmm.pop_due_vms(10) == [self.vm_name]
+
+        vmd.store_field(self.rc, "state", VmStates.TERMINATING)
+        self.vmm.remove_vm_from_pool(self.vm_name)
+        assert self.vmm.get_next_vm_due() is None
+
     def test_mark_server_start(self, mc_time):
         assert self.rc.hget(KEY_SERVER_INFO, "server_start_timestamp") is None
         for i in range(100):
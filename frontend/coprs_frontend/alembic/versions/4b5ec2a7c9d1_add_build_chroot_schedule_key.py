@@ -0,0 +1,32 @@
+"""add BuildChroot.schedule_key
+
+Revision ID: 4b5ec2a7c9d1
+Revises: 3341bf554454
+Create Date: 2016-10-03 14:12:37.540211
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b5ec2a7c9d1'
+down_revision = '3341bf554454'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('build_chroot', sa.Column('schedule_key', sa.Float(), nullable=True))
+    op.create_index('build_chroot_status_schedule_key', 'build_chroot', ['status', 'schedule_key'])
+
+    # keep the current order of pending tasks, background builds go last
+    op.execute("""
+        UPDATE build_chroot SET schedule_key = (
+            SELECT build.submitted_on + CASE WHEN build.is_background THEN 86400 ELSE 0 END
+            FROM build WHERE build.id = build_chroot.build_id)
+        WHERE build_chroot.status = 4
+    """)
+
+
+def downgrade():
+    op.drop_index('build_chroot_status_schedule_key', table_name='build_chroot')
+    op.drop_column('build_chroot', 'schedule_key')
@@ -38,6 +38,8 @@ import coprs.log
 from coprs.log import setup_log
 import coprs.models
 import coprs.whoosheers
+import coprs.work_notify
+import coprs.logic.schedule_logic
 
 from coprs.helpers import RedisConnectionProvider
 rcp = RedisConnectionProvider(config=app.config)
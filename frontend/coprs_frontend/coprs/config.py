@@ -55,6 +55,16 @@ class Config(object):
 
     SRPM_STORAGE_DIR = "/var/lib/copr/data/srpm_storage/"
 
+    # build queue scheduling, "fair_share" or "fifo"
+    BUILD_SCHEDULE_POLICY = "fair_share"
+    # queue time (in seconds) taken by one build task of an owner with weight 1
+    BUILD_SCHEDULE_SLOT = 60
+    # weights of owners ("user", "@group") and projects ("user/project")
+    BUILD_SCHEDULE_OWNER_WEIGHTS = {}
+    BUILD_SCHEDULE_PROJECT_WEIGHTS = {}
+    # background builds wait up to one day behind the normal ones
+    BUILD_SCHEDULE_CLASS_OFFSETS = {"normal": 0, "background": 3600 * 24}
+
 
 class ProductionConfig(Config):
     DEBUG = False
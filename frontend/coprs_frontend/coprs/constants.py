@@ -12,3 +12,12 @@ DEFAULT_BUILD_TIMEOUT = 3600 * 24  # 24 hours
 MIN_BUILD_TIMEOUT = 0
 MAX_BUILD_TIMEOUT = 86400
 DEFER_BUILD_SECONDS = 60
+# max number of build tasks leased by one backend request
+MAX_LEASED_BUILDS = 50
+# leased tasks which backend doesn't start within this many seconds go back to the queue
+BUILD_LEASE_TIMEOUT = 3600
+
+# average build duration reported to backend is computed from builds finished in this window
+QUEUE_STATS_DURATION_WINDOW = 3600 * 6
+# redis channel used to wake up backend dispatchers, keep in sync with copr-backend
+NEW_WORK_PUB_SUB = "copr:backend:new_work:pubsub::"
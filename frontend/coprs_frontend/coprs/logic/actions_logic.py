@@ -110,6 +110,7 @@ class ActionsLogic(object):
             data_dict["src_pkg_name"] = build.src_pkg_name
         else:
             data_dict["result_dir_name"] = build.result_dir_name
+        data_dict.update(build.copr.project_flags)
 
         action = models.Action(
             action_type=helpers.ActionTypeEnum("delete"),
@@ -121,6 +122,43 @@ class ActionsLogic(object):
         )
         db.session.add(action)
 
+    @classmethod
+    def send_cancel_build(cls, build):
+        """ Schedules stop of the running chroots of the build
+        :type build: models.Build
+        """
+        action = models.Action(
+            action_type=helpers.ActionTypeEnum("cancel_build"),
+            object_type="build",
+            object_id=build.id,
+            old_value=build.copr.full_name,
+            data=json.dumps({"build_id": build.id}),
+            created_on=int(time.time())
+        )
+        db.session.add(action)
+
+    @classmethod
+    def send_update_project(cls, copr, project_flags):
+        """ Announces changed project settings to backend
+        :type copr: models.Copr
+        :param dict project_flags: new value of :py:attr:`models.Copr.project_flags`
+        """
+        data_dict = {
+            "username": copr.owner_name,
+            "projectname": copr.name,
+        }
+        data_dict.update(project_flags)
+
+        action = models.Action(
+            action_type=helpers.ActionTypeEnum("update_project"),
+            object_type="copr",
+            object_id=copr.id,
+            old_value=copr.full_name,
+            data=json.dumps(data_dict),
+            created_on=int(time.time())
+        )
+        db.session.add(action)
+
     @classmethod
     def send_update_comps(cls, chroot):
         """ Schedules update comps.xml action
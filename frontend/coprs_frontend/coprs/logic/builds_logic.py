@@ -13,7 +13,7 @@ from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import false,true
 from werkzeug.utils import secure_filename
-from sqlalchemy import desc,asc, bindparam, Integer
+from sqlalchemy import desc,asc, bindparam, Integer, func
 from collections import defaultdict
 
 from coprs import app
@@ -21,7 +21,8 @@ from coprs import db
 from coprs import exceptions
 from coprs import models
 from coprs import helpers
-from coprs.constants import DEFAULT_BUILD_TIMEOUT, MAX_BUILD_TIMEOUT, DEFER_BUILD_SECONDS
+from coprs.constants import DEFAULT_BUILD_TIMEOUT, MAX_BUILD_TIMEOUT, DEFER_BUILD_SECONDS, \
+    QUEUE_STATS_DURATION_WINDOW, BUILD_LEASE_TIMEOUT
 from coprs.exceptions import MalformedArgumentException, ActionInProgressException, InsufficientRightsException
 from coprs.helpers import StatusEnum
 
@@ -115,22 +116,179 @@ class BuildsLogic(object):
 
     @classmethod
     def get_build_task(cls):
+        # read-only, stale tasks are requeued by `lease_build_tasks`
+        return cls.get_build_task_query().first()
+
+    @classmethod
+    def lease_build_tasks(cls, count, capacity=None):
+        """
+        Atomically take up to `count` tasks from the build queue and mark them
+        as starting, so that no other backend request gets them again.
+
+        When `capacity` is given, only tasks which backend can start right now
+        are taken, see `lease_build_tasks_for_group`.
+
+        Leases which the backend cannot use are returned through `defer_build`.
+        """
+        cls.requeue_stale_tasks()
+        if capacity is None:
+            tasks = cls.get_build_task_query().limit(count).with_for_update().all()
+            for task in tasks:
+                cls.mark_leased(task)
+            return tasks
+
+        tasks = []
+        for group in capacity:
+            if len(tasks) >= count:
+                break
+            tasks.extend(cls.lease_build_tasks_for_group(
+                min(count - len(tasks), group["count"]),
+                group["archs"],
+                group.get("max_per_owner"),
+                group.get("owners_in_use", {}),
+            ))
+        return tasks
+
+    @classmethod
+    def lease_build_tasks_for_group(cls, count, archs, max_per_owner=None, owners_in_use=None):
+        """
+        Lease up to `count` tasks for one backend build group, i.e. tasks with
+        a chroot of one of `archs` whose project owner doesn't exceed
+        `max_per_owner` running builds. Tasks of other archs or owners which
+        can't be served now don't block the rest of the queue.
+
+        :param owners_in_use: dict owner name -> number of builds already running
+        """
+        in_use = dict(owners_in_use or {})
+        arch_chroots = (db.session.query(models.MockChroot.id)
+                        .filter(models.MockChroot.arch.in_(archs)))
+
+        tasks = []
+        while len(tasks) < count:
+            saturated = []
+            if max_per_owner is not None:
+                saturated = [owner for owner, used in in_use.items() if used >= max_per_owner]
+
+            query = (cls.get_build_task_query()
+                     .filter(models.BuildChroot.mock_chroot_id.in_(arch_chroots)))
+            query = cls.filter_out_owners(query, saturated)
+            candidates = query.limit(count - len(tasks)).with_for_update().all()
+            if not candidates:
+                break
+
+            # every round leases at least one task, the owners of the
+            # skipped ones are excluded in the next round
+            for task in candidates:
+                owner = task.build.copr.owner_name
+                if max_per_owner is not None and in_use.get(owner, 0) >= max_per_owner:
+                    continue
+                in_use[owner] = in_use.get(owner, 0) + 1
+                cls.mark_leased(task)
+                tasks.append(task)
+
+            db.session.flush()
+
+        return tasks
+
+    @classmethod
+    def filter_out_owners(cls, query, owners):
+        """
+        Skip build tasks from projects of given owners (user names or @group names).
+        Uses subqueries, so the query can still be locked with FOR UPDATE.
+        """
+        users = [owner for owner in owners if not owner.startswith("@")]
+        groups = [owner[1:] for owner in owners if owner.startswith("@")]
+        if users:
+            query = query.filter(~models.Build.copr_id.in_(
+                db.session.query(models.Copr.id).join(models.Copr.user)
+                .filter(models.Copr.group_id.is_(None))
+                .filter(models.User.username.in_(users))))
+        if groups:
+            query = query.filter(~models.Build.copr_id.in_(
+                db.session.query(models.Copr.id).join(models.Copr.group)
+                .filter(models.Group.name.in_(groups))))
+        return query
+
+    @classmethod
+    def mark_leased(cls, task):
+        task.status = StatusEnum("starting")
+        task.started_on = int(time.time())
+        db.session.add(task)
+
+    @classmethod
+    def get_build_task_query(cls):
+        """
+        Returns pending BuildChroots in the order given by the scheduling
+        policy, see coprs.logic.schedule_logic. Served by the
+        (status, schedule_key) index, so it doesn't sort the whole queue.
+        """
         query = (models.BuildChroot.query.join(models.Build)
                  .filter(models.Build.canceled == false())
-                 .filter(or_(
-                     models.BuildChroot.status == helpers.StatusEnum("pending"),
-                     and_(
-                         models.BuildChroot.status == helpers.StatusEnum("running"),
-                         models.BuildChroot.started_on < int(time.time() - 1.1 * MAX_BUILD_TIMEOUT),
-                         models.BuildChroot.ended_on.is_(None)
-                     )
-                 ))
+                 .filter(models.BuildChroot.status == helpers.StatusEnum("pending"))
                  .filter(or_(
                      models.BuildChroot.last_deferred.is_(None),
                      models.BuildChroot.last_deferred < int(time.time() - DEFER_BUILD_SECONDS)
                  ))
-        ).order_by(models.Build.is_background.asc(), models.BuildChroot.build_id.asc())
-        return query.first()
+        ).order_by(models.BuildChroot.schedule_key.asc(), models.BuildChroot.build_id.asc())
+        return query
+
+    @classmethod
+    def requeue_stale_tasks(cls):
+        """
+        Return tasks running for much longer than the build timeout and
+        tasks leased (`mark_leased`) but not started within the lease timeout
+        back to the queue, backend has most probably lost them.
+        """
+        now = int(time.time())
+        stale = (models.BuildChroot.query
+                 .filter(or_(
+                     and_(models.BuildChroot.status == helpers.StatusEnum("running"),
+                          models.BuildChroot.started_on < now - 1.1 * MAX_BUILD_TIMEOUT),
+                     and_(models.BuildChroot.status == helpers.StatusEnum("starting"),
+                          models.BuildChroot.started_on < now - BUILD_LEASE_TIMEOUT),
+                 ))
+                 .filter(models.BuildChroot.ended_on.is_(None))
+                 .all())
+        for task in stale:
+            task.status = helpers.StatusEnum("pending")
+            db.session.add(task)
+
+    @classmethod
+    def get_queue_stats(cls, duration_window=QUEUE_STATS_DURATION_WINDOW):
+        """
+        Summarize the build queue per chroot arch, used by backend to scale
+        its VM pools: number of pending and running tasks and the average
+        duration of tasks finished within last `duration_window` seconds.
+
+        :return: dict arch -> {"pending": int, "running": int, "avg_duration": float or None}
+        """
+        stats = defaultdict(lambda: {"pending": 0, "running": 0, "avg_duration": None})
+
+        counts = (db.session.query(models.MockChroot.arch, models.BuildChroot.status,
+                                   func.count(models.BuildChroot.build_id))
+                  .select_from(models.BuildChroot)
+                  .join(models.MockChroot)
+                  .join(models.Build)
+                  .filter(models.Build.canceled == false())
+                  .filter(models.BuildChroot.status.in_([
+                      StatusEnum("pending"), StatusEnum("starting"), StatusEnum("running")]))
+                  .group_by(models.MockChroot.arch, models.BuildChroot.status))
+        for arch, status, count in counts:
+            key = "pending" if status == StatusEnum("pending") else "running"
+            stats[arch][key] += count
+
+        durations = (db.session.query(models.MockChroot.arch,
+                                      func.avg(models.BuildChroot.ended_on - models.BuildChroot.started_on))
+                     .select_from(models.BuildChroot)
+                     .join(models.MockChroot)
+                     .filter(models.BuildChroot.status.in_([StatusEnum("succeeded"), StatusEnum("failed")]))
+                     .filter(models.BuildChroot.started_on.isnot(None))
+                     .filter(models.BuildChroot.ended_on > int(time.time() - duration_window))
+                     .group_by(models.MockChroot.arch))
+        for arch, avg_duration in durations:
+            stats[arch]["avg_duration"] = float(avg_duration)
+
+        return dict(stats)
 
     @classmethod
     def get_multiple(cls):
@@ -644,6 +802,9 @@ GROUP BY
 
         for attr in ["results", "built_packages"]:
             value = upd_dict.get(attr, None)
+            if attr == "built_packages" and isinstance(value, list):
+                # backend sends metadata from the rpm headers, we keep "name version" lines
+                value = "\n".join("{} {}".format(pkg["name"], pkg["version"]) for pkg in value)
             if value:
                 setattr(build, attr, value)
 
@@ -655,13 +816,18 @@ GROUP BY
             raise exceptions.InsufficientRightsException(
                 "You are not allowed to cancel this build.")
         if not build.cancelable:
-            if build.status == StatusEnum("starting") or build.status == StatusEnum("running"):
-                err_msg = "Cannot cancel build {} which is still running".format(build.id)
-            else:
-                err_msg = "Cannot cancel build {}".format(build.id)
+            err_msg = "Cannot cancel build {}".format(build.id)
             raise exceptions.RequestCannotBeExecuted(err_msg)
+
+        running = [StatusEnum("starting"), StatusEnum("running")]
+        if any(chroot.status in running for chroot in build.build_chroots):
+            # backend stops the builds and releases their VMs
+            ActionsLogic.send_cancel_build(build)
+
         build.canceled = True
         for chroot in build.build_chroots:
+            if chroot.status in cls.terminal_states or chroot.status == StatusEnum("skipped"):
+                continue
             chroot.status = 2  # canceled
             if chroot.ended_on is not None:
                 chroot.ended_on = time.time()
@@ -682,7 +848,9 @@ GROUP BY
                 "You can not delete build `{}` which is not finished.".format(build.id),
                 "Unfinished build")
 
-        if send_delete_action and build.state not in ["canceled"]: # cancelled builds should have nothing in backend to delete
+        # canceled builds have results on backend only in the chroots which started
+        if send_delete_action and (build.state not in ["canceled"] or
+                                   any(chroot.started_on for chroot in build.build_chroots)):
             ActionsLogic.send_delete_build(build)
 
         for build_chroot in build.build_chroots:
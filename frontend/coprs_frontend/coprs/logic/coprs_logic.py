@@ -422,6 +422,24 @@ listen(models.Copr.auto_createrepo, 'set', on_auto_createrepo_change,
        active_history=True, retval=False)
 
 
+def on_project_flag_change(flag):
+    """ Emit update_project action when a flag backend caches changes """
+    def listener(target_copr, value, old_value, initiator):
+        if old_value == NEVER_SET or bool(old_value) == bool(value):
+            return
+        # attribute is set after listeners, so the old value is there yet
+        project_flags = target_copr.project_flags
+        project_flags[flag] = bool(value)
+        ActionsLogic.send_update_project(target_copr, project_flags)
+    return listener
+
+
+listen(models.Copr.auto_createrepo, 'set', on_project_flag_change("auto_createrepo"),
+       active_history=True, retval=False)
+listen(models.Copr.persistent, 'set', on_project_flag_change("persistent"),
+       active_history=True, retval=False)
+
+
 class CoprChrootsLogic(object):
     @classmethod
     def mock_chroots_from_names(cls, names):
@@ -0,0 +1,160 @@
+# coding: utf-8
+
+"""
+Build queue scheduling policies.
+
+Build queue is ordered by `BuildChroot.schedule_key` (ascending) which is
+assigned once, when the task enters the pending state. Picking the next task
+is then just an indexed `ORDER BY schedule_key LIMIT n` query, regardless of
+the queue length.
+
+Policy is selected by BUILD_SCHEDULE_POLICY config option, see
+`SCHEDULE_POLICIES`.
+"""
+
+import time
+
+from sqlalchemy import event, func, inspect
+from flask_sqlalchemy import SignallingSession
+
+from coprs import app
+from coprs import db
+from coprs import models
+from coprs.helpers import StatusEnum
+
+
+class SchedulePolicy(object):
+    """
+    Base class of scheduling policies, subclasses implement `get_key`.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def get_class_offset(self, build):
+        """
+        Priority classes are implemented as a constant offset of the key,
+        a task from lower class wins over the higher class after the offset
+        passes, so nothing starves forever.
+        """
+        offsets = self.config.get("BUILD_SCHEDULE_CLASS_OFFSETS", {})
+        priority_class = "background" if build.is_background else "normal"
+        return offsets.get(priority_class, 0)
+
+    def get_key(self, build_chroot, now):
+        raise NotImplementedError
+
+    def assign_keys(self, build_chroots):
+        now = int(time.time())
+        for build_chroot in build_chroots:
+            build_chroot.schedule_key = self.get_key(build_chroot, now)
+
+
+class FifoPolicy(SchedulePolicy):
+    """
+    First come, first served, within a priority class.
+    """
+
+    def get_key(self, build_chroot, now):
+        build = build_chroot.build
+        return (build.submitted_on or now) + self.get_class_offset(build)
+
+
+class FairSharePolicy(SchedulePolicy):
+    """
+    Weighted fair queuing across project owners.
+
+    Every owner has a virtual clock per priority class, the key of the owner's
+    latest pending task. A new task gets `max(now + offset, clock + cost)` where
+    `cost = BUILD_SCHEDULE_SLOT / (owner weight * project weight)`. Thus an
+    owner submitting thousands of builds queues them in the future, while
+    tasks of the others are interleaved with them. Keys are wall-clock based,
+    so waiting tasks age and get before any newly submitted ones.
+    """
+
+    def __init__(self, config):
+        super(FairSharePolicy, self).__init__(config)
+        # (owner, background) -> virtual clock, valid for one flush
+        self.clocks = {}
+
+    def get_cost(self, copr):
+        owner_weights = self.config.get("BUILD_SCHEDULE_OWNER_WEIGHTS", {})
+        project_weights = self.config.get("BUILD_SCHEDULE_PROJECT_WEIGHTS", {})
+        weight = (owner_weights.get(copr.owner_name, 1.0) *
+                  project_weights.get(copr.full_name, 1.0))
+        return self.config.get("BUILD_SCHEDULE_SLOT", 60) / float(weight)
+
+    def load_clock(self, copr, background):
+        """
+        Return the latest key of pending tasks of `copr` owner
+        """
+        if copr.id is None:
+            return None
+
+        owner_coprs = db.session.query(models.Copr.id)
+        if copr.group_id is not None:
+            owner_coprs = owner_coprs.filter(models.Copr.group_id == copr.group_id)
+        else:
+            owner_coprs = (owner_coprs.filter(models.Copr.user_id == copr.user_id)
+                           .filter(models.Copr.group_id.is_(None)))
+
+        return (db.session.query(func.max(models.BuildChroot.schedule_key))
+                .join(models.Build)
+                .filter(models.BuildChroot.status == StatusEnum("pending"))
+                .filter(models.Build.is_background == background)
+                .filter(models.Build.copr_id.in_(owner_coprs))
+                .scalar())
+
+    def get_key(self, build_chroot, now):
+        build = build_chroot.build
+        copr = build.copr
+        clock_id = (copr.owner_name, bool(build.is_background))
+        if clock_id not in self.clocks:
+            self.clocks[clock_id] = self.load_clock(copr, bool(build.is_background))
+
+        key = now + self.get_class_offset(build)
+        clock = self.clocks[clock_id]
+        if clock is not None:
+            key = max(key, clock + self.get_cost(copr))
+
+        self.clocks[clock_id] = key
+        return key
+
+
+SCHEDULE_POLICIES = {
+    "fifo": FifoPolicy,
+    "fair_share": FairSharePolicy,
+}
+
+
+def get_schedule_policy():
+    policy_cls = SCHEDULE_POLICIES[app.config.get("BUILD_SCHEDULE_POLICY", "fair_share")]
+    return policy_cls(app.config)
+
+
+def _get_entering_queue(session):
+    """
+    Return BuildChroots getting to the pending state without a schedule key,
+    tasks returned to the queue (deferred, rescheduled) keep their position.
+    """
+    pending = StatusEnum("pending")
+    entering = []
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, models.BuildChroot) or obj.schedule_key is not None:
+            continue
+        if obj.build is None:
+            continue
+        if pending in (inspect(obj).attrs.status.history.added or ()):
+            entering.append(obj)
+    return entering
+
+
+@event.listens_for(SignallingSession, "before_flush")
+def assign_schedule_keys(session, flush_context, instances):
+    entering = _get_entering_queue(session)
+    if not entering:
+        return
+
+    with session.no_autoflush:
+        get_schedule_policy().assign_keys(
+            sorted(entering, key=lambda bc: (bc.build.id or 0, bc.build.submitted_on or 0)))
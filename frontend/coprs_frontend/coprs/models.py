@@ -305,6 +305,16 @@ class Copr(db.Model, helpers.Serializer, CoprSearchRelatedData):
 
         self.auto_createrepo = not bool(value)
 
+    @property
+    def project_flags(self):
+        """
+        Return dict of the project settings backend needs for builds and actions
+        """
+        return {
+            "auto_createrepo": self.auto_createrepo,
+            "persistent": self.persistent,
+        }
+
     @property
     def modified_chroots(self):
         """
@@ -676,11 +686,11 @@ class Build(db.Model, helpers.Serializer):
         """
         Find out if this build is cancelable.
 
-        Build is cancelabel only when it's pending (not started)
+        Build is cancelable until it ends, running chroots are stopped by backend
         """
 
-        return self.status == StatusEnum("pending") or \
-            self.status == StatusEnum("importing")
+        return self.status in [StatusEnum("pending"), StatusEnum("importing"),
+                               StatusEnum("starting"), StatusEnum("running")]
 
     @property
     def repeatable(self):
@@ -885,6 +895,11 @@ class BuildChroot(db.Model, helpers.Serializer):
 
     last_deferred = db.Column(db.Integer)
 
+    # position in the build queue, see coprs.logic.schedule_logic
+    schedule_key = db.Column(db.Float)
+
+    __table_args__ = (db.Index("build_chroot_status_schedule_key", "status", "schedule_key"), )
+
     @property
     def name(self):
         """
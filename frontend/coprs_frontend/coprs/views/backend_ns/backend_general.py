@@ -4,6 +4,7 @@ import time
 from coprs import db, app
 from coprs import helpers
 from coprs import models
+from coprs.constants import MAX_LEASED_BUILDS
 from coprs.helpers import StatusEnum
 from coprs.logic import actions_logic
 from coprs.logic.builds_logic import BuildsLogic
@@ -114,6 +115,46 @@ def dist_git_upload_completed():
     return flask.jsonify(result)
 
 
+def get_build_record(task):
+    """
+    Return the dict describing a BuildChroot task as expected by the backend,
+    or None when the task can not be serialized.
+    """
+    try:
+        build_record = {
+            "task_id": task.task_id,
+            "build_id": task.build.id,
+            "project_owner": task.build.copr.owner_name,
+            "project_name": task.build.copr.name,
+            "submitter": task.build.user.name if task.build.user else None, # there is no user for webhook builds
+            "pkgs": task.build.pkgs,  # TODO to be removed
+            "chroot": task.mock_chroot.name,
+
+            "repos": task.build.repos,
+            "memory_reqs": task.build.memory_reqs,
+            "timeout": task.build.timeout,
+            "enable_net": task.build.enable_net,
+            "git_repo": task.build.package.dist_git_repo,
+            "git_hash": task.git_hash,
+            "git_branch": helpers.chroot_to_branch(task.mock_chroot.name),
+            "package_name": task.build.package.name,
+            "package_version": task.build.pkg_version
+        }
+        build_record.update(task.build.copr.project_flags)
+
+        copr_chroot = CoprChrootsLogic.get_by_name_safe(task.build.copr, task.mock_chroot.name)
+        if copr_chroot:
+            build_record["buildroot_pkgs"] = copr_chroot.buildroot_pkgs
+        else:
+            build_record["buildroot_pkgs"] = ""
+
+    except Exception as err:
+        app.logger.exception(err)
+        return None
+
+    return build_record
+
+
 @backend_ns.route("/waiting/")
 #@misc.backend_authenticated
 def waiting():
@@ -131,40 +172,50 @@ def waiting():
 
     task = BuildsLogic.get_build_task()
     if task:
-        try:
-            build_record = {
-                "task_id": task.task_id,
-                "build_id": task.build.id,
-                "project_owner": task.build.copr.owner_name,
-                "project_name": task.build.copr.name,
-                "submitter": task.build.user.name if task.build.user else None, # there is no user for webhook builds
-                "pkgs": task.build.pkgs,  # TODO to be removed
-                "chroot": task.mock_chroot.name,
-
-                "repos": task.build.repos,
-                "memory_reqs": task.build.memory_reqs,
-                "timeout": task.build.timeout,
-                "enable_net": task.build.enable_net,
-                "git_repo": task.build.package.dist_git_repo,
-                "git_hash": task.git_hash,
-                "git_branch": helpers.chroot_to_branch(task.mock_chroot.name),
-                "package_name": task.build.package.name,
-                "package_version": task.build.pkg_version
-            }
-
-            copr_chroot = CoprChrootsLogic.get_by_name_safe(task.build.copr, task.mock_chroot.name)
-            if copr_chroot:
-                build_record["buildroot_pkgs"] = copr_chroot.buildroot_pkgs
-            else:
-                build_record["buildroot_pkgs"] = ""
-
-        except Exception as err:
-            app.logger.exception(err)
+        build_record = get_build_record(task)
 
     response_dict = {"action": action_record, "build": build_record}
     return flask.jsonify(response_dict)
 
 
+@backend_ns.route("/lease_builds/", methods=["POST", "PUT"])
+@misc.backend_authenticated
+def lease_builds():
+    """
+    Lease up to `count` build tasks at once. Leased tasks are moved
+    to the starting state, unused leases are returned by `defer_build`.
+
+    Optional `capacity` lists build groups with ready VMs, e.g.:
+    [{"archs": ["x86_64"], "count": 2, "max_per_owner": 4, "owners_in_use": {"bob": 1}}]
+    only tasks which fit in are leased then.
+    """
+    count = int(flask.request.json.get("count", 1))
+    count = max(1, min(count, MAX_LEASED_BUILDS))
+    capacity = flask.request.json.get("capacity")
+
+    builds_list = []
+    for task in BuildsLogic.lease_build_tasks(count, capacity):
+        build_record = get_build_record(task)
+        if build_record:
+            builds_list.append(build_record)
+        else:
+            task.status = StatusEnum("pending")
+            db.session.add(task)
+    db.session.commit()
+
+    return flask.jsonify({"builds": builds_list})
+
+
+@backend_ns.route("/queue_stats/", methods=["POST", "PUT"])
+@misc.backend_authenticated
+def queue_stats():
+    """
+    Return pending and running task counts and recent average build
+    duration per chroot arch, used by backend to scale VM pools.
+    """
+    return flask.jsonify({"archs": BuildsLogic.get_queue_stats()})
+
+
 @backend_ns.route("/update/", methods=["POST", "PUT"])
 @misc.backend_authenticated
 def update():
@@ -227,6 +278,7 @@ def starting_build():
 def defer_build():
     """
     Defer build (keep it out of waiting jobs for some time).
+    Also returns a leased (starting) build back to the pending state.
     """
 
     result = {"was_deferred": False}
@@ -237,10 +289,15 @@ def defer_build():
 
         if build and chroot:
             log.info("Defer build {}, chroot {}".format(build.id, chroot))
-            BuildsLogic.update_state_from_dict(build, {
+            upd_dict = {
                 "chroot": chroot,
                 "last_deferred": int(time.time()),
-            })
+            }
+            # leased builds are returned back to the queue
+            build_chroot = build.chroots_dict_by_name.get(chroot)
+            if build_chroot and build_chroot.status == StatusEnum("starting"):
+                upd_dict["status"] = StatusEnum("pending")
+            BuildsLogic.update_state_from_dict(build, upd_dict)
             db.session.commit()
             result["was_deferred"] = True
 
@@ -251,14 +308,22 @@ def defer_build():
 @misc.backend_authenticated
 def reschedule_all_running():
     """
-    Add-hoc handle. Remove after implementation of persistent task handling in copr-backend
+    Return starting and running builds to the queue on backend start,
+    except the builds listed in `keep` which backend resumes,
+    e.g.: {"keep": [{"build_id": 1, "chroot": "fedora-24-x86_64"}]}
     """
+    keep = set()
+    if flask.request.json:
+        keep = set((item["build_id"], item["chroot"]) for item in flask.request.json.get("keep", []))
+
     to_reschedule = \
         BuildsLogic.get_build_tasks(StatusEnum("starting")).all() + \
         BuildsLogic.get_build_tasks(StatusEnum("running")).all()
 
     if to_reschedule:
         for build_chroot in to_reschedule:
+            if (build_chroot.build_id, build_chroot.name) in keep:
+                continue
             build_chroot.status = StatusEnum("pending")
             db.session.add(build_chroot)
 
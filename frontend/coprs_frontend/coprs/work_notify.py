@@ -0,0 +1,67 @@
+# coding: utf-8
+
+"""
+Announce new runnable work to the backend dispatchers over redis, so they
+don't need to poll the frontend for it.
+
+New pending build chroots and new actions are collected on every flush and
+published only once the transaction is committed, otherwise the dispatcher
+could ask for the work before it is visible in the database.
+"""
+
+from itertools import chain
+
+from redis.exceptions import RedisError
+from sqlalchemy import event, inspect
+from flask_sqlalchemy import SignallingSession
+
+from coprs import app
+from coprs import models
+from coprs import helpers
+from coprs.constants import NEW_WORK_PUB_SUB
+
+rcp = helpers.RedisConnectionProvider(config=app.config)
+
+SESSION_KEY = "copr_new_work"
+
+
+def _get_new_work(session):
+    """
+    Return set of work kinds ("build", "action") added by the pending flush
+    """
+    kinds = set()
+    pending = helpers.StatusEnum("pending")
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, models.Action) and obj in session.new:
+            kinds.add("action")
+        elif isinstance(obj, models.BuildChroot):
+            if pending in (inspect(obj).attrs.status.history.added or ()):
+                kinds.add("build")
+    return kinds
+
+
+@event.listens_for(SignallingSession, "after_flush")
+def collect_new_work(session, flush_context):
+    kinds = _get_new_work(session)
+    if kinds:
+        session.info.setdefault(SESSION_KEY, set()).update(kinds)
+
+
+@event.listens_for(SignallingSession, "after_rollback")
+def forget_new_work(session):
+    session.info.pop(SESSION_KEY, None)
+
+
+@event.listens_for(SignallingSession, "after_commit")
+def publish_new_work(session):
+    kinds = session.info.pop(SESSION_KEY, None)
+    if not kinds:
+        return
+
+    try:
+        rc = rcp.get_connection()
+        for kind in sorted(kinds):
+            rc.publish(NEW_WORK_PUB_SUB, kind)
+    except RedisError as err:
+        # backend falls back to polling, nothing is lost
+        app.logger.warning("Failed to notify backend about new work: {}".format(err))
@@ -5,7 +5,7 @@ import pytest
 import time
 from sqlalchemy.orm.exc import NoResultFound
 from coprs import helpers, models
-from coprs.constants import MAX_BUILD_TIMEOUT
+from coprs.constants import MAX_BUILD_TIMEOUT, BUILD_LEASE_TIMEOUT
 
 from coprs.exceptions import ActionInProgressException, InsufficientRightsException, MalformedArgumentException
 from coprs.helpers import StatusEnum
@@ -202,6 +202,8 @@ class TestBuildsLogic(CoprsTestCase):
         assert "chroots" in delete_data
         assert delete_data["result_dir_name"] == expected_dir
         assert expected_chroots_to_delete == set(delete_data["chroots"])
+        assert delete_data["auto_createrepo"] == self.c1.auto_createrepo
+        assert delete_data["persistent"] == self.c1.persistent
 
         with pytest.raises(NoResultFound):
             BuildsLogic.get(self.b1.id).one()
@@ -266,6 +268,70 @@ class TestBuildsLogic(CoprsTestCase):
         with pytest.raises(NoResultFound):
             BuildsLogic.get(self.b1.id).one()
 
+    def test_delete_build_canceled(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        self.b1.pkgs = "http://example.com/copr-keygen-1.58-1.fc20.src.rpm"
+        self.b1.canceled = True
+        for bchroot in self.b1_bc[1:]:
+            bchroot.status = helpers.StatusEnum("canceled")
+            bchroot.started_on = None
+        self.db.session.add(self.b1)
+        self.db.session.commit()
+
+        # the first chroot succeeded before the build was canceled
+        assert self.b1.state == "canceled"
+        BuildsLogic.delete_build(self.u1, self.b1)
+        self.db.session.commit()
+
+        assert len(ActionsLogic.get_many().all()) == 1
+        with pytest.raises(NoResultFound):
+            BuildsLogic.get(self.b1.id).one()
+
+    def test_delete_build_canceled_before_start(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        self.b1.canceled = True
+        for bchroot in self.b1_bc:
+            bchroot.status = helpers.StatusEnum("canceled")
+            bchroot.started_on = None
+        self.db.session.add(self.b1)
+        self.db.session.commit()
+
+        BuildsLogic.delete_build(self.u1, self.b1)
+        self.db.session.commit()
+
+        assert len(ActionsLogic.get_many().all()) == 0
+
+    def test_stale_tasks_requeued_only_by_lease(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        stale = self.b1_bc[0]
+        stale.status = helpers.StatusEnum("running")
+        stale.started_on = 0
+        stale.ended_on = None
+        self.db.session.commit()
+
+        BuildsLogic.get_build_task()
+        assert stale.status == helpers.StatusEnum("running")
+
+        BuildsLogic.lease_build_tasks(10)
+        assert stale.status != helpers.StatusEnum("running")
+
+    def test_expired_leases_requeued(
+            self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+
+        expired, fresh = self.b1_bc[0], self.b2_bc[0]
+        for task, started_on in [(expired, time.time() - BUILD_LEASE_TIMEOUT - 10), (fresh, time.time())]:
+            task.status = helpers.StatusEnum("starting")
+            task.started_on = started_on
+            task.ended_on = None
+        self.db.session.commit()
+
+        BuildsLogic.requeue_stale_tasks()
+        assert expired.status == helpers.StatusEnum("pending")
+        assert fresh.status == helpers.StatusEnum("starting")
+
     def test_mark_as_failed(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
         BuildsLogic.mark_as_failed(self.b1.id)
         BuildsLogic.mark_as_failed(self.b3.id)
@@ -74,4 +74,19 @@ class TestCoprsLogic(CoprsTestCase):
         assert data["username"] == self.u1.name
         assert data["projectname"] == name
 
+    def test_project_flag_change_sends_update_project_action(self, f_users, f_coprs, f_db):
+        assert not self.c1.persistent
+        assert len(ActionsLogic.get_many(ActionTypeEnum("update_project")).all()) == 0
+
+        # query flushes the session, commit would hit the whooshee index update
+        self.c1.persistent = True
+
+        actions = ActionsLogic.get_many(ActionTypeEnum("update_project")).all()
+        assert len(actions) == 1
+        data = json.loads(actions[0].data)
+        assert data["username"] == self.c1.owner_name
+        assert data["projectname"] == self.c1.name
+        assert data["persistent"] is True
+        assert data["auto_createrepo"] == self.c1.auto_createrepo
+
 
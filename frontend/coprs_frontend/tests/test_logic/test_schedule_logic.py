@@ -0,0 +1,69 @@
+# -*- encoding: utf-8 -*-
+
+from coprs import app
+from coprs.helpers import StatusEnum
+from coprs.logic.builds_logic import BuildsLogic
+
+from tests.coprs_test_case import CoprsTestCase
+
+
+class TestScheduleLogic(CoprsTestCase):
+
+    def submit(self, user, copr, count, background=False):
+        for _ in range(count):
+            BuildsLogic.add(user, "blah", copr, skip_import=True, background=background)
+        self.db.session.commit()
+
+    def queue_owners(self):
+        return [task.build.copr.owner_name
+                for task in BuildsLogic.get_build_task_query().all()]
+
+    def test_fair_share_interleaves_owners(self, f_users, f_coprs, f_mock_chroots, f_db):
+        self.submit(self.u1, self.c1, 5)
+        self.submit(self.u2, self.c3, 1)
+
+        owners = self.queue_owners()
+        assert len(owners) == 6
+        assert owners[:2] == [self.u1.name, self.u2.name]
+
+    def test_fair_share_weights(self, f_users, f_coprs, f_mock_chroots, f_db):
+        app.config["BUILD_SCHEDULE_OWNER_WEIGHTS"] = {self.u2.name: 4}
+        try:
+            self.submit(self.u1, self.c1, 3)
+            self.submit(self.u2, self.c3, 6)
+        finally:
+            app.config["BUILD_SCHEDULE_OWNER_WEIGHTS"] = {}
+
+        owners = self.queue_owners()
+        # u2 gets four slots for each slot of u1
+        assert owners[1:6].count(self.u2.name) == 4
+
+    def test_background_class(self, f_users, f_coprs, f_mock_chroots, f_db):
+        self.submit(self.u2, self.c3, 2, background=True)
+        self.submit(self.u1, self.c1, 1)
+
+        tasks = BuildsLogic.get_build_task_query().all()
+        assert [t.build.is_background for t in tasks] == [False, True, True]
+
+    def test_requeued_task_keeps_position(self, f_users, f_coprs, f_mock_chroots, f_db):
+        self.submit(self.u1, self.c1, 2)
+        first = BuildsLogic.get_build_task_query().first()
+        key = first.schedule_key
+
+        first.status = StatusEnum("starting")
+        self.db.session.commit()
+        first.status = StatusEnum("pending")
+        self.db.session.commit()
+
+        assert first.schedule_key == key
+        assert BuildsLogic.get_build_task_query().first() == first
+
+    def test_fifo_policy(self, f_users, f_coprs, f_mock_chroots, f_db):
+        app.config["BUILD_SCHEDULE_POLICY"] = "fifo"
+        try:
+            self.submit(self.u1, self.c1, 3)
+            self.submit(self.u2, self.c3, 1)
+        finally:
+            app.config["BUILD_SCHEDULE_POLICY"] = "fair_share"
+
+        assert self.queue_owners()[-1] == self.u2.name
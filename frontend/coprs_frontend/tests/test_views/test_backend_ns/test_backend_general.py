@@ -1,4 +1,5 @@
 import json
+import time
 
 from tests.coprs_test_case import CoprsTestCase
 from coprs.logic.builds_logic import BuildsLogic
@@ -31,6 +32,139 @@ class TestWaitingBuilds(CoprsTestCase):
         r = self.tc.get("/backend/waiting/")
         data = json.loads(r.data)
         assert data["build"]["build_id"] == 3
+        assert data["build"]["auto_createrepo"] == self.b3.copr.auto_createrepo
+        assert data["build"]["persistent"] == self.b3.copr.persistent
+
+
+class TestLeaseBuilds(CoprsTestCase):
+
+    def lease(self, count, capacity=None):
+        data = {"count": count}
+        if capacity is not None:
+            data["capacity"] = capacity
+        r = self.tc.post("/backend/lease_builds/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps(data))
+        return json.loads(r.data.decode("utf-8"))["builds"]
+
+    def test_lease_requires_password(self, f_users, f_coprs, f_builds, f_db):
+        r = self.tc.post("/backend/lease_builds/",
+                         content_type="application/json",
+                         data=json.dumps({"count": 1}))
+        assert b"You have to provide the correct password" in r.data
+
+    def test_lease_builds(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroots in [self.b2_bc, self.b3_bc, self.b4_bc]:
+            for build_chroot in build_chroots:
+                build_chroot.status = 4  # pending
+        self.db.session.commit()
+
+        leased = self.lease(3)
+        assert len(leased) == 3
+        assert set(b["task_id"] for b in leased).isdisjoint(
+            set(b["task_id"] for b in self.lease(10)))
+        assert self.lease(10) == []
+
+        for build_chroot in self.models.BuildChroot.query.all():
+            if build_chroot.build_id != 1:
+                assert build_chroot.status == 6  # starting
+
+    def test_lease_builds_capacity_archs(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroots in [self.b2_bc, self.b3_bc, self.b4_bc]:
+            for build_chroot in build_chroots:
+                build_chroot.status = 4  # pending
+        self.db.session.commit()
+
+        leased = self.lease(10, [{"archs": ["i386", "ppc64le"], "count": 5}])
+        assert sorted(b["task_id"] for b in leased) == ["3-fedora-17-i386", "4-fedora-17-i386"]
+
+        leased = self.lease(10, [{"archs": ["ppc64le"], "count": 5},
+                                 {"archs": ["x86_64"], "count": 1}])
+        assert [b["task_id"] for b in leased] == ["2-fedora-18-x86_64"]
+
+        assert self.lease(10, []) == []
+
+    def test_lease_builds_capacity_owners(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroots in [self.b2_bc, self.b3_bc, self.b4_bc]:
+            for build_chroot in build_chroots:
+                build_chroot.status = 4  # pending
+        self.db.session.commit()
+
+        u2_name = self.u2.name
+        capacity = {"archs": ["x86_64"], "count": 5, "max_per_owner": 1,
+                    "owners_in_use": {u2_name: 1}}
+        leased = self.lease(10, [capacity])
+        assert [b["task_id"] for b in leased] == ["2-fedora-18-x86_64"]
+
+        # one build of u2 fits in, the rest is left in queue
+        capacity["owners_in_use"] = {}
+        leased = self.lease(10, [capacity])
+        assert [b["task_id"] for b in leased] == ["3-fedora-17-x86_64"]
+
+    def test_queue_stats(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        now = int(time.time())
+        for build_chroot in self.b2_bc + self.b3_bc:
+            build_chroot.status = 4  # pending
+        for build_chroot in self.b4_bc:
+            build_chroot.status = 3  # running
+        self.b3_bc[0].status = 1  # succeeded
+        self.b3_bc[0].started_on = now - 300
+        self.b3_bc[0].ended_on = now - 100
+        for build_chroot in self.b1_bc:
+            # finished too long ago to count
+            build_chroot.started_on, build_chroot.ended_on = 0, 100
+        self.db.session.commit()
+
+        r = self.tc.post("/backend/queue_stats/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps({}))
+        stats = json.loads(r.data.decode("utf-8"))["archs"]
+        assert stats == {
+            "x86_64": {"pending": 1, "running": 1, "avg_duration": 200.0},
+            "i386": {"pending": 1, "running": 1, "avg_duration": None},
+        }
+
+    def test_defer_returns_lease(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroot in self.b2_bc:
+            build_chroot.status = 4  # pending
+        self.db.session.commit()
+
+        leased = self.lease(1)
+        assert len(leased) == 1
+
+        r = self.tc.post("/backend/defer_build/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps({"build_id": leased[0]["build_id"],
+                                          "chroot": leased[0]["chroot"]}))
+        assert json.loads(r.data.decode("utf-8"))["was_deferred"]
+
+        build_chroot = self.models.BuildChroot.query.filter(
+            self.models.BuildChroot.build_id == leased[0]["build_id"]).one()
+        assert build_chroot.status == 4  # pending
+        assert build_chroot.last_deferred is not None
+
+        # deferred build is kept out of the queue for a while
+        assert self.lease(1) == []
+
+    def test_reschedule_all_running_keeps_resumed(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        for build_chroot in self.b2_bc + self.b3_bc:
+            build_chroot.status = 3  # running
+        self.db.session.commit()
+        running = [(bc.build_id, bc.name) for bc in self.b2_bc + self.b3_bc]
+        kept = running[0]
+
+        r = self.tc.post("/backend/reschedule_all_running/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps({"keep": [{"build_id": kept[0], "chroot": kept[1]}]}))
+        assert r.status_code == 200
+
+        statuses = dict(((bc.build_id, bc.name), bc.status) for bc in self.models.BuildChroot.query.all())
+        assert statuses[kept] == 3
+        assert [statuses[key] for key in running[1:]] == [4] * (len(running) - 1)
 
 
 # status = 0 # failure
@@ -120,6 +254,27 @@ class TestUpdateBuilds(CoprsTestCase):
         assert updated.status == 1
         assert updated.chroots_ended_on == {'fedora-18-x86_64': 149086644000}
 
+    def test_update_built_packages(self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
+        self.db.session.commit()
+        data = {"builds": [{
+            "id": 1,
+            "chroot": "fedora-18-x86_64",
+            "built_packages": [
+                {"name": "foo", "epoch": None, "version": "1.0", "release": "1.fc18",
+                 "arch": "x86_64", "size": 1024},
+                {"name": "foo-devel", "epoch": 1, "version": "1.0", "release": "1.fc18",
+                 "arch": "noarch", "size": 10},
+            ],
+        }]}
+        r = self.tc.post("/backend/update/",
+                         content_type="application/json",
+                         headers=self.auth_header,
+                         data=json.dumps(data))
+        assert json.loads(r.data.decode("utf-8"))["updated_builds_ids"] == [1]
+
+        updated = self.models.Build.query.filter(self.models.Build.id == 1).one()
+        assert updated.built_packages == "foo 1.0\nfoo-devel 1.0"
+
     def test_update_more_existent_and_non_existent_builds(
             self, f_users, f_coprs, f_mock_chroots, f_builds, f_db):
 
@@ -1,6 +1,6 @@
 import json
 from coprs import models
-from coprs.helpers import StatusEnum
+from coprs.helpers import StatusEnum, ActionTypeEnum
 from tests.coprs_test_case import CoprsTestCase, TransactionDecorator
 
 
@@ -102,6 +102,27 @@ class TestCoprCancelBuild(CoprsTestCase):
 
         assert self.models.Build.query.first().canceled is True
 
+    @TransactionDecorator("u1")
+    def test_copr_build_submitter_can_cancel_running_build(self, f_users, f_coprs,
+                                                           f_mock_chroots,
+                                                           f_builds, f_db):
+        self.b1_bc[0].status = StatusEnum("running")
+        self.b1_bc[0].ended_on = None
+        self.db.session.add_all(self.b1_bc)
+        self.db.session.add_all([self.u1, self.c1, self.b1])
+        self.test_client.post("/coprs/{0}/{1}/cancel_build/{2}/"
+                              .format(self.u1.name, self.c1.name, self.b1.id),
+                              data={},
+                              follow_redirects=True)
+
+        build = self.models.Build.query.get(self.b1.id)
+        assert build.canceled is True
+        assert build.build_chroots[0].status == StatusEnum("canceled")
+
+        action = self.models.Action.query.one()
+        assert action.action_type == ActionTypeEnum("cancel_build")
+        assert json.loads(action.data) == {"build_id": self.b1.id}
+
     @TransactionDecorator("u2")
     def test_copr_build_non_submitter_cannot_cancel_build(self, f_users,
                                                           f_coprs,
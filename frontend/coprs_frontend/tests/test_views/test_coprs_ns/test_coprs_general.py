@@ -396,8 +396,9 @@ class TestCoprUpdate(CoprsTestCase):
         # check current status
         c1_actual = CoprsLogic.get(username, coprname).one()
         assert not c1_actual.auto_createrepo
-        # no actions issued before
-        assert len(ActionsLogic.get_many().all()) == 0
+        # only backend got notified about the change
+        assert len(ActionsLogic.get_many(action_type=ActionTypeEnum("createrepo")).all()) == 0
+        assert len(ActionsLogic.get_many(action_type=ActionTypeEnum("update_project")).all()) == 1
 
         # 2. enabling ACR
         self.test_client.post(
@@ -420,6 +421,30 @@ class TestCoprUpdate(CoprsTestCase):
         assert data_dict["username"] == username
         assert data_dict["projectname"] == coprname
 
+    @TransactionDecorator("u1")
+    def test_update_sends_project_flags(
+            self, f_users, f_coprs, f_mock_chroots, f_db):
+
+        self.db.session.add_all([self.u1, self.c1, self.mc1])
+        self.db.session.commit()
+        username, coprname = self.u1.name, self.c1.name
+
+        r = self.test_client.post(
+            "/coprs/{0}/{1}/update/".format(username, coprname),
+            data={"name": coprname, self.mc1.name: "y", "id": self.c1.id,
+                  "disable_createrepo": True},
+            follow_redirects=True
+        )
+        assert r.status_code == 200
+
+        action = ActionsLogic.get_many(action_type=ActionTypeEnum("update_project")).one()
+        data_dict = json.loads(action.data)
+        assert data_dict["username"] == username
+        assert data_dict["projectname"] == coprname
+        assert data_dict["auto_createrepo"] is False
+        assert action.object_type == "copr"
+        assert action.old_value == "{}/{}".format(username, coprname)
+
 
 class TestCoprApplyForPermissions(CoprsTestCase):
 
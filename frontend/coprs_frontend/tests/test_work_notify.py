@@ -0,0 +1,84 @@
+# coding: utf-8
+
+from redis import ConnectionError
+
+from coprs import helpers
+from coprs.constants import NEW_WORK_PUB_SUB
+from coprs.logic.actions_logic import ActionsLogic
+from coprs.logic.builds_logic import BuildsLogic
+from coprs.work_notify import rcp
+
+from tests.coprs_test_case import CoprsTestCase
+
+
+class TestWorkNotify(CoprsTestCase):
+
+    def setup_method(self, method):
+        super(TestWorkNotify, self).setup_method(method)
+        self.pubsub = rcp.get_connection().pubsub(ignore_subscribe_messages=True)
+        self.disabled = False
+        try:
+            self.pubsub.subscribe(NEW_WORK_PUB_SUB)
+        except ConnectionError:
+            self.disabled = True
+
+    def teardown_method(self, method):
+        if not self.disabled:
+            self.pubsub.close()
+        super(TestWorkNotify, self).teardown_method(method)
+
+    def get_published(self):
+        published = []
+        while True:
+            msg = self.pubsub.get_message(timeout=0.2)
+            if msg is None:
+                return published
+            published.append(msg["data"])
+
+    def test_new_build_published_after_commit(self, f_users, f_coprs,
+                                              f_mock_chroots, f_db):
+        if self.disabled:
+            return
+        self.get_published()
+
+        BuildsLogic.add(self.u1, "blah", self.c1, skip_import=True)
+        self.db.session.flush()
+        assert self.get_published() == []
+
+        self.db.session.commit()
+        assert self.get_published() == ["build"]
+
+    def test_importing_build_not_published(self, f_users, f_coprs,
+                                           f_mock_chroots, f_db):
+        if self.disabled:
+            return
+        self.get_published()
+
+        build = BuildsLogic.add(self.u1, "blah", self.c1)
+        self.db.session.commit()
+        assert self.get_published() == []
+
+        for chroot in build.build_chroots:
+            chroot.status = helpers.StatusEnum("pending")
+        self.db.session.commit()
+        assert self.get_published() == ["build"]
+
+    def test_action_published(self, f_users, f_coprs, f_db):
+        if self.disabled:
+            return
+        self.get_published()
+
+        ActionsLogic.send_create_gpg_key(self.c1)
+        self.db.session.commit()
+        assert self.get_published() == ["action"]
+
+    def test_rollback_not_published(self, f_users, f_coprs, f_db):
+        if self.disabled:
+            return
+        self.get_published()
+
+        ActionsLogic.send_create_gpg_key(self.c1)
+        self.db.session.flush()
+        self.db.session.rollback()
+        self.db.session.commit()
+        assert self.get_published() == []